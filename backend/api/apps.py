@@ -4,3 +4,12 @@ from django.apps import AppConfig
 class ApiConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'api'
+
+    def ready(self):
+        from django.db.backends.signals import connection_created
+
+        from .metrics import install_sql_counter
+        from .profiling import install_sql_wrapper
+
+        connection_created.connect(install_sql_wrapper)
+        connection_created.connect(install_sql_counter)
@@ -0,0 +1,74 @@
+import asyncio
+import contextvars
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import close_old_connections
+from rest_framework.permissions import SAFE_METHODS
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    """Пул потоков для ORM, общий для всех async-представлений процесса."""
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(
+                    max_workers=settings.ASYNC_READ_VIEWS_THREADS,
+                    thread_name_prefix='orm')
+    return _executor
+
+
+def run_in_pool(view, request, *args, **kwargs):
+    # Потоки пула живут между запросами, поэтому соединения с БД
+    # проверяются так же, как Django делает это на границах запроса.
+    close_old_connections()
+    try:
+        response = view(request, *args, **kwargs)
+        if hasattr(response, 'render'):
+            response = response.render()
+        if response.streaming:
+            # ASGI-обработчик Django 3.2 читает поток в цикле событий,
+            # где ORM недоступен: ответ дочитывается здесь.
+            response.streaming_content = list(response.streaming_content)
+        return response
+    finally:
+        close_old_connections()
+
+
+def async_read_view(view):
+    """Async-обертка представления: чтение выполняется в пуле потоков,
+    и один воркер обслуживает несколько запросов, пока они ждут БД.
+    Запись идет как у обычного sync-представления под ASGI."""
+    write_view = sync_to_async(view)
+
+    @functools.wraps(view)
+    async def wrapper(request, *args, **kwargs):
+        if request.method not in SAFE_METHODS:
+            return await write_view(request, *args, **kwargs)
+        loop = asyncio.get_running_loop()
+        # Контекст копируется, чтобы замеры профилирования шли в пул.
+        context = contextvars.copy_context()
+        return await loop.run_in_executor(
+            get_executor(), functools.partial(
+                context.run, run_in_pool, view, request, *args, **kwargs))
+
+    return wrapper
+
+
+class AsyncReadViewSetMixin:
+    """При ASYNC_READ_VIEWS маршруты вьюсета становятся async-представлениями
+    с чтением в пуле потоков; в режиме WSGI вьюсет не меняется."""
+
+    @classmethod
+    def as_view(cls, actions=None, **initkwargs):
+        view = super().as_view(actions, **initkwargs)
+        if not settings.ASYNC_READ_VIEWS:
+            return view
+        return async_read_view(view)
@@ -0,0 +1,55 @@
+import gzip
+import hashlib
+
+from django.conf import settings
+from django.core.cache import cache
+from django.http import HttpResponse, HttpResponseNotModified
+from django.utils.cache import patch_vary_headers
+from rest_framework.renderers import JSONRenderer
+
+from recipes.versions import catalog_version
+from .metrics import record_cache
+
+
+def parse_etags(header):
+    return {tag.strip() for tag in header.split(',') if tag.strip()}
+
+
+class CatalogCacheMixin:
+    """Готовый JSON (и его gzip) справочника, закэшированный по версии.
+
+    Ответ несет сильный ETag, на совпадающий If-None-Match отдается 304.
+    Запросы с параметрами обрабатываются как обычно.
+    """
+
+    catalog_name = None
+
+    def get_catalog_payload(self):
+        key = f'catalog:{self.catalog_name}:v{catalog_version()}'
+        payload = cache.get(key)
+        record_cache('catalog', payload is not None)
+        if payload is None:
+            serializer = self.get_serializer(
+                self.filter_queryset(self.get_queryset()), many=True)
+            body = JSONRenderer().render(serializer.data)
+            etag = f'"{hashlib.sha1(body).hexdigest()}"'
+            payload = (body, gzip.compress(body), etag)
+            cache.set(key, payload, settings.CATALOG_CACHE_TIMEOUT)
+        return payload
+
+    def list(self, request, *args, **kwargs):
+        if request.query_params:
+            return super().list(request, *args, **kwargs)
+        body, compressed, etag = self.get_catalog_payload()
+        use_gzip = 'gzip' in request.META.get('HTTP_ACCEPT_ENCODING', '')
+        if use_gzip:
+            body, etag = compressed, f'{etag[:-1]}-gzip"'
+        if etag in parse_etags(request.META.get('HTTP_IF_NONE_MATCH', '')):
+            response = HttpResponseNotModified()
+        else:
+            response = HttpResponse(body, content_type='application/json')
+            if use_gzip:
+                response['Content-Encoding'] = 'gzip'
+        response['ETag'] = etag
+        patch_vary_headers(response, ('Accept-Encoding',))
+        return response
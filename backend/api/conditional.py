@@ -0,0 +1,32 @@
+import hashlib
+
+from django.utils.cache import get_conditional_response, patch_vary_headers
+from django.utils.http import http_date
+
+from .metrics import record_cache
+
+
+def make_etag(*parts):
+    return '"{}"'.format(hashlib.md5(
+        ':'.join(map(str, parts)).encode()).hexdigest())
+
+
+def conditional(request, etag, last_modified=None):
+    """Ответ 304, если копия клиента актуальна, иначе None."""
+    response = get_conditional_response(
+        request,
+        etag=etag,
+        last_modified=last_modified and int(last_modified.timestamp()),
+    )
+    if ('HTTP_IF_NONE_MATCH' in request.META
+            or 'HTTP_IF_MODIFIED_SINCE' in request.META):
+        record_cache('conditional', response is not None)
+    return response
+
+
+def set_validators(response, etag, last_modified=None):
+    response['ETag'] = etag
+    if last_modified is not None:
+        response['Last-Modified'] = http_date(last_modified.timestamp())
+    patch_vary_headers(response, ('Authorization',))
+    return response
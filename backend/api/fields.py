@@ -0,0 +1,111 @@
+import base64
+import binascii
+from collections import Counter
+from pathlib import PurePosixPath
+
+from django.core.files.uploadedfile import SimpleUploadedFile
+from drf_extra_fields.fields import Base64ImageField
+from rest_framework.serializers import (Field, FileField, IntegerField,
+                                        ListField, ValidationError)
+
+from recipes.images import (content_hash, find_stored, image_extension,
+                            variant_urls)
+
+DUPLICATES_ERROR = 'Каждый {name} может быть упомянут только один раз: {ids}'
+MISSING_ERROR = 'Не найдены {name} с id: {ids}'
+
+
+def find_duplicates(ids):
+    return [pk for pk, count in Counter(ids).items() if count > 1]
+
+
+def resolve_ids(queryset, ids, name):
+    """Загружает объекты одним запросом id__in, сохраняя порядок ids.
+
+    Повторы и несуществующие id собираются и отклоняются все сразу.
+    """
+    duplicates = find_duplicates(ids)
+    if duplicates:
+        raise ValidationError(DUPLICATES_ERROR.format(
+            name=name, ids=', '.join(map(str, duplicates))))
+    objects = queryset.in_bulk(ids)
+    missing = [pk for pk in ids if pk not in objects]
+    if missing:
+        raise ValidationError(MISSING_ERROR.format(
+            name=name, ids=', '.join(map(str, missing))))
+    return [objects[pk] for pk in ids]
+
+
+class BulkPrimaryKeyRelatedField(ListField):
+    """Список первичных ключей, проверяемый одним запросом к БД."""
+
+    child = IntegerField(min_value=1)
+
+    def __init__(self, queryset, name='объект', **kwargs):
+        self.queryset = queryset
+        self.name = name
+        super().__init__(**kwargs)
+
+    def to_internal_value(self, data):
+        return resolve_ids(
+            self.queryset.all(), super().to_internal_value(data), self.name)
+
+    def to_representation(self, value):
+        if hasattr(value, 'all'):
+            value = value.all()
+        return [obj.pk for obj in value]
+
+
+class HashedBase64ImageField(Base64ImageField):
+    """Картинка в base64, сохраняемая под хэшем содержимого.
+
+    Если такая картинка уже есть у рецепта или в хранилище, она не
+    записывается повторно. Тип определяется по сигнатуре файла: Pillow
+    открывает картинку только в фоне, при создании вариантов.
+    """
+
+    def to_internal_value(self, base64_data):
+        if base64_data in self.EMPTY_VALUES:
+            return None
+        if not isinstance(base64_data, str):
+            raise ValidationError(self.INVALID_FILE_MESSAGE)
+        try:
+            decoded_file = base64.b64decode(
+                base64_data.split(';base64,')[-1])
+        except (TypeError, binascii.Error, ValueError):
+            raise ValidationError(self.INVALID_FILE_MESSAGE)
+        digest = content_hash(decoded_file)
+        current = getattr(
+            getattr(self.parent, 'instance', None), 'image', None)
+        if current and PurePosixPath(current.name).stem == digest:
+            return current.name
+        stored = find_stored(digest)
+        if stored is not None:
+            return stored
+        extension = image_extension(decoded_file)
+        if extension not in self.ALLOWED_TYPES:
+            raise ValidationError(self.INVALID_TYPE_MESSAGE)
+        return FileField.to_internal_value(self, SimpleUploadedFile(
+            name=f'{digest}.{extension}', content=decoded_file))
+
+
+class ImageVariantsField(Field):
+    """Ссылки на уменьшенные WebP-варианты картинки рецепта.
+
+    Готовность вариантов берется из рецепта, хранилище не опрашивается.
+    """
+
+    def __init__(self, **kwargs):
+        kwargs['read_only'] = True
+        kwargs.setdefault('source', '*')
+        super().__init__(**kwargs)
+
+    def to_representation(self, recipe):
+        if not recipe.image:
+            return None
+        urls = variant_urls(recipe.image.name, recipe.image_variants_ready)
+        request = self.context.get('request')
+        if request is None:
+            return urls
+        return {variant: request.build_absolute_uri(url)
+                for variant, url in urls.items()}
@@ -1,9 +1,17 @@
+from django.db.models import Case, Exists, IntegerField, OuterRef, Value, When
 from django_filters import rest_framework as filters
 
-from recipes.models import Ingredients, Recipes, Tag
+from recipes.matching import MATCH_LIMIT, recipe_matcher
+from recipes.models import Cart, Favorites, Recipes, RecipeTag, Tag
+
+TAGS_MODE_ANY = 'any'
+TAGS_MODE_ALL = 'all'
+ORDERING_POPULAR = 'popular'
 
 
 class RecipeFilterSet(filters.FilterSet):
+    """Фильтры по связям - подзапросы EXISTS: без JOIN и DISTINCT."""
+
     is_favorited = filters.BooleanFilter(method='filter_is_favorited')
     is_in_shopping_cart = filters.BooleanFilter(
         method='filter_is_in_shopping_cart'
@@ -11,36 +19,98 @@ class RecipeFilterSet(filters.FilterSet):
     tags = filters.ModelMultipleChoiceFilter(
         method='filter_tags', queryset=Tag.objects.all(), to_field_name='slug'
     )
+    tags_mode = filters.ChoiceFilter(
+        method='filter_tags_mode',
+        choices=((TAGS_MODE_ANY, 'любой из тегов'),
+                 (TAGS_MODE_ALL, 'все теги')),
+        empty_label=None,
+    )
+    search = filters.CharFilter(method='filter_search')
+    have = filters.BaseInFilter(method='filter_have')
+    missing = filters.NumberFilter(method='filter_missing', min_value=0)
+    ordering = filters.ChoiceFilter(
+        method='filter_ordering',
+        choices=((ORDERING_POPULAR, 'по популярности'),),
+    )
 
     class Meta:
         model = Recipes
         fields = (
-            'name', 'tags', 'author', 'is_favorited', 'is_in_shopping_cart'
+            'name', 'tags', 'tags_mode', 'author', 'is_favorited',
+            'is_in_shopping_cart', 'search', 'have', 'missing', 'ordering',
         )
 
+    def filter_by_user_relation(self, queryset, model, value):
+        if not value:
+            return queryset
+        user = self.request.user
+        if not user.is_authenticated:
+            return queryset.none()
+        return queryset.filter(Exists(model.objects.filter(
+            user=user, recipe=OuterRef('pk'))))
+
     def filter_is_favorited(self, queryset, field_name, value):
-        if value:
-            return queryset.filter(favorites__user=self.request.user)
-        return queryset
+        return self.filter_by_user_relation(queryset, Favorites, value)
 
     def filter_is_in_shopping_cart(self, queryset, field_name, value):
-        if value:
-            return queryset.filter(shopping_cart__user=self.request.user)
-        return queryset
+        return self.filter_by_user_relation(queryset, Cart, value)
+
+    def filter_tags(self, queryset, field_name, value):
+        if not value:
+            return queryset
+        recipe_tags = RecipeTag.objects.filter(recipe=OuterRef('pk'))
+        if self.form.cleaned_data.get('tags_mode') == TAGS_MODE_ALL:
+            for tag in value:
+                queryset = queryset.filter(
+                    Exists(recipe_tags.filter(tag=tag)))
+            return queryset
+        return queryset.filter(Exists(recipe_tags.filter(tag__in=value)))
 
     @staticmethod
-    def filter_tags(queryset, field_name, value):
-        if value:
-            return queryset.filter(tags__in=value).distinct()
+    def filter_tags_mode(queryset, field_name, value):
+        # Учитывается в filter_tags.
         return queryset
 
+    def filter_have(self, queryset, field_name, value):
+        """Рецепты из имеющихся ингредиентов: без недостающих или, с
+        missing=N, без не более N; сначала с большей долей покрытия."""
+        try:
+            ingredient_ids = [int(pk) for pk in value]
+        except (TypeError, ValueError):
+            return queryset.none()
+        missing = int(self.form.cleaned_data.get('missing') or 0)
+        matches = recipe_matcher.match(ingredient_ids, missing,
+                                       MATCH_LIMIT + 1)
+        # Предел усечения RecipeViewSet вернет в заголовке ответа.
+        self.request.matches_limit = (MATCH_LIMIT if len(matches)
+                                      > MATCH_LIMIT else None)
+        groups = {}
+        for recipe_id, covered, lacking in matches[:MATCH_LIMIT]:
+            groups.setdefault((covered, lacking), []).append(recipe_id)
+        if not groups:
+            return queryset.none()
+        return queryset.filter(
+            pk__in=[pk for group in groups.values() for pk in group]
+        ).annotate(have_rank=Case(
+            *(When(pk__in=group, then=Value(rank))
+              for rank, group in enumerate(groups.values())),
+            output_field=IntegerField(),
+        )).order_by('have_rank', '-pub_date', '-id')
 
-class IngredientsFilter(filters.FilterSet):
-    name = filters.CharFilter(
-        field_name='name',
-        lookup_expr='icontains',
-    )
+    @staticmethod
+    def filter_missing(queryset, field_name, value):
+        # Учитывается в filter_have.
+        return queryset
 
-    class Meta:
-        model = Ingredients
-        fields = ('name',)
+    @staticmethod
+    def filter_ordering(queryset, field_name, value):
+        """Порядок по оценке, пересчитываемой refresh_popularity."""
+        if value == ORDERING_POPULAR:
+            return queryset.order_by('-popularity', '-id')
+        return queryset
+
+    @staticmethod
+    def filter_search(queryset, field_name, value):
+        if value.strip():
+            return queryset.search(value.strip())
+        return queryset
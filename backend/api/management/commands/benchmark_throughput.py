@@ -0,0 +1,104 @@
+import statistics
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from django.core.management.base import BaseCommand, CommandError
+
+PATHS = (
+    '/api/recipes/',
+    '/api/recipes/?limit=6&tags=breakfast',
+    '/api/tags/',
+    '/api/ingredients/?name=сол',
+)
+CONCURRENCY = 32
+DURATION = 10
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+class Command(BaseCommand):
+    help = ('нагрузка на запущенные серверы по очереди и сравнение '
+            'пропускной способности, например: '
+            '--target wsgi=http://127.0.0.1:9000 '
+            '--target asgi=http://127.0.0.1:9001')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--target', action='append', required=True,
+                            help='имя=базовый URL, можно несколько')
+        parser.add_argument('--path', action='append',
+                            help='путь для запросов, можно несколько')
+        parser.add_argument('--concurrency', type=int, default=CONCURRENCY)
+        parser.add_argument('--duration', type=float, default=DURATION,
+                            help='секунд на один сервер')
+        parser.add_argument('--token', help='токен для авторизации')
+
+    def handle(self, *args, **options):
+        targets = []
+        for target in options['target']:
+            name, separator, url = target.partition('=')
+            if not separator or not url:
+                raise CommandError(f'ожидается имя=URL: {target}')
+            targets.append((name, url.rstrip('/')))
+        headers = {}
+        if options['token']:
+            headers['Authorization'] = f'Token {options["token"]}'
+        paths = options['path'] or PATHS
+        self.stdout.write(
+            f'{"сервер":<12}{"запросов":>10}{"ошибок":>8}{"зап/с":>10}'
+            f'{"p50, мс":>10}{"p95, мс":>10}')
+        for name, url in targets:
+            result = self.run(url, paths, headers, options['concurrency'],
+                              options['duration'])
+            self.stdout.write(
+                f'{name:<12}{result["requests"]:>10}{result["errors"]:>8}'
+                f'{result["rps"]:>10.1f}{result["p50"]:>10.1f}'
+                f'{result["p95"]:>10.1f}')
+
+    @staticmethod
+    def run(url, paths, headers, concurrency, duration):
+        """Каждый поток по кругу запрашивает пути до конца отведенного
+        времени; считаются только ответы 200."""
+        latencies = []
+        errors = 0
+        lock = threading.Lock()
+        deadline = time.perf_counter() + duration
+
+        def worker(offset):
+            nonlocal errors
+            session = requests.Session()
+            session.headers.update(headers)
+            local, failed, index = [], 0, offset
+            while time.perf_counter() < deadline:
+                started = time.perf_counter()
+                try:
+                    response = session.get(url + paths[index % len(paths)])
+                    ok = response.status_code == 200
+                except requests.RequestException:
+                    ok = False
+                if ok:
+                    local.append((time.perf_counter() - started) * 1000)
+                else:
+                    failed += 1
+                index += 1
+            with lock:
+                latencies.extend(local)
+                errors += failed
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            list(executor.map(worker, range(concurrency)))
+        elapsed = time.perf_counter() - started
+        return {
+            'requests': len(latencies),
+            'errors': errors,
+            'rps': len(latencies) / elapsed,
+            'p50': statistics.median(latencies) if latencies else 0,
+            'p95': percentile(latencies, 0.95),
+        }
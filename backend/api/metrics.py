@@ -0,0 +1,329 @@
+import asyncio
+import hmac
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from bisect import bisect_left
+from contextvars import ContextVar
+from pathlib import Path
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed, PermissionDenied
+from django.http import Http404, HttpResponse
+
+logger = logging.getLogger(__name__)
+
+PREFIX = 'foodgram'
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576)
+FLUSH_INTERVAL = 1.0
+# Файл воркера, не обновлявшийся LIVE_INTERVALS интервалов сброса, считается
+# файлом завершенного процесса; через RETENTION секунд он удаляется.
+LIVE_INTERVALS = 5
+RETENTION = 60 * 60
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+HELP = {
+    'requests_total': ('counter', 'Число запросов'),
+    'request_duration_seconds': ('histogram', 'Время ответа'),
+    'response_size_bytes': ('histogram', 'Размер ответа'),
+    'db_queries_total': ('counter', 'Число SQL-запросов'),
+    'cache_requests_total': ('counter', 'Обращения к кэшам'),
+    'requests_in_flight': ('gauge', 'Запросы в обработке'),
+}
+
+current_queries = ContextVar('current_queries', default=None)
+
+
+def metrics_enabled():
+    return getattr(settings, 'METRICS_ENABLED', False)
+
+
+def flush_interval():
+    return getattr(settings, 'METRICS_FLUSH_INTERVAL', FLUSH_INTERVAL)
+
+
+class Registry:
+    """Метрики процесса. Каждый воркер периодически пишет их в свой файл
+    в METRICS_DIR, эндпоинт складывает файлы всех воркеров."""
+
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+        self.in_flight = 0
+        self._flusher_pid = None
+        self._file_pid = None
+        self._file_name = None
+        self._lock = threading.Lock()
+
+    def inc(self, name, labels, value=1):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, labels, value, buckets):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = {
+                    'buckets': list(buckets),
+                    'counts': [0] * len(buckets), 'sum': 0, 'count': 0}
+            index = bisect_left(buckets, value)
+            if index < len(buckets):
+                histogram['counts'][index] += 1
+            histogram['sum'] += value
+            histogram['count'] += 1
+
+    def add_in_flight(self, delta):
+        with self._lock:
+            self.in_flight += delta
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'pid': os.getpid(),
+                'counters': [[name, labels, value] for (name, labels), value
+                             in self.counters.items()],
+                'histograms': [
+                    [name, labels, {**histogram,
+                                    'counts': list(histogram['counts'])}]
+                    for (name, labels), histogram in self.histograms.items()
+                ],
+                'in_flight': self.in_flight,
+            }
+
+    def file_name(self):
+        """Имя файла процесса; суффикс отличает процесс, получивший pid
+        завершенного воркера, чтобы не затереть его счетчики."""
+        pid = os.getpid()
+        if self._file_pid != pid:
+            self._file_pid = pid
+            self._file_name = f'{pid}-{uuid.uuid4().hex[:8]}.json'
+        return self._file_name
+
+    def flush(self):
+        directory = Path(settings.METRICS_DIR)
+        directory.mkdir(parents=True, exist_ok=True)
+        path = directory / self.file_name()
+        temporary = path.with_suffix('.tmp')
+        temporary.write_text(json.dumps(self.snapshot()))
+        os.replace(temporary, path)
+
+    def start_flusher(self):
+        """Фоновый поток процесса сбрасывает метрики в файл раз в
+        METRICS_FLUSH_INTERVAL, не задерживая ответы."""
+        if self._flusher_pid == os.getpid():
+            return
+        with self._lock:
+            if self._flusher_pid == os.getpid():
+                return
+            self._flusher_pid = os.getpid()
+        interval = flush_interval()
+
+        def run():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.flush()
+                except OSError:
+                    logger.exception('не удалось записать метрики')
+
+        threading.Thread(target=run, name='metrics-flush',
+                         daemon=True).start()
+
+    def reset(self):
+        with self._lock:
+            self.counters.clear()
+            self.histograms.clear()
+            self.in_flight = 0
+
+
+registry = Registry()
+
+
+def record_cache(cache_name, hit):
+    if metrics_enabled():
+        registry.inc('cache_requests_total',
+                     {'cache': cache_name, 'result': 'hit' if hit else 'miss'})
+
+
+def count_sql(execute, sql, params, many, context):
+    counter = current_queries.get()
+    if counter is not None:
+        counter[0] += 1
+    return execute(sql, params, many, context)
+
+
+def install_sql_counter(connection, **kwargs):
+    if count_sql not in connection.execute_wrappers:
+        connection.execute_wrappers.append(count_sql)
+
+
+def route_name(request):
+    match = getattr(request, 'resolver_match', None)
+    if match is None or not match.url_name:
+        return 'unmatched'
+    return match.url_name
+
+
+class MetricsMiddleware:
+    """Счетчики и гистограммы по маршрутам DRF (recipes-list и т.п.).
+
+    Поддерживает ASGI без перехода в поток, как и ProfilingMiddleware.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        if not metrics_enabled():
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        if asyncio.iscoroutinefunction(get_response):
+            self._is_coroutine = asyncio.coroutines._is_coroutine
+
+    def __call__(self, request):
+        if asyncio.iscoroutinefunction(self.get_response):
+            return self.__acall__(request)
+        queries, token, started = self.start()
+        try:
+            response = self.get_response(request)
+        finally:
+            self.stop(token)
+        return self.record(request, response, queries, started)
+
+    async def __acall__(self, request):
+        queries, token, started = self.start()
+        try:
+            response = await self.get_response(request)
+        finally:
+            self.stop(token)
+        return self.record(request, response, queries, started)
+
+    @staticmethod
+    def start():
+        registry.start_flusher()
+        registry.add_in_flight(1)
+        queries = [0]
+        return queries, current_queries.set(queries), time.perf_counter()
+
+    @staticmethod
+    def stop(token):
+        current_queries.reset(token)
+        registry.add_in_flight(-1)
+
+    @staticmethod
+    def record(request, response, queries, started):
+        duration = time.perf_counter() - started
+        route = route_name(request)
+        registry.inc('requests_total', {'route': route,
+                                        'method': request.method,
+                                        'status': str(response.status_code)})
+        registry.observe('request_duration_seconds', {'route': route},
+                         duration, LATENCY_BUCKETS)
+        if not response.streaming:
+            registry.observe('response_size_bytes', {'route': route},
+                             len(response.content), SIZE_BUCKETS)
+        registry.inc('db_queries_total', {'route': route}, queries[0])
+        return response
+
+
+def collect():
+    """Сумма метрик из файлов всех воркеров. Счетчики завершившихся
+    воркеров сохраняются METRICS_RETENTION секунд, их запросы в обработке
+    не учитываются."""
+    counters, histograms, in_flight = {}, {}, 0
+    now = time.time()
+    retention = getattr(settings, 'METRICS_RETENTION', RETENTION)
+    for path in Path(settings.METRICS_DIR).glob('*.json'):
+        try:
+            age = now - path.stat().st_mtime
+            if age > retention:
+                path.unlink()
+                continue
+            snapshot = json.loads(path.read_text())
+        except (OSError, ValueError):
+            continue
+        for name, labels, value in snapshot['counters']:
+            key = (name, tuple(map(tuple, labels)))
+            counters[key] = counters.get(key, 0) + value
+        for name, labels, histogram in snapshot['histograms']:
+            key = (name, tuple(map(tuple, labels)))
+            total = histograms.get(key)
+            if total is None:
+                histograms[key] = histogram
+                continue
+            total['counts'] = [left + right for left, right
+                               in zip(total['counts'], histogram['counts'])]
+            total['sum'] += histogram['sum']
+            total['count'] += histogram['count']
+        if age <= flush_interval() * LIVE_INTERVALS:
+            in_flight += snapshot['in_flight']
+    return counters, histograms, in_flight
+
+
+def format_labels(labels, **extra):
+    labels = (*labels, *extra.items())
+    if not labels:
+        return ''
+    return '{' + ','.join(
+        '{}="{}"'.format(name, str(value).replace('\\', '\\\\')
+                         .replace('"', '\\"'))
+        for name, value in labels) + '}'
+
+
+def render(counters, histograms, in_flight):
+    """Текстовый формат Prometheus 0.0.4."""
+    lines = []
+    by_name = {}
+    for (name, labels), value in counters.items():
+        by_name.setdefault(name, []).append((labels, value))
+    for (name, labels), histogram in histograms.items():
+        by_name.setdefault(name, []).append((labels, histogram))
+    by_name['requests_in_flight'] = [((), in_flight)]
+    for name in sorted(by_name):
+        metric_type, description = HELP[name]
+        full_name = f'{PREFIX}_{name}'
+        lines.append(f'# HELP {full_name} {description}')
+        lines.append(f'# TYPE {full_name} {metric_type}')
+        for labels, value in sorted(by_name[name], key=lambda item: item[0]):
+            if metric_type != 'histogram':
+                lines.append(f'{full_name}{format_labels(labels)} {value}')
+                continue
+            cumulative = 0
+            for bound, count in zip(value['buckets'], value['counts']):
+                cumulative += count
+                lines.append(f'{full_name}_bucket'
+                             f'{format_labels(labels, le=bound)} '
+                             f'{cumulative}')
+            lines.append(f'{full_name}_bucket'
+                         f'{format_labels(labels, le="+Inf")} '
+                         f'{value["count"]}')
+            lines.append(f'{full_name}_sum{format_labels(labels)} '
+                         f'{value["sum"]}')
+            lines.append(f'{full_name}_count{format_labels(labels)} '
+                         f'{value["count"]}')
+    return '\n'.join(lines) + '\n'
+
+
+def metrics_allowed(request):
+    """Доступ по заголовку Authorization: Bearer METRICS_TOKEN (так
+    авторизуется Prometheus) или сотрудникам, вошедшим в админку."""
+    token = getattr(settings, 'METRICS_TOKEN', '')
+    if token and hmac.compare_digest(
+            request.META.get('HTTP_AUTHORIZATION', ''), f'Bearer {token}'):
+        return True
+    return request.user.is_staff
+
+
+def metrics_view(request):
+    if not metrics_enabled():
+        raise Http404
+    if not metrics_allowed(request):
+        raise PermissionDenied
+    registry.flush()
+    return HttpResponse(render(*collect()), content_type=CONTENT_TYPE)
@@ -1,5 +1,23 @@
-from rest_framework.pagination import PageNumberPagination
+from rest_framework.pagination import CursorPagination, PageNumberPagination
+
+CURSOR_MODE_PARAM = 'paginate'
+CURSOR_MODE = 'cursor'
 
 
 class PageLimitPagination(PageNumberPagination):
     page_size_query_param = "limit"
+
+
+class RecipeCursorPagination(CursorPagination):
+    """Keyset-пагинация ленты рецептов без COUNT(*) и OFFSET."""
+
+    page_size_query_param = "limit"
+    ordering = ('-pub_date', '-id')
+
+    @staticmethod
+    def is_requested(request):
+        return (
+            request.query_params.get(CURSOR_MODE_PARAM) == CURSOR_MODE
+            or RecipeCursorPagination.cursor_query_param
+            in request.query_params
+        )
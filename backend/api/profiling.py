@@ -0,0 +1,153 @@
+import asyncio
+import json
+import logging
+import random
+import re
+import time
+from collections import Counter
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from rest_framework.renderers import JSONRenderer
+
+logger = logging.getLogger(__name__)
+
+DUPLICATE_THRESHOLD = 3
+SQL_LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+\b")
+SQL_LISTS = re.compile(r'\((?:\s*\?\s*,)+\s*\?\s*\)')
+
+current_profile = ContextVar('current_profile', default=None)
+
+
+def normalize_sql(sql):
+    """SQL без значений: литералы и списки IN (...) заменяются на ?."""
+    sql = SQL_LITERALS.sub('?', sql.replace('%s', '?'))
+    return ' '.join(SQL_LISTS.sub('(...)', sql).split())
+
+
+class RequestProfile:
+    """Замеры одного запроса: SQL, рендеринг и остальное время (view и
+    сериализация) - app."""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.queries = Counter()
+        self.query_count = 0
+        self.sql_time = 0.0
+        self.render_time = 0.0
+
+    def duplicates(self, threshold):
+        return [{'sql': sql, 'count': count}
+                for sql, count in self.queries.most_common()
+                if count >= threshold]
+
+    def timings(self):
+        total = time.perf_counter() - self.started
+        return {
+            'db': self.sql_time * 1000,
+            'app': max(total - self.sql_time - self.render_time, 0) * 1000,
+            'render': self.render_time * 1000,
+            'total': total * 1000,
+        }
+
+
+def record_sql(execute, sql, params, many, context):
+    """Обертка execute_wrapper, которая ставится на каждое соединение;
+    вне профилируемого запроса ничего не делает."""
+    profile = current_profile.get()
+    if profile is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        profile.sql_time += time.perf_counter() - started
+        profile.query_count += 1
+        profile.queries[normalize_sql(sql)] += 1
+
+
+def install_sql_wrapper(connection, **kwargs):
+    if record_sql not in connection.execute_wrappers:
+        connection.execute_wrappers.append(record_sql)
+
+
+class ProfilingJSONRenderer(JSONRenderer):
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        profile = current_profile.get()
+        if profile is None:
+            return super().render(data, accepted_media_type,
+                                  renderer_context)
+        started = time.perf_counter()
+        try:
+            return super().render(data, accepted_media_type,
+                                  renderer_context)
+        finally:
+            profile.render_time += time.perf_counter() - started
+
+
+class ProfilingMiddleware:
+    """Профилирует долю PROFILING_SAMPLE_RATE запросов: заголовок
+    Server-Timing и строка JSON в лог api.profiling. Запросы, повторенные
+    не меньше PROFILING_DUPLICATE_THRESHOLD раз, попадают в duplicates.
+
+    Поддерживает ASGI без перехода в поток: под uvicorn синхронный
+    middleware выполнял бы все запросы в одном потоке.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.sample_rate = getattr(settings, 'PROFILING_SAMPLE_RATE', 0)
+        if self.sample_rate <= 0:
+            raise MiddlewareNotUsed
+        self.threshold = getattr(settings, 'PROFILING_DUPLICATE_THRESHOLD',
+                                 DUPLICATE_THRESHOLD)
+        self.get_response = get_response
+        if asyncio.iscoroutinefunction(get_response):
+            # Так же помечает себя MiddlewareMixin в Django 3.2.
+            self._is_coroutine = asyncio.coroutines._is_coroutine
+
+    def __call__(self, request):
+        if asyncio.iscoroutinefunction(self.get_response):
+            return self.__acall__(request)
+        if random.random() >= self.sample_rate:
+            return self.get_response(request)
+        profile = RequestProfile()
+        token = current_profile.set(profile)
+        try:
+            response = self.get_response(request)
+        finally:
+            current_profile.reset(token)
+        return self.report(request, response, profile)
+
+    async def __acall__(self, request):
+        if random.random() >= self.sample_rate:
+            return await self.get_response(request)
+        profile = RequestProfile()
+        token = current_profile.set(profile)
+        try:
+            response = await self.get_response(request)
+        finally:
+            current_profile.reset(token)
+        return self.report(request, response, profile)
+
+    def report(self, request, response, profile):
+        timings = profile.timings()
+        response['Server-Timing'] = ', '.join(
+            f'{name};dur={duration:.1f}'
+            + (f';desc="{profile.query_count} queries"'
+               if name == 'db' else '')
+            for name, duration in timings.items())
+        logger.info(json.dumps({
+            'method': request.method,
+            'path': request.path,
+            'status': response.status_code,
+            'queries': profile.query_count,
+            **{f'{name}_ms': round(duration, 2)
+               for name, duration in timings.items()},
+            'duplicates': profile.duplicates(self.threshold),
+        }, ensure_ascii=False))
+        return response
@@ -1,26 +1,36 @@
 from django.contrib.auth import get_user_model
 # from django.shortcuts import get_object_or_404
 from django.core.exceptions import ValidationError
-from drf_extra_fields.fields import Base64ImageField
+from django.db import transaction
 from rest_framework.serializers import (CharField, IntegerField,
-                                        ModelSerializer,
+                                        ListSerializer, ModelSerializer,
                                         PrimaryKeyRelatedField,
                                         SerializerMethodField,
                                         ReadOnlyField)
+from rest_framework.serializers import ValidationError as DRFValidationError
 
-from recipes.models import (Cart, Favorites, Ingredients, RecipeIngridient,
-                            Recipes, Tag)
+from recipes.images import schedule_variants
+from recipes.matching import recipes_changed
+from recipes.similarity import schedule_similar
+from recipes.models import (Cart, CartIngredientTotal, Favorites, Ingredients,
+                            RecipeIngridient, Recipes, Tag, TimelineEntry)
 from users.models import Follow
+from .fields import (BulkPrimaryKeyRelatedField, HashedBase64ImageField,
+                     ImageVariantsField, resolve_ids)
 
 
 User = get_user_model()
 
+DEFAULT_RECIPES_LIMIT = 10
+MAX_RECIPES_LIMIT = 50
+
 
 class ShortRecipeSerializer(ModelSerializer):
+    image_variants = ImageVariantsField()
 
     class Meta:
         model = Recipes
-        fields = "id", "name", "image", "cooking_time"
+        fields = "id", "name", "image", "image_variants", "cooking_time"
         read_only_fields = ("__all__",)
 
 
@@ -36,15 +46,18 @@ class UserSerializer(ModelSerializer):
             "first_name",
             "last_name",
             "is_subscribed",
+            "followers_count",
             "password",
         )
         extra_kwargs = {"password": {"write_only": True}}
-        read_only_fields = ("is_subscribed",)
+        read_only_fields = ("is_subscribed", "followers_count")
 
     def get_is_subscribed(self, obj):
         user = self.context.get("request").user
         if user.is_anonymous or (user == obj):
             return False
+        if hasattr(obj, 'is_subscribed'):
+            return obj.is_subscribed
         return user.follower.filter(following=obj).exists()
 
     def create(self, validated_data):
@@ -59,6 +72,21 @@ class UserSerializer(ModelSerializer):
         return user
 
 
+def get_recipes_limit(request):
+    """recipes_limit из запроса: целое не меньше нуля, не больше
+    MAX_RECIPES_LIMIT."""
+    value = request.query_params.get('recipes_limit', DEFAULT_RECIPES_LIMIT)
+    try:
+        value = int(value)
+    except (TypeError, ValueError):
+        raise DRFValidationError(
+            {'recipes_limit': 'Должно быть целым числом'})
+    if value < 0:
+        raise DRFValidationError(
+            {'recipes_limit': 'Должно быть не меньше нуля'})
+    return min(value, MAX_RECIPES_LIMIT)
+
+
 class ShowFollowSerializer(ModelSerializer):
     email = CharField(
         source='following.email',
@@ -78,9 +106,7 @@ class ShowFollowSerializer(ModelSerializer):
     recipes = SerializerMethodField()
     is_subscribed = SerializerMethodField()
     recipes_count = ReadOnlyField(
-        source='following.recipes.count')
-    is_subscribed = SerializerMethodField()
-    recipes = SerializerMethodField()
+        source='following.recipes_count')
 
     class Meta:
         model = Follow
@@ -91,24 +117,17 @@ class ShowFollowSerializer(ModelSerializer):
         read_only_fields = fields
 
     def get_is_subscribed(self, obj):
-        if Follow.objects.filter(
-            user=self.context.get('request').user,
-            following=obj.following
-        ):
-            return True
-        return False
+        return obj.user_id == self.context.get('request').user.id
 
     def get_recipes(self, obj):
-        recipes_limit = int(self.context['request'].GET.get(
-            'recipes_limit', 10))
-        recipes = obj.following.recipes.all()[:recipes_limit]
-
+        recipes_by_author = self.context.get('recipes_by_author')
+        if recipes_by_author is not None:
+            recipes = recipes_by_author.get(obj.following_id, [])
+        else:
+            recipes = obj.following.recipes.all()[
+                :get_recipes_limit(self.context['request'])]
         return ShortRecipeSerializer(recipes, many=True).data
 
-    # def get_recipes_count(self, obj):
-    #     user = get_object_or_404(User, pk=obj.pk)
-    #     return Recipes.objects.filter(author=user).count()
-
 
 class TagSerializer(ModelSerializer):
 
@@ -147,47 +166,73 @@ class ShowRecipeFullSerializer(ModelSerializer):
     ingredients = SerializerMethodField()
     is_favorited = SerializerMethodField()
     is_in_shopping_cart = SerializerMethodField()
+    image_variants = ImageVariantsField()
 
     class Meta:
         model = Recipes
         fields = (
             'id', 'tags', 'author', 'ingredients',
             'is_favorited', 'is_in_shopping_cart',
-            'name', 'image', 'text', 'cooking_time',
+            'name', 'image', 'image_variants', 'text', 'cooking_time',
+            'favorites_count',
         )
 
+    def to_representation(self, obj):
+        if hasattr(obj, 'author_is_subscribed'):
+            obj.author.is_subscribed = obj.author_is_subscribed
+        return super().to_representation(obj)
+
     def get_ingredients(self, obj):
-        ingredients = RecipeIngridient.objects.filter(recipe=obj)
+        ingredients = obj.recipeingridient_set.all()
         return ShowRecipeIngredientsSerializer(ingredients, many=True).data
 
     def get_is_favorited(self, obj):
         request = self.context.get('request')
         if not request or request.user.is_anonymous:
             return False
+        if hasattr(obj, 'is_favorited'):
+            return obj.is_favorited
         return Favorites.objects.filter(recipe=obj, user=request.user).exists()
 
     def get_is_in_shopping_cart(self, obj):
         request = self.context.get('request')
         if not request or request.user.is_anonymous:
             return False
+        if hasattr(obj, 'is_in_shopping_cart'):
+            return obj.is_in_shopping_cart
         return Cart.objects.filter(recipe=obj,
                                    user=request.user).exists()
 
 
+class AddRecipeIngredientsListSerializer(ListSerializer):
+
+    def to_internal_value(self, data):
+        ingredients = super().to_internal_value(data)
+        resolved = resolve_ids(
+            Ingredients.objects.all(),
+            [ingredient['id'] for ingredient in ingredients],
+            'ингредиент',
+        )
+        for ingredient, instance in zip(ingredients, resolved):
+            ingredient['id'] = instance
+        return ingredients
+
+
 class AddRecipeIngredientsSerializer(ModelSerializer):
-    id = PrimaryKeyRelatedField(queryset=Ingredients.objects.all())
+    id = IntegerField(min_value=1)
 
     class Meta:
         model = RecipeIngridient
         fields = ('id', 'amount')
+        list_serializer_class = AddRecipeIngredientsListSerializer
 
 
 class AddRecipeSerializer(ModelSerializer):
-    image = Base64ImageField()
+    image = HashedBase64ImageField()
     author = UserSerializer(read_only=True)
     ingredients = AddRecipeIngredientsSerializer(many=True)
-    tags = PrimaryKeyRelatedField(
-        queryset=Tag.objects.all(), many=True
+    tags = BulkPrimaryKeyRelatedField(
+        queryset=Tag.objects.all(), name='тег'
     )
     cooking_time = IntegerField()
 
@@ -196,68 +241,91 @@ class AddRecipeSerializer(ModelSerializer):
         fields = ('id', 'tags', 'author', 'ingredients',
                   'name', 'image', 'text', 'cooking_time')
 
-    def validate_ingridients(self, value):
-        ingredients_set = []
-        for ingredient in value:
-            if ingredient['id'] in ingredients_set:
-                raise ValidationError(
-                    'Каждый ингредиент может быть упомянут только один раз'
-                )
-            elif ingredient['amount'] < 1:
-                raise ValidationError(
-                    'Количество ингредиентов должно быть'
-                    ' положительным числом'
-                )
-            else:
-                ingredients_set.append(ingredient)
-        return value
-
-    def validate_tags(self, value):
-        if len(value) != len(set(value)):
-            raise ValidationError(
-                'Каждый тег может быть упомянут только один раз'
-            )
-        return value
-
     def validate_cooking_time(self, value):
         if value <= 0:
             raise ValidationError('Время готовки должно быть положительным'
                                   ' числом, не менее 1 минуты!')
         return value
 
-    def add_recipe_ingredients(self, ingredients, recipe):
-        for ingredient in ingredients:
-            ingredient_id = ingredient['id']
-            amount = ingredient['amount']
-            if RecipeIngridient.objects.filter(
-                    recipe=recipe,
-                    ingredient=ingredient_id,
-            ).exists():
-                amount += ingredient['amount']
-            RecipeIngridient.objects.update_or_create(
-                recipe=recipe,
-                ingredient=ingredient_id,
-                defaults={'amount': amount},
-            )
+    @staticmethod
+    def ingredient_amounts(ingredients):
+        return {ingredient['id'].pk: ingredient['amount']
+                for ingredient in ingredients}
+
+    @staticmethod
+    def add_recipe_ingredients(amounts, recipe):
+        RecipeIngridient.objects.bulk_create(
+            RecipeIngridient(recipe=recipe,
+                             ingredient_id=ingredient_id,
+                             amount=amount)
+            for ingredient_id, amount in amounts.items()
+        )
+
+    def update_recipe_ingredients(self, amounts, recipe):
+        """Меняет только отличающиеся строки, возвращает старые кол-ва."""
+        existing = list(recipe.recipeingridient_set.all())
+        old_amounts = {row.ingredient_id: row.amount for row in existing
+                       if row.ingredient_id is not None}
+        removed = [row.pk for row in existing
+                   if row.ingredient_id not in amounts]
+        changed = []
+        for row in existing:
+            amount = amounts.get(row.ingredient_id)
+            if amount is not None and amount != row.amount:
+                row.amount = amount
+                changed.append(row)
+        if removed:
+            RecipeIngridient.objects.filter(pk__in=removed).delete()
+        RecipeIngridient.objects.bulk_update(changed, ['amount'])
+        self.add_recipe_ingredients(
+            {ingredient_id: amount
+             for ingredient_id, amount in amounts.items()
+             if ingredient_id not in old_amounts},
+            recipe,
+        )
+        return old_amounts
 
     def create(self, validated_data):
         author = self.context.get('request').user
         tags_data = validated_data.pop('tags')
-        ingredients_data = validated_data.pop('ingredients')
-        recipe = Recipes.objects.create(author=author, **validated_data)
-        self.add_recipe_ingredients(ingredients_data, recipe)
-        recipe.tags.set(tags_data)
+        amounts = self.ingredient_amounts(validated_data.pop('ingredients'))
+        with transaction.atomic():
+            recipe = Recipes.objects.create(author=author, **validated_data)
+            User.objects.filter(pk=author.pk).increment(
+                recipes_count=1)
+            self.add_recipe_ingredients(amounts, recipe)
+            recipe.tags.set(tags_data)
+            if TimelineEntry.objects.enabled():
+                TimelineEntry.objects.fan_out(recipe)
+            schedule_variants(recipe.image.name)
+            schedule_similar(recipe.pk)
+            recipes_changed([recipe.pk])
         return recipe
 
     def update(self, recipe, validated_data):
-        if 'ingredients' in validated_data:
-            ingredients = validated_data.pop('ingredients')
-            recipe.ingredients.clear()
-            self.add_recipe_ingredients(ingredients, recipe)
-        if 'tags' in validated_data:
-            tags_data = validated_data.pop('tags')
-            recipe.tags.set(tags_data)
-        return super().update(recipe, validated_data)
+        with transaction.atomic():
+            features_changed = 'tags' in validated_data
+            if 'ingredients' in validated_data:
+                amounts = self.ingredient_amounts(
+                    validated_data.pop('ingredients'))
+                old_amounts = self.update_recipe_ingredients(amounts, recipe)
+                CartIngredientTotal.objects.change_recipe(
+                    recipe, old_amounts, amounts)
+                if old_amounts.keys() != amounts.keys():
+                    features_changed = True
+                    recipes_changed([recipe.pk])
+            if 'tags' in validated_data:
+                tags_data = validated_data.pop('tags')
+                recipe.tags.set(tags_data)
+            if validated_data.get('image', recipe.image.name) != (
+                    recipe.image.name):
+                recipe.image_variants_ready = False
+            recipe = super().update(recipe, validated_data)
+            if 'image' in validated_data:
+                schedule_variants(recipe.image.name)
+            if features_changed:
+                schedule_similar(recipe.pk)
+            return recipe
 
     def to_representation(self, recipe):
         return ShortRecipeSerializer(
@@ -0,0 +1,157 @@
+import csv
+import json
+
+import numpy as np
+from rest_framework.negotiation import DefaultContentNegotiation
+
+from recipes.models import CartIngredientTotal
+
+FORMAT_PARAM = 'format'
+DEFAULT_FORMAT = 'txt'
+ITERATOR_CHUNK_SIZE = 2000
+FILENAME = 'buylist'
+
+# Единица: (величина, сколько базовых единиц величины в ней).
+UNITS = {
+    'г': ('масса', 1),
+    'кг': ('масса', 1000),
+    'мл': ('объем', 1),
+    'л': ('объем', 1000),
+    'ч. л.': ('ложки', 1),
+    'ст. л.': ('ложки', 3),
+}
+# Крупная единица выбирается, если в ней не больше двух знаков дроби.
+DISPLAY_PRECISION = 100
+
+
+class ShoppingListNegotiation(DefaultContentNegotiation):
+    """Параметр format выбирает формат файла, а не рендерер DRF."""
+
+    def select_renderer(self, request, renderers, format_suffix=None):
+        return renderers[0], renderers[0].media_type
+
+
+class EchoBuffer:
+    """Буфер для csv.writer, который сразу отдает записанную строку."""
+
+    def write(self, value):
+        return value
+
+
+def unit_key(unit):
+    """'ч.л.' и 'ч. л.' - одна единица."""
+    return ' '.join(unit.replace('.', '. ').split())
+
+
+def display_units(totals, dimensions):
+    """Для каждой строки - самая крупная единица ее величины, в которой
+    количество не меньше 1 и не дробнее DISPLAY_PRECISION."""
+    units = dimensions.copy()
+    factors = np.ones(len(totals))
+    for unit, (dimension, factor) in sorted(
+            UNITS.items(), key=lambda item: item[1][1]):
+        values = totals / factor * DISPLAY_PRECISION
+        better = ((dimensions == dimension) & (values >= DISPLAY_PRECISION)
+                  & np.isclose(values, np.round(values)))
+        units[better] = unit
+        factors[better] = factor
+    return units, factors
+
+
+def normalize_units(items):
+    """Сводит строки одного продукта в совместимых единицах (500 г и 1 кг
+    муки - 1.5 кг) одним векторным проходом, порядок строк сохраняется."""
+    names, units, amounts = [], [], []
+    for item in items:
+        names.append(item['ingredient__name'])
+        units.append(unit_key(item['ingredient__measurement_unit']))
+        amounts.append(item['amount'])
+    if not names:
+        return []
+    unit_values, unit_positions = np.unique(np.array(units, dtype=object),
+                                            return_inverse=True)
+    conversions = [UNITS.get(unit, (unit, 1)) for unit in unit_values]
+    dimension_values = np.array([dimension for dimension, _ in conversions],
+                                dtype=object)
+    base = np.asarray(amounts, dtype=np.float64) * np.array(
+        [factor for _, factor in conversions])[unit_positions]
+    _, name_positions = np.unique(np.array(names, dtype=object),
+                                  return_inverse=True)
+    keys = name_positions * len(unit_values) + np.unique(
+        dimension_values, return_inverse=True)[1][unit_positions]
+    _, first, groups = np.unique(keys, return_index=True,
+                                 return_inverse=True)
+    totals = np.bincount(groups, weights=base)
+    order = np.argsort(first, kind='stable')
+    first, totals = first[order], totals[order]
+    units, factors = display_units(
+        totals, dimension_values[unit_positions[first]])
+    return [{
+        'ingredient__name': names[line],
+        'ingredient__measurement_unit': unit,
+        'amount': int(amount) if amount.is_integer() else round(amount, 2),
+    } for line, unit, amount in zip(first.tolist(), units.tolist(),
+                                    (totals / factors).tolist())]
+
+
+def normalized_chunks(items, chunk_size=ITERATOR_CHUNK_SIZE):
+    """normalize_units по кускам не меньше chunk_size строк. Строки идут
+    по названию, поэтому кусок режется только на смене названия, и все
+    строки продукта сводятся вместе, а память не растет с корзиной."""
+    chunk = []
+    for item in items:
+        if (len(chunk) >= chunk_size and item['ingredient__name']
+                != chunk[-1]['ingredient__name']):
+            yield from normalize_units(chunk)
+            chunk = []
+        chunk.append(item)
+    yield from normalize_units(chunk)
+
+
+def shopping_list_items(user):
+    """Итоги корзины, читаемые курсором на стороне БД и сведенные по
+    единицам измерения."""
+    return normalized_chunks(CartIngredientTotal.objects.filter(
+        user=user).values(
+            'ingredient__name',
+            'ingredient__measurement_unit',
+            'amount',
+    ).order_by(
+        'ingredient__name', 'ingredient__measurement_unit'
+    ).iterator(chunk_size=ITERATOR_CHUNK_SIZE))
+
+
+def render_txt(items):
+    for item in items:
+        yield (f'{item["ingredient__name"]}'
+               f' - {item["amount"]} '
+               f'{item["ingredient__measurement_unit"]}\n')
+
+
+def render_csv(items):
+    writer = csv.writer(EchoBuffer())
+    yield writer.writerow(('name', 'amount', 'measurement_unit'))
+    for item in items:
+        yield writer.writerow((item['ingredient__name'],
+                               item['amount'],
+                               item['ingredient__measurement_unit']))
+
+
+def render_json(items):
+    yield '['
+    separator = ''
+    for item in items:
+        yield separator + json.dumps({
+            'name': item['ingredient__name'],
+            'amount': item['amount'],
+            'measurement_unit': item['ingredient__measurement_unit'],
+        }, ensure_ascii=False)
+        separator = ','
+    yield ']'
+
+
+RENDERERS = {
+    'txt': (render_txt, 'text/plain; charset=utf-8'),
+    'csv': (render_csv, 'text/csv; charset=utf-8'),
+    'json': (render_json, 'application/json'),
+}
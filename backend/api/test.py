@@ -1,15 +1,48 @@
+import asyncio
+import base64
 from http import HTTPStatus
+import json
+import os
 import shutil
 import tempfile
+import types
+from datetime import timedelta
+from io import StringIO
+from pathlib import Path
+from unittest import mock
 
+import numpy as np
+from asgiref.sync import async_to_sync
 from django.conf import settings
+from django.contrib.auth.models import Permission
+from django.core.cache import cache
 from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import connection
+from django.http import HttpResponse
 from django.test import override_settings
-from rest_framework.test import APIClient, APITestCase
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.authtoken.models import Token
+from rest_framework.test import APIClient, APIRequestFactory, APITestCase
 
 
-from recipes.models import Cart, Favorites, Tag, Recipes, Ingredients
-from users.models import User
+from api.metrics import MetricsMiddleware, registry
+from api.profiling import ProfilingMiddleware, normalize_sql
+from api.shopping_list import normalize_units, normalized_chunks
+from api.views import RecipeViewSet
+from recipes.counters import reconcile_counters
+from recipes.images import recipe_image_storage
+from recipes.matching import MATCH_TRUNCATED_HEADER, recipe_matcher
+from recipes.popularity import refresh_popularity
+from recipes.similarity import (FeatureMatrix, rebuild_similar,
+                                update_similar)
+from recipes.versions import bump_catalog_version, catalog_version
+from recipes.models import (Cart, CartIngredientTotal, Favorites, Tag,
+                            Recipes, RecipeIngridient, Ingredients)
+from users.authentication import token_cache
+from users.models import Follow, User
+from users.views import UserViewSet
 
 URLS = ['tags', 'recipes',
         'users', 'ingredients']
@@ -32,7 +65,7 @@ UPLOADED = SimpleUploadedFile(
 PATH_TO_PICTURE = 'recipes/my.gif'
 
 
-@override_settings(MEDIA_ROOT=TEMP_MEDIA_ROOT)
+@override_settings(MEDIA_ROOT=TEMP_MEDIA_ROOT, SIMILAR_RECIPES_ASYNC=False)
 class RecipeApiTest(APITestCase):
     @classmethod
     def setUpClass(cls):
@@ -80,6 +113,8 @@ class RecipeApiTest(APITestCase):
                                                 recipe=cls.recipe)
         cls.favorite = Favorites.objects.create(user=cls.user,
                                                 recipe=cls.recipe)
+        CartIngredientTotal.objects.rebuild()
+        reconcile_counters()
         # cls.follow = Follow.objects.create(following=cls.user,
         #                                    user=cls.user_1)
 
@@ -89,6 +124,7 @@ class RecipeApiTest(APITestCase):
         shutil.rmtree(TEMP_MEDIA_ROOT, ignore_errors=True)
 
     def setUp(self):
+        cache.clear()
         self.client = APIClient()
         self.client.force_authenticate(user=self.user)
         self.client_1 = APIClient()
@@ -212,3 +248,791 @@ class RecipeApiTest(APITestCase):
         self.assertEqual(delete_response.status_code, HTTPStatus.NO_CONTENT)
         self.assertFalse(Favorites.objects.filter(
             user=self.user, recipe=self.recipe).exists())
+
+    def test_recipe_list_queries_do_not_depend_on_page_size(self):
+        for index in range(10):
+            recipe = Recipes.objects.create(text='recipe',
+                                            author=self.user_1,
+                                            cooking_time=index + 1,
+                                            name=f'recipe_{index}',
+                                            image=UPLOADED)
+            recipe.ingredients.add(self.ingredient,
+                                   through_defaults={'amount': index + 1})
+            recipe.tags.add(self.tag, self.tag_1)
+        query_counts = []
+        for limit in (2, 12):
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get(f'/api/recipes/?limit={limit}')
+            self.assertEqual(response.status_code, HTTPStatus.OK)
+            self.assertEqual(len(response.data['results']), limit)
+            query_counts.append(len(queries))
+        self.assertEqual(query_counts[0], query_counts[1])
+
+    def test_recipe_cursor_pagination(self):
+        for index in range(5):
+            Recipes.objects.create(text='recipe',
+                                   author=self.user_1,
+                                   cooking_time=1,
+                                   name=f'recipe_{index}',
+                                   image=UPLOADED)
+        expected = list(Recipes.objects.order_by(
+            '-pub_date', '-id').values_list('id', flat=True))
+        url = '/api/recipes/?paginate=cursor&limit=3'
+        received = []
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, HTTPStatus.OK)
+            self.assertNotIn('count', response.data)
+            received += [recipe['id'] for recipe in response.data['results']]
+            url = response.data['next']
+        self.assertEqual(received, expected)
+
+    def test_download_shopping_cart_formats(self):
+        url = '/api/recipes/download_shopping_cart/'
+        for file_format, content_type in (('txt', 'text/plain'),
+                                          ('csv', 'text/csv'),
+                                          ('json', 'application/json')):
+            with self.subTest(file_format=file_format):
+                response = self.client.get(f'{url}?format={file_format}')
+                self.assertEqual(response.status_code, HTTPStatus.OK)
+                self.assertTrue(response.streaming)
+                self.assertTrue(
+                    response['Content-Type'].startswith(content_type))
+                self.assertIn(f'buylist.{file_format}',
+                              response['Content-Disposition'])
+        body = b''.join(self.client.get(
+            f'{url}?format=json').streaming_content)
+        self.assertEqual(json.loads(body), [{'name': '',
+                                             'amount': 3,
+                                             'measurement_unit': ''}])
+        self.assertEqual(self.client.get(f'{url}?format=pdf').status_code,
+                         HTTPStatus.BAD_REQUEST)
+
+    def test_cart_totals_follow_cart_changes(self):
+        totals = CartIngredientTotal.objects.filter(user=self.user)
+        self.assertEqual(list(totals.values_list('amount', flat=True)), [3])
+        self.recipe_1.ingredients.add(self.ingredient,
+                                      through_defaults={'amount': 4})
+        self.client.post(f'/api/recipes/{self.recipe_1.id}/shopping_cart/')
+        self.assertEqual(list(totals.values_list('amount', flat=True)), [7])
+        data = {"ingredients": [{"id": self.ingredient.id, "amount": 10}]}
+        response = self.client_1.patch(
+            f'/api/recipes/{self.recipe_1.id}/', data, format='json')
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+        self.assertEqual(list(totals.values_list('amount', flat=True)), [13])
+        self.client.delete(f'/api/recipes/{self.recipe.id}/shopping_cart/')
+        self.assertEqual(list(totals.values_list('amount', flat=True)), [10])
+        self.client_2 = APIClient()
+        self.client_2.force_authenticate(user=self.user_2)
+        self.client_2.post(f'/api/recipes/{self.recipe_1.id}/shopping_cart/')
+        with CaptureQueriesContext(connection) as queries:
+            self.client_1.delete(f'/api/recipes/{self.recipe_1.id}/')
+        self.assertFalse(totals.exists())
+        self.assertFalse(CartIngredientTotal.objects.filter(
+            user=self.user_2).exists())
+        self.assertEqual(sum('recipes_cartingredienttotal' in query['sql']
+                             and 'SELECT' in query['sql']
+                             for query in queries.captured_queries), 1)
+        with CaptureQueriesContext(connection) as queries:
+            CartIngredientTotal.objects.apply_deltas(
+                {(self.user.pk, self.ingredient.pk): 1})
+        self.assertIn('users_user', queries.captured_queries[0]['sql'])
+        self.assertEqual(list(totals.values_list('amount', flat=True)), [1])
+
+    def test_admin_inline_updates_cart_totals(self):
+        admin_user = User.objects.create(username='admin', is_staff=True,
+                                         is_superuser=True)
+        client = APIClient()
+        client.force_login(admin_user)
+        row = RecipeIngridient.objects.get(recipe=self.recipe)
+        tag_rows = list(self.recipe.recipetag_set.all())
+        data = {
+            'name': self.recipe.name, 'text': self.recipe.text,
+            'cooking_time': self.recipe.cooking_time,
+            'author': self.user.id, 'pub_date_0': '2023-01-01',
+            'pub_date_1': '00:00:00',
+            'recipeingridient_set-TOTAL_FORMS': 1,
+            'recipeingridient_set-INITIAL_FORMS': 1,
+            'recipeingridient_set-0-id': row.id,
+            'recipeingridient_set-0-recipe': self.recipe.id,
+            'recipeingridient_set-0-ingredient': self.ingredient.id,
+            'recipeingridient_set-0-amount': 8,
+            'recipetag_set-TOTAL_FORMS': len(tag_rows),
+            'recipetag_set-INITIAL_FORMS': len(tag_rows),
+        }
+        for index, tag_row in enumerate(tag_rows):
+            data[f'recipetag_set-{index}-id'] = tag_row.id
+            data[f'recipetag_set-{index}-recipe'] = self.recipe.id
+            data[f'recipetag_set-{index}-tag'] = tag_row.tag_id
+        response = client.post(
+            f'/admin/recipes/recipes/{self.recipe.id}/change/', data)
+        self.assertEqual(response.status_code, HTTPStatus.FOUND,
+                         getattr(response, 'context', None)
+                         and response.context['adminform'].form.errors)
+        self.assertEqual(CartIngredientTotal.objects.get(
+            user=self.user, ingredient=self.ingredient).amount, 8)
+        other = Ingredients.objects.create(name='другой',
+                                           measurement_unit='г')
+        neighbour = Recipes.objects.create(
+            text='text', author=self.user_1, cooking_time=1, name='сосед',
+            image=PATH_TO_PICTURE)
+        neighbour.ingredients.add(other, through_defaults={'amount': 1})
+        have = f'/api/recipes/?have={other.id}'
+        recipe_matcher.invalidate()
+        self.assertEqual(self.client.get(have).data['count'], 1)
+        data['recipeingridient_set-0-ingredient'] = other.id
+        with self.captureOnCommitCallbacks(execute=True):
+            client.post(
+                f'/admin/recipes/recipes/{self.recipe.id}/change/', data)
+        self.assertEqual([recipe['id'] for recipe
+                          in self.client.get(have).data['results']],
+                         [neighbour.id, self.recipe.id])
+        self.assertEqual([recipe['id'] for recipe in self.client.get(
+            f'/api/recipes/{self.recipe.id}/similar/').data],
+            [neighbour.id])
+        with self.captureOnCommitCallbacks(execute=True):
+            client.post(f'/admin/recipes/recipes/{self.recipe.id}/delete/',
+                        {'post': 'yes'})
+        self.assertFalse(Recipes.objects.filter(pk=self.recipe.id).exists())
+        self.assertEqual([recipe['id'] for recipe
+                          in self.client.get(have).data['results']],
+                         [neighbour.id])
+
+    def test_ingredient_search_ranking(self):
+        for name in ('сахарная пудра', 'сахар', 'ванильный сахар', 'соль'):
+            Ingredients.objects.create(name=name, measurement_unit='г')
+        response = self.client_not_auth.get('/api/ingredients/?name=Сахар')
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+        self.assertEqual([item['name'] for item in response.data],
+                         ['сахар', 'сахарная пудра', 'ванильный сахар'])
+        response = self.client_not_auth.get('/api/ingredients/?name=сахр')
+        self.assertEqual(response.data[0]['name'], 'сахар')
+        Ingredients.objects.filter(name='соль').update(name='соль морская')
+        with self.captureOnCommitCallbacks(execute=True):
+            Ingredients.objects.get(name='соль морская').save()
+        response = self.client_not_auth.get('/api/ingredients/?name=соль')
+        self.assertEqual([item['name'] for item in response.data],
+                         ['соль морская'])
+
+    def test_load_ingredients_is_idempotent(self):
+        directory = Path(tempfile.mkdtemp(dir=TEMP_MEDIA_ROOT))
+        csv_path = directory / 'ingredients.csv'
+        csv_path.write_text('мука,г\n мука , г\nмолоко,мл\n,г\nсоль\n',
+                            encoding='UTF-8')
+        json_path = directory / 'ingredients.json'
+        json_path.write_text(json.dumps([
+            {'name': 'молоко', 'measurement_unit': 'мл'},
+            {'name': 'молоко', 'measurement_unit': 'л'},
+        ]), encoding='UTF-8')
+        before = Ingredients.objects.count()
+        version = catalog_version()
+        out = StringIO()
+        call_command('load_ingredients', str(csv_path), stdout=out)
+        self.assertIn('прочитано 2, добавлено 2', out.getvalue())
+        self.assertEqual(Ingredients.objects.count(), before + 2)
+        self.assertNotEqual(catalog_version(), version)
+        out = StringIO()
+        call_command('load_ingredients', str(csv_path), stdout=out)
+        self.assertIn('добавлено 0', out.getvalue())
+        call_command('load_ingredients', str(json_path), '--batch-size', '1',
+                     stdout=StringIO())
+        self.assertEqual(Ingredients.objects.count(), before + 3)
+        self.assertEqual(
+            Ingredients.objects.filter(name='молоко').count(), 2)
+
+    def test_update_recipe_touches_only_changed_ingredients(self):
+        ingredients = [Ingredients.objects.create(name=f'ingredient_{index}',
+                                                  measurement_unit='г')
+                       for index in range(30)]
+        url = f'/api/recipes/{self.recipe_1.id}/'
+        data = {'ingredients': [{'id': ingredient.id, 'amount': 1}
+                                for ingredient in ingredients]}
+        self.assertEqual(self.client_1.patch(url, data, format='json')
+                         .status_code, HTTPStatus.OK)
+        rows = RecipeIngridient.objects.filter(recipe=self.recipe_1)
+        kept = rows.get(ingredient=ingredients[1]).pk
+        data['ingredients'] = data['ingredients'][1:]
+        data['ingredients'][1]['amount'] = 5
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client_1.patch(url, data, format='json')
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+        self.assertLessEqual(len(queries), 10)
+        self.assertEqual(rows.count(), 29)
+        self.assertEqual(rows.get(ingredient=ingredients[1]).pk, kept)
+        self.assertEqual(rows.get(ingredient=ingredients[2]).amount, 5)
+
+    def test_recipe_payload_ids_checked_together(self):
+        url = f'/api/recipes/{self.recipe.id}/'
+        data = {'ingredients': [{'id': self.ingredient.id, 'amount': 1},
+                                {'id': 998, 'amount': 1},
+                                {'id': 999, 'amount': 1}],
+                'tags': [self.tag.id, self.tag.id]}
+        response = self.client.patch(url, data, format='json')
+        self.assertEqual(response.status_code, HTTPStatus.BAD_REQUEST)
+        self.assertIn('998, 999', str(response.data['ingredients']))
+        self.assertIn(str(self.tag.id), str(response.data['tags']))
+        data = {'ingredients': [{'id': self.ingredient.id, 'amount': 1},
+                                {'id': self.ingredient.id, 'amount': 2}]}
+        response = self.client.patch(url, data, format='json')
+        self.assertEqual(response.status_code, HTTPStatus.BAD_REQUEST)
+
+    @override_settings(RECIPE_IMAGE_VARIANTS_ASYNC=False)
+    def test_recipe_image_deduplicated_with_variants(self):
+        data = {"ingredients": [{"id": self.ingredient.id, "amount": 10}],
+                "tags": [self.tag.id],
+                "image": "data:image/png;base64,"
+                         "iVBORw0KGgoAAAANSUhEUgAAAAEAAAABAgMAAABieywa"
+                         "AAAACVBMVEUAAAD///9fX1/S0ecCAAAACXBIWXMAAA7EA"
+                         "AAOxAGVKw4bAAAACklEQVQImWNoAAAAggCByxOyYQAAAAB"
+                         "JRU5ErkJggg==",
+                "name": "image", "text": "image", "cooking_time": 1}
+        with self.captureOnCommitCallbacks(execute=True):
+            first = self.client.post('/api/recipes/', data, format='json')
+        second = self.client.post('/api/recipes/', data, format='json')
+        self.assertEqual(first.status_code, HTTPStatus.CREATED)
+        self.assertEqual(second.status_code, HTTPStatus.CREATED)
+        names = set(Recipes.objects.filter(name='image').values_list(
+            'image', flat=True))
+        self.assertEqual(len(names), 1)
+        self.assertTrue(Recipes.objects.get(
+            pk=first.data['id']).image_variants_ready)
+        with mock.patch.object(recipe_image_storage, 'exists') as exists:
+            response = self.client.get(f'/api/recipes/{first.data["id"]}/')
+        exists.assert_not_called()
+        for url in response.data['image_variants'].values():
+            self.assertTrue(url.endswith('.webp'))
+        pending = self.client.get(f'/api/recipes/{second.data["id"]}/')
+        self.assertEqual(set(pending.data['image_variants'].values()),
+                         {pending.data['image']})
+        data['image'] = 'data:image/png;base64,' + base64.b64encode(
+            b'not an image').decode()
+        response = self.client.post('/api/recipes/', data, format='json')
+        self.assertEqual(response.status_code, HTTPStatus.BAD_REQUEST)
+
+    def test_catalog_etag_and_version(self):
+        response = self.client_not_auth.get('/api/tags/')
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+        self.assertEqual(len(json.loads(response.content)), 2)
+        etag = response['ETag']
+        response = self.client_not_auth.get('/api/tags/',
+                                            HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, HTTPStatus.NOT_MODIFIED)
+        with self.captureOnCommitCallbacks(execute=True):
+            Tag.objects.create(name='lunch', slug='lunch', color='green')
+        response = self.client_not_auth.get('/api/tags/',
+                                            HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+        self.assertEqual(len(json.loads(response.content)), 3)
+        response = self.client_not_auth.get('/api/ingredients/',
+                                            HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertTrue(response['ETag'].endswith('-gzip"'))
+
+    def test_versions_survive_cache_eviction(self):
+        version = bump_catalog_version()
+        cache.clear()
+        self.assertEqual(catalog_version(), version)
+        with self.captureOnCommitCallbacks() as callbacks:
+            Tag.objects.create(name='lunch', slug='lunch', color='green')
+        self.assertEqual(catalog_version(), version)
+        for callback in callbacks:
+            callback()
+        self.assertEqual(catalog_version(), version + 1)
+
+    def test_recipe_conditional_get(self):
+        for url in (f'/api/recipes/{self.recipe_1.id}/', '/api/recipes/'):
+            with self.subTest(url=url):
+                response = self.client.get(url)
+                etag = response['ETag']
+                self.assertEqual(self.client.get(
+                    url, HTTP_IF_NONE_MATCH=etag).status_code,
+                    HTTPStatus.NOT_MODIFIED)
+                self.client.post(
+                    f'/api/recipes/{self.recipe_1.id}/favorite/')
+                response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+                self.assertEqual(response.status_code, HTTPStatus.OK)
+                self.client.delete(
+                    f'/api/recipes/{self.recipe_1.id}/favorite/')
+        url = f'/api/recipes/{self.recipe_1.id}/'
+        etag = self.client_1.get(url)['ETag']
+        self.client.post(f'/api/recipes/{self.recipe_1.id}/favorite/')
+        response = self.client_1.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+        self.assertEqual(response.data['favorites_count'], 1)
+        self.client.delete(f'/api/recipes/{self.recipe_1.id}/favorite/')
+        subscribe = f'/api/users/{self.user_1.id}/subscribe/'
+        for url in (f'/api/recipes/{self.recipe_1.id}/', '/api/recipes/'):
+            for method, followers in (('post', 1), ('delete', 0)):
+                with self.subTest(url=url, method=method):
+                    etag = self.client_not_auth.get(url)['ETag']
+                    getattr(self.client, method)(subscribe)
+                    response = self.client_not_auth.get(
+                        url, HTTP_IF_NONE_MATCH=etag)
+                    self.assertEqual(response.status_code, HTTPStatus.OK)
+                    recipe = response.data.get(
+                        'results', [response.data])[0]
+                    self.assertEqual(recipe['id'], self.recipe_1.id)
+                    self.assertEqual(recipe['author']['followers_count'],
+                                     followers)
+        response = self.client_not_auth.get('/api/recipes/')
+        self.assertNotIn('Last-Modified', response)
+        older = Recipes.objects.create(
+            text='text', author=self.user_1, cooking_time=1, name='older',
+            image=PATH_TO_PICTURE,
+            pub_date=self.recipe.pub_date - timedelta(days=1))
+        Recipes.objects.filter(pk=older.pk).update(
+            updated_at=self.recipe.updated_at - timedelta(days=1))
+        response = self.client_not_auth.get('/api/recipes/')
+        older.delete()
+        self.assertEqual(self.client_not_auth.get(
+            '/api/recipes/',
+            HTTP_IF_NONE_MATCH=response['ETag']).status_code,
+            HTTPStatus.OK)
+        response = self.client_not_auth.get('/api/recipes/')
+        self.tag.name = 'brunch'
+        self.tag.save()
+        self.assertEqual(self.client_not_auth.get(
+            '/api/recipes/',
+            HTTP_IF_NONE_MATCH=response['ETag']).status_code,
+            HTTPStatus.OK)
+
+    def test_recipe_search(self):
+        Recipes.objects.create(text='салат с курицей', author=self.user_1,
+                               cooking_time=5, name='цезарь',
+                               image=UPLOADED)
+        Recipes.objects.create(text='просто курица', author=self.user_1,
+                               cooking_time=5, name='курица гриль',
+                               image=UPLOADED)
+        response = self.client.get('/api/recipes/?search=гриль')
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+        self.assertEqual([recipe['name'] for recipe
+                          in response.data['results']], ['курица гриль'])
+        response = self.client.get(
+            f'/api/recipes/?search=салат&author={self.user_1.id}')
+        self.assertEqual([recipe['name'] for recipe
+                          in response.data['results']], ['цезарь'])
+
+    def test_counters(self):
+        self.client.post(f'/api/recipes/{self.recipe_1.id}/favorite/')
+        self.client_1.post(f'/api/recipes/{self.recipe_1.id}/favorite/')
+        self.client_1.delete(f'/api/recipes/{self.recipe_1.id}/favorite/')
+        self.client.post(f'/api/users/{self.user_1.id}/subscribe/')
+        self.recipe_1.refresh_from_db()
+        self.user.refresh_from_db()
+        self.user_1.refresh_from_db()
+        self.assertEqual(self.recipe_1.favorites_count, 1)
+        self.assertEqual(self.user.following_count, 1)
+        self.assertEqual(self.user_1.followers_count, 1)
+        self.assertEqual(self.user_1.recipes_count, 1)
+        Follow.objects.all().delete()
+        fixed = reconcile_counters()
+        self.assertEqual(fixed['User.followers_count'], 1)
+        self.user_1.refresh_from_db()
+        self.assertEqual(self.user_1.followers_count, 0)
+
+    def test_subscriptions_recipes_limit(self):
+        for index in range(3):
+            Recipes.objects.create(text='text', author=self.user_1,
+                                   cooking_time=1, name=f'new_{index}',
+                                   image=PATH_TO_PICTURE)
+        Follow.objects.create(user=self.user, following=self.user_1)
+        Follow.objects.create(user=self.user, following=self.user_2)
+        response = self.client.get(
+            '/api/users/subscriptions/?recipes_limit=2')
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+        recipes = {item['id']: [recipe['name'] for recipe in item['recipes']]
+                   for item in response.data['results']}
+        self.assertEqual(recipes[self.user_1.id], ['new_2', 'new_1'])
+        self.assertEqual(recipes[self.user_2.id], [])
+        self.assertTrue(all(item['is_subscribed']
+                            for item in response.data['results']))
+        for value in ('abc', '-1'):
+            response = self.client.get(
+                f'/api/users/subscriptions/?recipes_limit={value}')
+            self.assertEqual(response.status_code, HTTPStatus.BAD_REQUEST)
+
+    def test_recipe_filters_use_exists(self):
+        url = (f'/api/recipes/?tags={self.tag.slug}&tags={self.tag_1.slug}'
+               '&is_favorited=1&is_in_shopping_cart=1')
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+        self.assertEqual([recipe['id'] for recipe
+                          in response.data['results']], [self.recipe.id])
+        for query in queries:
+            self.assertNotIn('DISTINCT', query['sql'].upper())
+        self.recipe_1.tags.add(self.tag)
+        response = self.client.get(
+            f'/api/recipes/?tags={self.tag.slug}&tags={self.tag_1.slug}')
+        self.assertEqual(response.data['count'], 2)
+        response = self.client.get(
+            f'/api/recipes/?tags={self.tag.slug}&tags={self.tag_1.slug}'
+            '&tags_mode=all')
+        self.assertEqual([recipe['id'] for recipe
+                          in response.data['results']], [self.recipe.id])
+        response = self.client.get('/api/recipes/?tags_mode=some')
+        self.assertEqual(response.status_code, HTTPStatus.BAD_REQUEST)
+        response = self.client_not_auth.get(
+            '/api/recipes/?is_favorited=1&is_in_shopping_cart=1')
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+        self.assertEqual(response.data['count'], 0)
+
+    def test_async_read_views(self):
+        factory = APIRequestFactory()
+        with override_settings(ASYNC_READ_VIEWS=True):
+            me = UserViewSet.as_view({'get': 'me'})
+            create = RecipeViewSet.as_view({'post': 'create'})
+        self.assertTrue(asyncio.iscoroutinefunction(me))
+        self.assertEqual(me.cls, UserViewSet)
+        response = async_to_sync(me)(factory.get('/api/users/me/'))
+        self.assertEqual(response.status_code, HTTPStatus.UNAUTHORIZED)
+        response = async_to_sync(create)(factory.post('/api/recipes/'))
+        self.assertEqual(response.status_code, HTTPStatus.UNAUTHORIZED)
+        self.assertFalse(asyncio.iscoroutinefunction(
+            UserViewSet.as_view({'get': 'me'})))
+
+    def test_cached_token_authentication(self):
+        token = Token.objects.create(user=self.user_2)
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION=f'Token {token.key}')
+        self.assertEqual(client.get('/api/users/me/').status_code,
+                         HTTPStatus.OK)
+        with CaptureQueriesContext(connection) as queries:
+            response = client.get('/api/users/me/')
+        self.assertEqual(response.data['id'], self.user_2.id)
+        self.assertEqual(len(queries), 0)
+        self.user_2.is_active = False
+        self.user_2.save()
+        self.assertEqual(client.get('/api/users/me/').status_code,
+                         HTTPStatus.UNAUTHORIZED)
+        self.user_2.is_active = True
+        self.user_2.save()
+        self.assertEqual(client.get('/api/users/me/').status_code,
+                         HTTPStatus.OK)
+        self.assertFalse(client.get('/api/users/me/').wsgi_request.user
+                         .has_perm('users.add_user'))
+        self.user_2.user_permissions.add(
+            Permission.objects.get(codename='add_user'))
+        self.assertTrue(client.get('/api/users/me/').wsgi_request.user
+                        .has_perm('users.add_user'))
+        self.assertEqual(client.post('/api/auth/token/logout/').status_code,
+                         HTTPStatus.NO_CONTENT)
+        self.assertEqual(client.get('/api/users/me/').status_code,
+                         HTTPStatus.UNAUTHORIZED)
+        token = Token.objects.create(user=self.user_2)
+        client.credentials(HTTP_AUTHORIZATION=f'Token {token.key}')
+        self.assertEqual(client.get('/api/users/me/').status_code,
+                         HTTPStatus.OK)
+        # Запись в кэше другого воркера, который не видел удаления.
+        key = token.key
+        stale = token_cache.get(key)
+        with self.captureOnCommitCallbacks(execute=True):
+            token.delete()
+        cache.clear()
+        token_cache.set(key, stale)
+        self.assertEqual(client.get('/api/users/me/').status_code,
+                         HTTPStatus.OK)
+        with override_settings(AUTH_REVOCATION_CHECK_INTERVAL=0):
+            self.assertEqual(client.get('/api/users/me/').status_code,
+                             HTTPStatus.UNAUTHORIZED)
+
+    @override_settings(PROFILING_SAMPLE_RATE=1,
+                       PROFILING_DUPLICATE_THRESHOLD=2)
+    def test_profiling_server_timing(self):
+        client = APIClient()
+        client.force_authenticate(user=self.user)
+        with self.assertLogs('api.profiling', 'INFO') as logs:
+            response = client.get('/api/users/subscriptions/')
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+        timing = response['Server-Timing']
+        for name in ('db', 'app', 'render', 'total'):
+            self.assertIn(f'{name};dur=', timing)
+        profile = json.loads(logs.records[0].getMessage())
+        self.assertEqual(profile['path'], '/api/users/subscriptions/')
+        self.assertGreater(profile['queries'], 0)
+        with self.assertLogs('api.profiling', 'INFO') as logs:
+            client.get('/api/users/')
+        self.assertEqual(
+            json.loads(logs.records[0].getMessage())['duplicates'], [])
+
+        def n_plus_one(request):
+            for user in User.objects.all():
+                user.follower.exists()
+            return HttpResponse()
+
+        with self.assertLogs('api.profiling', 'INFO') as logs:
+            ProfilingMiddleware(n_plus_one)(
+                APIRequestFactory().get('/api/users/'))
+        duplicates = json.loads(logs.records[0].getMessage())['duplicates']
+        self.assertIn('users_follow', duplicates[0]['sql'])
+
+        async def get_response(request):
+            return HttpResponse()
+
+        middleware = ProfilingMiddleware(get_response)
+        self.assertTrue(asyncio.iscoroutinefunction(middleware))
+        with self.assertLogs('api.profiling', 'INFO'):
+            response = async_to_sync(middleware)(
+                APIRequestFactory().get('/api/tags/'))
+        self.assertIn('total;dur=', response['Server-Timing'])
+        self.assertEqual(
+            normalize_sql('SELECT 1 FROM t WHERE id IN (%s, %s) AND a = 5'),
+            'SELECT ? FROM t WHERE id IN (...) AND a = ?')
+
+    def test_metrics_endpoint(self):
+        self.assertEqual(self.client.get('/api/metrics/').status_code,
+                         HTTPStatus.NOT_FOUND)
+        metrics_dir = Path(tempfile.mkdtemp(dir=TEMP_MEDIA_ROOT))
+        stale = metrics_dir / '1-dead.json'
+        stale.write_text(json.dumps({'pid': 1, 'counters': [],
+                                     'histograms': [], 'in_flight': 1}))
+        os.utime(stale, (0, 0))
+        with override_settings(METRICS_ENABLED=True, METRICS_DIR=metrics_dir,
+                               METRICS_TOKEN='secret'):
+            registry.reset()
+            client = APIClient()
+            client.get('/api/recipes/')
+            client.get('/api/tags/')
+            client.get('/api/tags/')
+            self.assertEqual(client.get('/api/metrics/').status_code,
+                             HTTPStatus.FORBIDDEN)
+            self.assertEqual(client.get(
+                '/api/metrics/', HTTP_AUTHORIZATION='Bearer wrong'
+            ).status_code, HTTPStatus.FORBIDDEN)
+            staff = User.objects.create(username='staff', is_staff=True)
+            client.force_login(staff)
+            self.assertEqual(client.get('/api/metrics/').status_code,
+                             HTTPStatus.OK)
+            client.logout()
+            response = client.get('/api/metrics/',
+                                  HTTP_AUTHORIZATION='Bearer secret')
+
+            async def get_response(request):
+                return HttpResponse()
+
+            middleware = MetricsMiddleware(get_response)
+            self.assertTrue(asyncio.iscoroutinefunction(middleware))
+            async_to_sync(middleware)(APIRequestFactory().get('/'))
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+        self.assertFalse(stale.exists())
+        body = response.content.decode()
+        self.assertIn('foodgram_requests_total{method="GET",'
+                      'route="recipes-list",status="200"} 1', body)
+        self.assertIn('foodgram_requests_total{method="GET",'
+                      'route="metrics",status="403"} 2', body)
+        self.assertIn('foodgram_request_duration_seconds_count'
+                      '{route="tags-list"} 2', body)
+        self.assertIn('foodgram_cache_requests_total'
+                      '{cache="catalog",result="hit"} 1', body)
+        self.assertIn('foodgram_requests_in_flight 1', body)
+        self.assertRegex(body, r'foodgram_db_queries_total'
+                               r'\{route="recipes-list"\} [1-9]')
+
+    def test_feed_strategies(self):
+        own = Recipes.objects.create(text='text', author=self.user_2,
+                                     cooking_time=1, name='own',
+                                     image=PATH_TO_PICTURE)
+        for strategy in ('read', 'write'):
+            with self.subTest(strategy=strategy), override_settings(
+                    FEED_STRATEGY=strategy):
+                self.client.post(f'/api/users/{self.user_1.id}/subscribe/')
+                self.client.post(f'/api/users/{self.user_2.id}/subscribe/')
+                response = self.client.get('/api/recipes/feed/?limit=1')
+                self.assertEqual(response.status_code, HTTPStatus.OK)
+                self.assertEqual([recipe['id'] for recipe
+                                  in response.data['results']], [own.id])
+                response = self.client.get(response.data['next'])
+                self.assertEqual([recipe['id'] for recipe
+                                  in response.data['results']],
+                                 [self.recipe_1.id])
+                self.assertIsNone(response.data['next'])
+                self.client.delete(f'/api/users/{self.user_2.id}/subscribe/')
+                response = self.client.get('/api/recipes/feed/')
+                self.assertEqual([recipe['id'] for recipe
+                                  in response.data['results']],
+                                 [self.recipe_1.id])
+                self.client.delete(f'/api/users/{self.user_1.id}/subscribe/')
+        self.assertEqual(
+            self.client_not_auth.get('/api/recipes/feed/').status_code,
+            HTTPStatus.UNAUTHORIZED)
+
+    def test_similar_recipes(self):
+        ingredients = [Ingredients.objects.create(name=f'similar_{index}',
+                                                  measurement_unit='г')
+                       for index in range(4)]
+        recipes = []
+        for index, used in enumerate(((0, 1, 2), (0, 1), (3,), (0, 1, 2))):
+            recipe = Recipes.objects.create(
+                text='text', author=self.user_1, cooking_time=1,
+                name=f'similar_{index}', image=PATH_TO_PICTURE)
+            for position in used:
+                recipe.ingredients.add(ingredients[position],
+                                       through_defaults={'amount': 1})
+            recipes.append(recipe)
+        rebuild_similar()
+        matrix = FeatureMatrix.from_db()
+        dense = np.zeros((len(matrix), matrix.csc[0].size - 1))
+        pointers, columns, values = matrix.csr
+        for row in range(len(matrix)):
+            dense[row, columns[pointers[row]:pointers[row + 1]]] = values[
+                pointers[row]:pointers[row + 1]]
+        expected = dense @ dense.T
+        np.fill_diagonal(expected, 0)
+        rows = np.arange(len(matrix))
+        np.testing.assert_allclose(matrix.similarities(rows), expected)
+        response = self.client.get(f'/api/recipes/{recipes[0].id}/similar/')
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+        self.assertEqual([recipe['id'] for recipe in response.data[:2]],
+                         [recipes[3].id, recipes[1].id])
+        self.assertNotIn(recipes[2].id,
+                         [recipe['id'] for recipe in response.data])
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client_1.patch(
+                f'/api/recipes/{recipes[2].id}/',
+                {'ingredients': [{'id': ingredients[0].id, 'amount': 1},
+                                 {'id': ingredients[1].id, 'amount': 1}]},
+                format='json')
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+        response = self.client.get(f'/api/recipes/{recipes[2].id}/similar/')
+        self.assertEqual(response.data[0]['id'], recipes[1].id)
+        self.assertEqual(
+            self.client.get('/api/recipes/0/similar/').status_code,
+            HTTPStatus.NOT_FOUND)
+        ingredients[2].delete()
+        self.assertGreater(rebuild_similar(), 0)
+        update_similar(recipes[0].id)
+        response = self.client.get(f'/api/recipes/{recipes[0].id}/similar/')
+        self.assertIn(recipes[3].id,
+                      [recipe['id'] for recipe in response.data])
+
+    def test_cook_with_what_i_have(self):
+        flour, egg, milk, salt = (
+            Ingredients.objects.create(name=name, measurement_unit='г')
+            for name in ('мука', 'яйцо', 'молоко', 'соль'))
+        recipes = {}
+        for name, used in (('блины', (flour, egg, milk)),
+                           ('омлет', (egg, milk)),
+                           ('соленое яйцо', (egg, salt))):
+            recipe = Recipes.objects.create(
+                text='text', author=self.user_1, cooking_time=1, name=name,
+                image=PATH_TO_PICTURE)
+            for ingredient in used:
+                recipe.ingredients.add(ingredient,
+                                       through_defaults={'amount': 1})
+            recipes[name] = recipe.id
+        recipe_matcher.invalidate()
+
+        def names(query):
+            response = self.client.get(f'/api/recipes/?{query}')
+            self.assertEqual(response.status_code, HTTPStatus.OK)
+            return [recipe['name'] for recipe in response.data['results']]
+
+        have = f'have={egg.id},{milk.id}'
+        self.assertEqual(names(have), ['омлет'])
+        self.assertEqual(names(f'{have}&missing=1'),
+                         ['омлет', 'блины', 'соленое яйцо'])
+        self.assertEqual(names(f'have={salt.id}&missing=0'), [])
+        built = recipe_matcher._built
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client_1.patch(
+                f'/api/recipes/{recipes["блины"]}/',
+                {'ingredients': [{'id': egg.id, 'amount': 1},
+                                 {'id': milk.id, 'amount': 2}]},
+                format='json')
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+        cache.clear()
+        self.assertEqual(sorted(names(have)), ['блины', 'омлет'])
+        # Правка применена по журналу в БД, без перестроения индекса.
+        self.assertEqual(recipe_matcher._built, built)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client_1.delete(f'/api/recipes/{recipes["омлет"]}/')
+        self.assertEqual(names(have), ['блины'])
+        self.assertNotIn(MATCH_TRUNCATED_HEADER,
+                         self.client.get(f'/api/recipes/?{have}'))
+        with mock.patch('api.filters.MATCH_LIMIT', 1):
+            response = self.client.get(f'/api/recipes/?{have}&missing=1')
+        self.assertEqual(response.data['count'], 1)
+        self.assertEqual(response[MATCH_TRUNCATED_HEADER], '1')
+
+    def test_have_after_ingredient_deleted(self):
+        flour, egg = (
+            Ingredients.objects.create(name=name, measurement_unit='г')
+            for name in ('мука', 'яйцо'))
+        recipe = Recipes.objects.create(
+            text='text', author=self.user_1, cooking_time=1, name='блины',
+            image=PATH_TO_PICTURE)
+        for ingredient in (flour, egg):
+            recipe.ingredients.add(ingredient, through_defaults={'amount': 1})
+        recipe_matcher.invalidate()
+        url = f'/api/recipes/?have={egg.id}'
+        self.assertEqual(self.client.get(url).data['count'], 0)
+        with self.captureOnCommitCallbacks(execute=True):
+            flour.delete()
+        self.assertTrue(RecipeIngridient.objects.filter(
+            recipe=recipe, ingredient__isnull=True).exists())
+        for rebuild in (False, True):
+            if rebuild:
+                recipe_matcher.invalidate()
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, HTTPStatus.OK)
+            self.assertEqual([item['id'] for item in response.data['results']],
+                             [recipe.id])
+
+    def test_popular_ordering(self):
+        fresh, old = (Recipes.objects.create(
+            text='text', author=self.user_1, cooking_time=1, name=name,
+            image=PATH_TO_PICTURE) for name in ('fresh', 'old'))
+        now = timezone.now()
+        Cart.objects.create(user=self.user_1, recipe=fresh, created=now)
+        for user in (self.user, self.user_1):
+            Favorites.objects.create(user=user, recipe=old,
+                                     created=now - timedelta(hours=48))
+
+        def ranking():
+            response = self.client.get('/api/recipes/?ordering=popular')
+            self.assertEqual(response.status_code, HTTPStatus.OK)
+            return [recipe['id'] for recipe in response.data['results']]
+
+        self.assertEqual(refresh_popularity(now, half_life_hours=72), 3)
+        self.assertEqual(ranking()[:3], [self.recipe.id, old.id, fresh.id])
+        refresh_popularity(now, half_life_hours=12)
+        old.refresh_from_db()
+        self.assertAlmostEqual(old.popularity, 2 / 16)
+        self.assertEqual(ranking()[:3], [self.recipe.id, fresh.id, old.id])
+        self.assertEqual(self.client.get(
+            '/api/recipes/?ordering=popular&paginate=cursor').status_code,
+            HTTPStatus.BAD_REQUEST)
+
+    def test_shopping_list_units_normalized(self):
+        lines = [('мука', 'г', 500), ('мука', 'кг', 1),
+                 ('молоко', 'мл', 300), ('молоко', 'л', 1),
+                 ('соль', 'ч.л.', 1), ('соль', 'ст. л.', 1),
+                 ('сахар', 'ч. л.', 3), ('яйцо', 'шт.', 2), ('яйцо', 'шт.', 3)]
+        items = normalize_units(
+            {'ingredient__name': name, 'ingredient__measurement_unit': unit,
+             'amount': amount} for name, unit, amount in lines)
+        self.assertEqual(
+            [(item['ingredient__name'], item['amount'],
+              item['ingredient__measurement_unit']) for item in items],
+            [('мука', 1.5, 'кг'), ('молоко', 1.3, 'л'), ('соль', 4, 'ч. л.'),
+             ('сахар', 1, 'ст. л.'), ('яйцо', 5, 'шт.')])
+        self.assertIs(type(items[-1]['ingredient__measurement_unit']), str)
+        rows = [{'ingredient__name': name,
+                 'ingredient__measurement_unit': unit, 'amount': amount}
+                for name, unit, amount in lines]
+        chunks = normalized_chunks(iter(rows), chunk_size=2)
+        self.assertIsInstance(chunks, types.GeneratorType)
+        self.assertEqual(list(chunks), items)
+        self.assertEqual(normalize_units([]), [])
+        recipe = Recipes.objects.create(text='text', author=self.user_1,
+                                        cooking_time=1, name='блины',
+                                        image=PATH_TO_PICTURE)
+        for unit, amount in (('г', 500), ('кг', 1)):
+            recipe.ingredients.add(
+                Ingredients.objects.create(name='мука', measurement_unit=unit),
+                through_defaults={'amount': amount})
+        self.client_1.post(f'/api/recipes/{recipe.id}/shopping_cart/')
+        body = b''.join(self.client_1.get(
+            '/api/recipes/download_shopping_cart/?format=txt'
+        ).streaming_content)
+        self.assertEqual(body.decode(), 'мука - 1.5 кг\n')
@@ -0,0 +1,317 @@
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+from http import HTTPStatus
+
+from django.core.cache import cache
+from django.db import connection
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
+from rest_framework.authtoken.models import Token
+from rest_framework.test import APIClient, APITestCase
+
+from recipes.counters import reconcile_counters
+from recipes.models import (Cart, CartIngredientTotal, Favorites,
+                            Ingredients, RecipeIngridient, Recipes,
+                            RecipeTag, Tag)
+from recipes.similarity import rebuild_similar
+from users.authentication import token_cache
+from users.models import Follow, User
+
+USERS_COUNT = 12
+RECIPES_PER_USER = 4
+INGREDIENTS_COUNT = 40
+INGREDIENTS_PER_RECIPE = 8
+TAGS_COUNT = 3
+FAVORITES_PER_USER = 10
+CART_PER_USER = 6
+FOLLOWS_PER_USER = 5
+PAGE_LIMIT = 20
+PASSWORD = 'bench-password'
+IMAGE = ('data:image/png;base64,'
+         'iVBORw0KGgoAAAANSUhEUgAAAAEAAAABAgMAAABieywaAAAACVBMVEUAAAD///9fX1/'
+         'S0ecCAAAACXBIWXMAAA7EAAAOxAGVKw4bAAAACklEQVQImWNoAAAAggCByxOyYQAAAAB'
+         'JRU5ErkJggg==')
+TEMP_MEDIA_ROOT = tempfile.mkdtemp()
+# Время зависит от машины, поэтому в CI только записывается в отчет;
+# BENCHMARK_TIMING=True включает и проверку бюджета по времени.
+CHECK_TIMING = os.getenv('BENCHMARK_TIMING', 'False') == 'True'
+
+# Бюджет на один запрос: (SQL-запросов, миллисекунд, байт ответа); он
+# общий для анонима и пользователя с настоящим токеном, у анонима
+# закрытые маршруты отвечают 401. Число запросов и размер проверяются
+# всегда и не зависят от числа объектов на странице. Токен из кэша
+# процесса запросов не стоит; чтение версий данных (справочники,
+# состояние пользователя) - один запрос по первичному ключу. Изменение
+# итогов корзины блокирует строку пользователя - еще один запрос.
+BUDGETS = {
+    'tags-list': (2, 500, 2_000),
+    'tags-detail': (1, 500, 1_000),
+    'ingredients-list': (2, 500, 10_000),
+    'ingredients-detail': (1, 500, 1_000),
+    'recipes-list': (6, 1_000, 60_000),
+    'recipes-detail': (3, 500, 5_000),
+    'recipes-similar': (2, 500, 5_000),
+    'recipes-feed': (3, 1_000, 60_000),
+    'recipes-create': (10, 1_000, 5_000),
+    'recipes-update': (16, 1_000, 5_000),
+    'recipes-delete': (14, 500, 1_000),
+    'recipes-download-shopping-cart': (1, 500, 10_000),
+    'recipes-favorite': (7, 500, 1_000),
+    'recipes-favorite-delete': (7, 500, 1_000),
+    'recipes-shopping-cart': (12, 500, 1_000),
+    'recipes-shopping-cart-delete': (12, 500, 1_000),
+    'users-list': (2, 1_000, 10_000),
+    'users-detail': (1, 500, 1_000),
+    'users-me': (0, 500, 1_000),
+    'users-subscriptions': (3, 1_000, 20_000),
+    'users-subscribe': (9, 500, 5_000),
+    'users-unsubscribe': (11, 500, 1_000),
+    'users-create': (3, 1_000, 1_000),
+    'auth-token-login': (3, 1_000, 1_000),
+    'auth-token-logout': (2, 500, 1_000),
+}
+
+
+# Проверка отзыва токенов за время теста не повторяется, чтобы число
+# запросов не зависело от того, сколько прошло с прошлой проверки.
+@override_settings(MEDIA_ROOT=TEMP_MEDIA_ROOT,
+                   AUTH_REVOCATION_CHECK_INTERVAL=60 * 60)
+class EndpointBenchmarkTest(APITestCase):
+    """Бюджеты по SQL-запросам, времени и размеру ответа для эндпоинтов."""
+
+    results = []
+
+    @classmethod
+    def setUpTestData(cls):
+        # Объекты с первичными ключами создаются по одному: bulk_create
+        # возвращает pk не на всех бэкендах.
+        cls.users = [
+            User.objects.create(username=f'bench_{index}',
+                                email=f'bench_{index}@yandex.ru',
+                                first_name='bench',
+                                last_name='bench')
+            for index in range(USERS_COUNT)
+        ]
+        cls.tags = [
+            Tag.objects.create(name=f'tag_{index}', slug=f'tag_{index}',
+                               color=f'#0000{index:02d}')
+            for index in range(TAGS_COUNT)
+        ]
+        cls.ingredients = [
+            Ingredients.objects.create(name=f'ingredient_{index}',
+                                       measurement_unit='г')
+            for index in range(INGREDIENTS_COUNT)
+        ]
+        cls.recipes = [
+            Recipes.objects.create(author=author,
+                                   name=f'recipe_{author.pk}_{index}',
+                                   text='text',
+                                   cooking_time=index + 1,
+                                   image='recipes/bench.png')
+            for author in cls.users
+            for index in range(RECIPES_PER_USER)
+        ]
+        RecipeIngridient.objects.bulk_create(
+            RecipeIngridient(
+                recipe=recipe,
+                ingredient=cls.ingredients[
+                    (recipe_index + offset) % INGREDIENTS_COUNT],
+                amount=offset + 1)
+            for recipe_index, recipe in enumerate(cls.recipes)
+            for offset in range(INGREDIENTS_PER_RECIPE)
+        )
+        RecipeTag.objects.bulk_create(
+            RecipeTag(recipe=recipe, tag=cls.tags[index % TAGS_COUNT])
+            for index, recipe in enumerate(cls.recipes)
+        )
+        recipes_count = len(cls.recipes)
+        Favorites.objects.bulk_create(
+            Favorites(user=user,
+                      recipe=cls.recipes[(user_index + offset)
+                                         % recipes_count])
+            for user_index, user in enumerate(cls.users)
+            for offset in range(FAVORITES_PER_USER)
+        )
+        Cart.objects.bulk_create(
+            Cart(user=user,
+                 recipe=cls.recipes[(user_index * 3 + offset)
+                                    % recipes_count])
+            for user_index, user in enumerate(cls.users)
+            for offset in range(CART_PER_USER)
+        )
+        Follow.objects.bulk_create(
+            Follow(user=user,
+                   following=cls.users[(user_index + offset)
+                                       % USERS_COUNT])
+            for user_index, user in enumerate(cls.users)
+            for offset in range(1, FOLLOWS_PER_USER + 1)
+        )
+        CartIngredientTotal.objects.rebuild()
+        reconcile_counters()
+        rebuild_similar()
+        cls.user = cls.users[0]
+        cls.user.set_password(PASSWORD)
+        cls.user.save()
+        cls.token = Token.objects.create(user=cls.user)
+        cls.recipe = cls.recipes[-1]
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        shutil.rmtree(TEMP_MEDIA_ROOT, ignore_errors=True)
+        sys.stdout.write('endpoint benchmark:\n{}\n'.format(json.dumps(
+            cls.results, ensure_ascii=False, indent=2)))
+
+    def setUp(self):
+        cache.clear()
+        token_cache.clear()
+        self.client_anon = APIClient()
+        self.client_auth = APIClient()
+        self.client_auth.credentials(
+            HTTP_AUTHORIZATION=f'Token {self.token.key}')
+        # Токен попадает в кэш процесса до замеров, как у работающего
+        # воркера; промах кэша - это еще один запрос.
+        self.client_auth.get('/api/users/me/')
+
+    def measure(self, name, client, method, url, expected_status,
+                data=None):
+        with CaptureQueriesContext(connection) as queries:
+            started = time.perf_counter()
+            response = getattr(client, method)(url, data, format='json')
+            size = len(response.getvalue()) if response.streaming else len(
+                response.content)
+            elapsed_ms = (time.perf_counter() - started) * 1000
+        self.assertEqual(response.status_code, expected_status, url)
+        result = {
+            'endpoint': name,
+            'user': 'anon' if client is self.client_anon else 'auth',
+            'queries': len(queries),
+            'ms': round(elapsed_ms, 2),
+            'bytes': size,
+        }
+        self.results.append(result)
+        max_queries, max_ms, max_bytes = BUDGETS[name]
+        self.assertLessEqual(len(queries), max_queries, result)
+        if CHECK_TIMING:
+            self.assertLessEqual(elapsed_ms, max_ms, result)
+        self.assertLessEqual(size, max_bytes, result)
+        return response
+
+    def recipe_data(self, offset=0):
+        return {
+            'ingredients': [
+                {'id': self.ingredients[
+                    (offset + index) % INGREDIENTS_COUNT].pk,
+                 'amount': index + 1}
+                for index in range(INGREDIENTS_PER_RECIPE)],
+            'tags': [self.tags[offset % TAGS_COUNT].pk],
+            'image': IMAGE,
+            'name': f'bench_new_{offset}',
+            'text': 'text',
+            'cooking_time': 10,
+        }
+
+    def test_public_endpoints(self):
+        endpoints = (
+            ('tags-list', '/api/tags/'),
+            ('tags-detail', f'/api/tags/{self.tags[0].pk}/'),
+            ('ingredients-list', '/api/ingredients/'),
+            ('ingredients-detail',
+             f'/api/ingredients/{self.ingredients[0].pk}/'),
+            ('recipes-list', f'/api/recipes/?limit={PAGE_LIMIT}'),
+            ('recipes-detail', f'/api/recipes/{self.recipe.pk}/'),
+            ('recipes-similar', f'/api/recipes/{self.recipe.pk}/similar/'),
+            ('users-list', f'/api/users/?limit={PAGE_LIMIT}'),
+        )
+        for client in (self.client_anon, self.client_auth):
+            for name, url in endpoints:
+                with self.subTest(endpoint=name, url=url):
+                    self.measure(name, client, 'get', url, HTTPStatus.OK)
+
+    def test_authenticated_endpoints(self):
+        endpoints = (
+            ('users-detail', f'/api/users/{self.users[1].pk}/'),
+            ('users-me', '/api/users/me/'),
+            ('users-subscriptions',
+             f'/api/users/subscriptions/?limit={PAGE_LIMIT}'),
+            ('recipes-feed', f'/api/recipes/feed/?limit={PAGE_LIMIT}'),
+            ('recipes-download-shopping-cart',
+             '/api/recipes/download_shopping_cart/'),
+        )
+        for client, status in ((self.client_anon, HTTPStatus.UNAUTHORIZED),
+                               (self.client_auth, HTTPStatus.OK)):
+            for name, url in endpoints:
+                with self.subTest(endpoint=name, url=url):
+                    self.measure(name, client, 'get', url, status)
+
+    def test_write_endpoints(self):
+        recipe = next(
+            recipe for recipe in reversed(self.recipes)
+            if not Favorites.objects.filter(
+                user=self.user, recipe=recipe).exists()
+            and not Cart.objects.filter(
+                user=self.user, recipe=recipe).exists()
+        )
+        author = next(
+            user for user in self.users[1:]
+            if not Follow.objects.filter(
+                user=self.user, following=user).exists())
+        favorite = f'/api/recipes/{recipe.pk}/favorite/'
+        cart = f'/api/recipes/{recipe.pk}/shopping_cart/'
+        subscribe = f'/api/users/{author.pk}/subscribe/'
+        detail = f'/api/recipes/{self.recipe.pk}/'
+        for name, method, url in (
+                ('recipes-create', 'post', '/api/recipes/'),
+                ('recipes-update', 'patch', detail),
+                ('recipes-delete', 'delete', detail),
+                ('recipes-favorite', 'post', favorite),
+                ('recipes-favorite-delete', 'delete', favorite),
+                ('recipes-shopping-cart', 'post', cart),
+                ('recipes-shopping-cart-delete', 'delete', cart),
+                ('users-subscribe', 'post', subscribe),
+                ('users-unsubscribe', 'delete', subscribe)):
+            with self.subTest(endpoint=name, user='anon'):
+                self.measure(name, self.client_anon, method, url,
+                             HTTPStatus.UNAUTHORIZED)
+        created = self.measure(
+            'recipes-create', self.client_auth, 'post', '/api/recipes/',
+            HTTPStatus.CREATED, self.recipe_data())
+        detail = f'/api/recipes/{created.data["id"]}/'
+        self.measure('recipes-update', self.client_auth, 'patch', detail,
+                     HTTPStatus.OK, self.recipe_data(offset=1))
+        self.measure('recipes-favorite', self.client_auth, 'post',
+                     favorite, HTTPStatus.CREATED)
+        self.measure('recipes-favorite-delete', self.client_auth, 'delete',
+                     favorite, HTTPStatus.NO_CONTENT)
+        self.measure('recipes-shopping-cart', self.client_auth, 'post',
+                     cart, HTTPStatus.CREATED)
+        self.measure('recipes-shopping-cart-delete', self.client_auth,
+                     'delete', cart, HTTPStatus.NO_CONTENT)
+        self.measure('users-subscribe', self.client_auth, 'post', subscribe,
+                     HTTPStatus.CREATED)
+        self.measure('users-unsubscribe', self.client_auth, 'delete',
+                     subscribe, HTTPStatus.NO_CONTENT)
+        self.measure('recipes-delete', self.client_auth, 'delete', detail,
+                     HTTPStatus.NO_CONTENT)
+
+    def test_token_endpoints(self):
+        self.measure('users-create', self.client_anon, 'post', '/api/users/',
+                     HTTPStatus.CREATED,
+                     {'email': 'bench_new@yandex.ru',
+                      'username': 'bench_new', 'first_name': 'bench',
+                      'last_name': 'bench', 'password': PASSWORD})
+        response = self.measure(
+            'auth-token-login', self.client_anon, 'post',
+            '/api/auth/token/login/', HTTPStatus.OK,
+            {'email': self.user.email, 'password': PASSWORD})
+        self.measure('auth-token-logout', self.client_anon, 'post',
+                     '/api/auth/token/logout/', HTTPStatus.UNAUTHORIZED)
+        client = APIClient()
+        client.credentials(
+            HTTP_AUTHORIZATION=f'Token {response.data["auth_token"]}')
+        self.measure('auth-token-logout', client, 'post',
+                     '/api/auth/token/logout/', HTTPStatus.NO_CONTENT)
@@ -1,6 +1,7 @@
 from django.urls import include, path
 from rest_framework.routers import DefaultRouter
 
+from api.metrics import metrics_view
 from api.views import (
     IngredientsViewSet,
     RecipeViewSet,
@@ -29,4 +30,5 @@ urlpatterns = [
     #      ),
     path("", include(router.urls)),
     path("auth/", include("djoser.urls.authtoken")),
+    path("metrics/", metrics_view, name="metrics"),
 ]
@@ -1,51 +1,137 @@
 from django.contrib.auth import get_user_model
-from django.db.models import Sum
-from django.http.response import HttpResponse
+from django.db import transaction
+from django.db.models import Count, Max
+from django.http.response import StreamingHttpResponse
 from django.shortcuts import get_object_or_404
 from django_filters.rest_framework import DjangoFilterBackend
 from rest_framework import permissions, status, viewsets
 from rest_framework.decorators import action
+from rest_framework.exceptions import ValidationError
 
 from rest_framework.response import Response
 from rest_framework.viewsets import ReadOnlyModelViewSet
 
-from recipes.models import (Cart, Favorites, Ingredients, RecipeIngridient,
-                            Recipes, Tag)
-from .filters import IngredientsFilter, RecipeFilterSet
-from .pagination import PageLimitPagination
+from recipes.models import (Cart, CartIngredientTotal, Favorites, Ingredients,
+                            Recipes, SimilarRecipe, Tag, TimelineEntry)
+from recipes.matching import MATCH_TRUNCATED_HEADER, recipes_changed
+from recipes.popularity import popularity_version
+from recipes.search import ingredient_search
+from recipes.versions import bump_user_state_version, user_state_version
+from .async_views import AsyncReadViewSetMixin
+from .catalog_cache import CatalogCacheMixin
+from .conditional import conditional, make_etag, set_validators
+from .filters import ORDERING_POPULAR, RecipeFilterSet
+from .pagination import PageLimitPagination, RecipeCursorPagination
 from .permissions import AdminOrReadOnly, AuthorStaffOrReadOnly
 from .serializers import (AddRecipeSerializer, FavouriteSerializer,
                           IngredientSerializer, ShoppingListSerializer,
-                          ShowRecipeFullSerializer, TagSerializer)
+                          ShortRecipeSerializer, ShowRecipeFullSerializer,
+                          TagSerializer)
+from .shopping_list import (DEFAULT_FORMAT, FILENAME, FORMAT_PARAM,
+                            RENDERERS, ShoppingListNegotiation,
+                            shopping_list_items)
 
 User = get_user_model()
 
 
-class TagViewSet(ReadOnlyModelViewSet):
+class TagViewSet(AsyncReadViewSetMixin, CatalogCacheMixin,
+                 ReadOnlyModelViewSet):
 
+    catalog_name = 'tags'
     queryset = Tag.objects.all()
     serializer_class = TagSerializer
     permission_classes = (AdminOrReadOnly,)
     pagination_class = None
 
 
-class IngredientsViewSet(ReadOnlyModelViewSet):
+class IngredientsViewSet(AsyncReadViewSetMixin, CatalogCacheMixin,
+                         ReadOnlyModelViewSet):
+    catalog_name = 'ingredients'
     queryset = Ingredients.objects.all()
     serializer_class = IngredientSerializer
     permission_classes = (AdminOrReadOnly,)
-    filter_backends = [DjangoFilterBackend]
-    filterset_class = IngredientsFilter
     pagination_class = None
 
+    def list(self, request, *args, **kwargs):
+        name = request.query_params.get('name')
+        if not name:
+            return super().list(request, *args, **kwargs)
+        return Response(ingredient_search.search(name))
+
 
-class RecipeViewSet(viewsets.ModelViewSet):
-    queryset = Recipes.objects.all().order_by('-pub_date')
+class RecipeViewSet(AsyncReadViewSetMixin, viewsets.ModelViewSet):
+    queryset = Recipes.objects.all().order_by('-pub_date', '-id')
     serializer_class = ShowRecipeFullSerializer
     permission_classes = (AuthorStaffOrReadOnly,)
     filter_backends = [DjangoFilterBackend]
     filterset_class = RecipeFilterSet
     pagination_class = PageLimitPagination
 
+    def get_queryset(self):
+        if self.request.method == 'GET':
+            return Recipes.objects.for_list(
+                self.request.user).order_by('-pub_date', '-id')
+        return super().get_queryset()
+
+    def get_list_validators(self):
+        """ETag страницы без сериализации рецептов. Last-Modified не
+        отдается: удаление рецепта не меняет Max(updated_at), а число
+        рецептов в ETag учитывает и его."""
+        user = self.request.user
+        aggregate = self.filter_queryset(Recipes.objects.all()).aggregate(
+            last_modified=Max('updated_at'), count=Count('id'))
+        state = (None if user.is_anonymous
+                 else (user.pk, user_state_version(user.pk)))
+        ranking = (popularity_version()
+                   if self.request.query_params.get('ordering')
+                   == ORDERING_POPULAR else None)
+        return make_etag(self.request.get_full_path(), state, ranking,
+                         aggregate['last_modified'], aggregate['count'])
+
+    def list(self, request, *args, **kwargs):
+        etag = self.get_list_validators()
+        response = conditional(request, etag)
+        if response is None:
+            response = super().list(request, *args, **kwargs)
+            if getattr(request, 'matches_limit', None):
+                response[MATCH_TRUNCATED_HEADER] = str(request.matches_limit)
+        return set_validators(response, etag)
+
+    def retrieve(self, request, *args, **kwargs):
+        recipe = self.get_object()
+        etag = make_etag(recipe.pk, recipe.updated_at.isoformat(),
+                         recipe.is_favorited, recipe.is_in_shopping_cart,
+                         recipe.author_is_subscribed)
+        last_modified = (recipe.updated_at if request.user.is_anonymous
+                         else None)
+        response = conditional(request, etag, last_modified)
+        if response is None:
+            response = Response(self.get_serializer(recipe).data)
+        return set_validators(response, etag, last_modified)
+
+    def perform_destroy(self, instance):
+        with transaction.atomic():
+            CartIngredientTotal.objects.delete_recipe(instance)
+            recipes_changed([instance.pk])
+            instance.delete()
+            User.objects.filter(pk=instance.author_id).increment(
+                recipes_count=-1)
+
+    @property
+    def paginator(self):
+        if not hasattr(self, '_paginator'):
+            if RecipeCursorPagination.is_requested(self.request):
+                if (self.request.query_params.get('ordering')
+                        == ORDERING_POPULAR):
+                    # Курсор идет по pub_date и переупорядочил бы выдачу.
+                    raise ValidationError({'ordering': [
+                        'ordering=popular не поддерживает курсорную '
+                        'пагинацию, используйте page и limit.']})
+                self._paginator = RecipeCursorPagination()
+            else:
+                self._paginator = self.pagination_class()
+        return self._paginator
+
     def get_serializer_class(self):
         if self.request.method == 'GET':
             return ShowRecipeFullSerializer
@@ -65,7 +151,11 @@ class RecipeViewSet(viewsets.ModelViewSet):
                 {"error": "Этот рецепт уже в избранном"},
                 status=status.HTTP_400_BAD_REQUEST,
             )
-        favorite = Favorites.objects.create(user=user, recipe=recipe)
+        with transaction.atomic():
+            favorite = Favorites.objects.create(user=user, recipe=recipe)
+            Recipes.objects.filter(pk=recipe.pk).increment(
+                favorites_count=1)
+        bump_user_state_version(user.pk)
         serializer = FavouriteSerializer(favorite,
                                          context={"request": request})
         return Response(serializer.data, status=status.HTTP_201_CREATED)
@@ -76,7 +166,11 @@ class RecipeViewSet(viewsets.ModelViewSet):
         recipe = get_object_or_404(Recipes, id=pk)
         favorite = Favorites.objects.filter(user=user, recipe=recipe)
         if favorite.exists():
-            favorite.delete()
+            with transaction.atomic():
+                deleted, _ = favorite.delete()
+                Recipes.objects.filter(pk=recipe.pk).increment(
+                    favorites_count=-deleted)
+            bump_user_state_version(user.pk)
             return Response(status=status.HTTP_204_NO_CONTENT)
         return Response(status=status.HTTP_400_BAD_REQUEST)
 
@@ -94,8 +188,12 @@ class RecipeViewSet(viewsets.ModelViewSet):
                 {"error": "Этот рецепт уже в корзине покупок"},
                 status=status.HTTP_400_BAD_REQUEST,
             )
-        shoping_cart = Cart.objects.create(user=user,
-                                           recipe=recipe)
+        with transaction.atomic():
+            shoping_cart = Cart.objects.create(user=user,
+                                               recipe=recipe)
+            CartIngredientTotal.objects.add_recipe(user, recipe)
+            Recipes.objects.filter(pk=recipe.pk).increment(in_carts_count=1)
+        bump_user_state_version(user.pk)
         serializer = ShoppingListSerializer(
             shoping_cart, context={"request": request}
         )
@@ -108,23 +206,61 @@ class RecipeViewSet(viewsets.ModelViewSet):
         delete_shoping_cart = Cart.objects.filter(user=user,
                                                   recipe=recipe)
         if delete_shoping_cart.exists():
-            delete_shoping_cart.delete()
+            with transaction.atomic():
+                CartIngredientTotal.objects.remove_recipe(user, recipe)
+                deleted, _ = delete_shoping_cart.delete()
+                Recipes.objects.filter(pk=recipe.pk).increment(
+                    in_carts_count=-deleted)
+            bump_user_state_version(user.pk)
             return Response(status=status.HTTP_204_NO_CONTENT)
         return Response(status=status.HTTP_400_BAD_REQUEST)
 
+    @action(detail=True, methods=["GET"])
+    def similar(self, request, pk=None):
+        """Похожие рецепты из заранее посчитанных соседей."""
+        recipe = get_object_or_404(Recipes, pk=pk)
+        entries = SimilarRecipe.objects.filter(recipe=recipe).select_related(
+            'similar').order_by('-score')
+        serializer = ShortRecipeSerializer(
+            [entry.similar for entry in entries],
+            many=True, context={'request': request})
+        return Response(serializer.data)
+
     @action(detail=False, methods=["GET"],
             permission_classes=[permissions.IsAuthenticated])
+    def feed(self, request):
+        """Рецепты авторов из подписок, новые сначала, по курсору."""
+        paginator = RecipeCursorPagination()
+        recipes = Recipes.objects.for_list(request.user)
+        if TimelineEntry.objects.enabled():
+            entries = paginator.paginate_queryset(
+                TimelineEntry.objects.filter(user=request.user),
+                request, view=self)
+            by_id = recipes.in_bulk([entry.recipe_id for entry in entries])
+            page = [by_id[entry.recipe_id] for entry in entries
+                    if entry.recipe_id in by_id]
+        else:
+            page = paginator.paginate_queryset(
+                recipes.followed_by(request.user), request, view=self)
+        serializer = self.get_serializer(page, many=True)
+        return paginator.get_paginated_response(serializer.data)
+
+    @action(detail=False, methods=["GET"],
+            permission_classes=[permissions.IsAuthenticated],
+            content_negotiation_class=ShoppingListNegotiation)
     def download_shopping_cart(self, request):
-        response = HttpResponse([f'{item["ingredient__name"]}'
-                                 f' - {item["amount"]} '
-                                 f'{item["ingredient__measurement_unit"]} \n'
-                                 for item in RecipeIngridient.objects.filter(
-                                     recipe__shopping_cart__user=request.user
-                                 ).values(
-                                     'ingredient__name',
-                                     'ingredient__measurement_unit'
-                                 ).annotate(amount=Sum('amount'))],
-                                'Content-Type: text/plain')
-        response['Content-Disposition'] = ('attachment; '
-                                           'filename="buylist.txt"')
+        file_format = request.query_params.get(FORMAT_PARAM, DEFAULT_FORMAT)
+        if file_format not in RENDERERS:
+            return Response(
+                {"error": f"Доступные форматы: {', '.join(RENDERERS)}"},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        render, content_type = RENDERERS[file_format]
+        response = StreamingHttpResponse(
+            render(shopping_list_items(request.user)),
+            content_type=content_type,
+        )
+        response['Content-Disposition'] = (f'attachment; '
+                                           f'filename="{FILENAME}.'
+                                           f'{file_format}"')
         return response
@@ -1,7 +1,32 @@
+"""
+ASGI config for backend project.
+
+Under ASGI the read endpoints run as async views that execute the ORM
+in a thread pool (see ``api.async_views``), so one worker overlaps
+database round trips of concurrent requests.
+"""
+
 import os
+import threading
 
 from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'backend_foodgram.settings')
+os.environ.setdefault('ASYNC_READ_VIEWS', 'True')
 
 application = get_asgi_application()
+
+from recipes.matching import recipe_matcher  # noqa: E402
+from recipes.search import ingredient_search  # noqa: E402
+
+
+def warm():
+    ingredient_search.warm()
+    recipe_matcher.warm()
+
+
+# uvicorn импортирует приложение уже внутри цикла событий, где ORM
+# запрещен, поэтому индексы строятся в отдельном потоке.
+warmer = threading.Thread(target=warm, name='warm-indexes')
+warmer.start()
+warmer.join()
@@ -1,4 +1,5 @@
 import os
+import tempfile
 from pathlib import Path
 
 from dotenv import load_dotenv
@@ -37,6 +38,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'api.metrics.MetricsMiddleware',
+    'api.profiling.ProfilingMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -66,6 +69,11 @@ TEMPLATES = [
 
 WSGI_APPLICATION = 'backend_foodgram.wsgi.application'
 
+# Включается в asgi.py: чтение выполняется async-представлениями
+# в пуле из ASYNC_READ_VIEWS_THREADS потоков.
+ASYNC_READ_VIEWS = os.getenv('ASYNC_READ_VIEWS', 'False') == 'True'
+ASYNC_READ_VIEWS_THREADS = int(os.getenv('ASYNC_READ_VIEWS_THREADS', 8))
+
 if DEBUG:
     DATABASES = {
         'default': {
@@ -89,6 +97,69 @@ else:
         }
     }
 
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.getenv(
+            'CACHE_LOCATION',
+            str(Path(tempfile.gettempdir()) / 'foodgram_cache')
+        ),
+    }
+}
+
+CATALOG_CACHE_TIMEOUT = 60 * 60 * 24
+
+# Доля профилируемых запросов (0 - middleware отключен); включается в
+# окружении, например PROFILING_SAMPLE_RATE=0.01.
+PROFILING_SAMPLE_RATE = float(os.getenv('PROFILING_SAMPLE_RATE', 0))
+PROFILING_DUPLICATE_THRESHOLD = 3
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'formatters': {
+        'message': {'format': '%(message)s'},
+    },
+    'handlers': {
+        'console': {
+            'class': 'logging.StreamHandler',
+            'formatter': 'message',
+        },
+    },
+    'loggers': {
+        'api.profiling': {
+            'handlers': ['console'],
+            'level': 'INFO',
+            'propagate': False,
+        },
+    },
+}
+
+# Метрики Prometheus на /api/metrics/; воркеры gunicorn пишут их в
+# METRICS_DIR.
+METRICS_ENABLED = os.getenv('METRICS_ENABLED', 'False') == 'True'
+METRICS_DIR = os.getenv(
+    'METRICS_DIR', str(Path(tempfile.gettempdir()) / 'foodgram_metrics'))
+METRICS_FLUSH_INTERVAL = 1.0
+# Файлы завершившихся воркеров удаляются через METRICS_RETENTION секунд.
+METRICS_RETENTION = 60 * 60
+# Токен для Authorization: Bearer; без него эндпоинт доступен только staff.
+METRICS_TOKEN = os.getenv('METRICS_TOKEN', '')
+
+# Лента подписок: read - выборка по подпискам при чтении, write - разнос
+# рецептов по лентам подписчиков при публикации (после переключения
+# выполнить manage.py rebuild_timeline).
+FEED_STRATEGY = os.getenv('FEED_STRATEGY', 'read')
+
+# Период полураспада оценки популярности (?ordering=popular), часов.
+POPULARITY_HALF_LIFE_HOURS = float(
+    os.getenv('POPULARITY_HALF_LIFE_HOURS', 72))
+
+AUTH_TOKEN_CACHE_SIZE = 1024
+AUTH_TOKEN_CACHE_TTL = 5 * 60
+# Как часто процесс сверяет версию отзыва токенов с БД, секунд.
+AUTH_REVOCATION_CHECK_INTERVAL = 5
+
 
 AUTH_PASSWORD_VALIDATORS = [
     {
@@ -121,9 +192,14 @@ STATIC_ROOT = BASE_DIR / 'collected_static'
 MEDIA_URL = '/media/'
 MEDIA_ROOT = BASE_DIR / 'media'
 
+RECIPE_IMAGE_VARIANTS_ASYNC = True
+
+# Соседи измененного рецепта пересчитываются в фоновом потоке.
+SIMILAR_RECIPES_ASYNC = True
+
 REST_FRAMEWORK = {
     "DEFAULT_AUTHENTICATION_CLASSES": [
-        "rest_framework.authentication.TokenAuthentication",
+        "users.authentication.CachedTokenAuthentication",
     ],
     "DEFAULT_PERMISSION_CLASSES": [
         "rest_framework.permissions.IsAuthenticatedOrReadOnly",
@@ -134,6 +210,10 @@ REST_FRAMEWORK = {
     'DEFAULT_PAGINATION_CLASS':
         'rest_framework.pagination.PageNumberPagination',
     'PAGE_SIZE': 6,
+    'DEFAULT_RENDERER_CLASSES': [
+        'api.profiling.ProfilingJSONRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+    ],
 }
 
 DJOSER = {
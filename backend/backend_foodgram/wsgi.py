@@ -14,3 +14,9 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'backend_foodgram.settings')
 
 application = get_wsgi_application()
+
+from recipes.matching import recipe_matcher  # noqa: E402
+from recipes.search import ingredient_search  # noqa: E402
+
+ingredient_search.warm()
+recipe_matcher.warm()
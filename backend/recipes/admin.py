@@ -1,7 +1,11 @@
 from django.contrib import admin
+from django.db import transaction
 
-from .models import (Cart, Favorites, Ingredients, RecipeIngridient, Recipes,
-                     RecipeTag, Tag)
+from .images import schedule_variants
+from .matching import recipes_changed
+from .models import (Cart, CartIngredientTotal, Favorites, Ingredients,
+                     RecipeIngridient, Recipes, RecipeTag, Tag)
+from .similarity import schedule_similar
 
 
 @admin.register(Tag)
@@ -26,12 +30,53 @@ class RecipeTagsInline(admin.TabularInline):
 
 @admin.register(Recipes)
 class AdminRecipe(admin.ModelAdmin):
-    list_display = ('id', 'name', 'author', 'favorites')
+    list_display = ('id', 'name', 'author', 'favorites_count')
     list_filter = ['name', 'author', 'tags']
+    list_select_related = ('author',)
     inlines = (RecipeIngredientsInline, RecipeTagsInline)
 
-    def favorites(self, obj):
-        return obj.favorites.all().count()
+    def save_model(self, request, obj, form, change):
+        """Новой картинке нужны свои варианты."""
+        image_changed = 'image' in form.changed_data
+        if image_changed:
+            obj.image_variants_ready = False
+        super().save_model(request, obj, form, change)
+        if image_changed:
+            schedule_variants(obj.image.name)
+
+    def save_related(self, request, form, formsets, change):
+        """Правка ингредиентов в инлайне переносится в итоги корзин, в
+        индекс «из того, что есть» и в похожие рецепты."""
+        recipe = form.instance
+        old_amounts = (CartIngredientTotal.objects.recipe_amounts(recipe)
+                       if change else {})
+        old_tags = set(recipe.tags.values_list('pk', flat=True)
+                       if change else ())
+        super().save_related(request, form, formsets, change)
+        new_amounts = CartIngredientTotal.objects.recipe_amounts(recipe)
+        CartIngredientTotal.objects.change_recipe(
+            recipe, old_amounts, new_amounts)
+        ingredients_changed = old_amounts.keys() != new_amounts.keys()
+        if ingredients_changed:
+            recipes_changed([recipe.pk])
+        if ingredients_changed or old_tags != set(
+                recipe.tags.values_list('pk', flat=True)):
+            schedule_similar(recipe.pk)
+
+    def delete_model(self, request, obj):
+        with transaction.atomic():
+            CartIngredientTotal.objects.delete_recipe(obj)
+            recipes_changed([obj.pk])
+            super().delete_model(request, obj)
+
+    def delete_queryset(self, request, queryset):
+        with transaction.atomic():
+            recipe_ids = []
+            for recipe in queryset:
+                CartIngredientTotal.objects.delete_recipe(recipe)
+                recipe_ids.append(recipe.pk)
+            recipes_changed(recipe_ids)
+            super().delete_queryset(request, queryset)
 
 
 @admin.register(Favorites)
@@ -42,3 +87,19 @@ class AdminFavorite(admin.ModelAdmin):
 @admin.register(Cart)
 class AdminCart(admin.ModelAdmin):
     list_display = ('id', 'user', 'recipe')
+
+    def save_model(self, request, obj, form, change):
+        super().save_model(request, obj, form, change)
+        users = [obj.user_id]
+        if change and 'user' in form.changed_data:
+            users.append(form.initial['user'])
+        CartIngredientTotal.objects.rebuild(users=users)
+
+    def delete_model(self, request, obj):
+        super().delete_model(request, obj)
+        CartIngredientTotal.objects.rebuild(users=[obj.user_id])
+
+    def delete_queryset(self, request, queryset):
+        users = list(queryset.values_list('user_id', flat=True))
+        super().delete_queryset(request, queryset)
+        CartIngredientTotal.objects.rebuild(users=users)
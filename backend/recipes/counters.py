@@ -0,0 +1,40 @@
+from django.contrib.auth import get_user_model
+from django.db.models import Count, F, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from users.models import Follow
+from .models import Cart, Favorites, Recipes
+
+User = get_user_model()
+
+# (модель со счетчиком, поле счетчика, считаемая модель, поле связи)
+COUNTERS = (
+    (Recipes, 'favorites_count', Favorites, 'recipe'),
+    (Recipes, 'in_carts_count', Cart, 'recipe'),
+    (User, 'recipes_count', Recipes, 'author'),
+    (User, 'followers_count', Follow, 'following'),
+    (User, 'following_count', Follow, 'user'),
+)
+
+
+def count_of(model, field):
+    return Coalesce(Subquery(
+        model.objects.filter(**{field: OuterRef('pk')}).order_by().values(
+            field).annotate(total=Count('pk')).values('total')
+    ), 0)
+
+
+def reconcile_counters():
+    """Исправляет расхождения счетчиков, возвращает {счетчик: строк}."""
+    fixed = {}
+    for model, counter, counted, field in COUNTERS:
+        drifted = model.objects.annotate(
+            actual=count_of(counted, field)
+        ).exclude(**{counter: F('actual')}).values_list('pk', flat=True)
+        updates = {counter: count_of(counted, field)}
+        if model is Recipes:
+            updates['updated_at'] = timezone.now()
+        fixed[f'{model.__name__}.{counter}'] = model.objects.filter(
+            pk__in=drifted).update(**updates)
+    return fixed
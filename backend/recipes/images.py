@@ -0,0 +1,152 @@
+import hashlib
+import io
+import logging
+import re
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import PurePosixPath
+
+from django.apps import apps
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import FileSystemStorage
+from django.db import connection, transaction
+from django.utils.deconstruct import deconstructible
+from PIL import Image, ImageOps
+
+logger = logging.getLogger(__name__)
+
+UPLOAD_TO = 'recipes'
+VARIANTS_DIR = 'variants'
+VARIANTS = {
+    'thumbnail': (160, 160),
+    'card': (480, 360),
+}
+WEBP_QUALITY = 80
+HASH_NAME = re.compile(r'^[0-9a-f]{64}$')
+SIGNATURES = (
+    (b'\x89PNG\r\n\x1a\n', 'png'),
+    (b'\xff\xd8\xff', 'jpg'),
+    (b'GIF87a', 'gif'),
+    (b'GIF89a', 'gif'),
+)
+
+executor = ThreadPoolExecutor(max_workers=1,
+                              thread_name_prefix='recipe-images')
+
+
+def content_hash(content):
+    return hashlib.sha256(content).hexdigest()
+
+
+def image_extension(content):
+    """Расширение по сигнатуре файла, без декодирования картинки."""
+    for signature, extension in SIGNATURES:
+        if content.startswith(signature):
+            return extension
+    if content[:4] == b'RIFF' and content[8:12] == b'WEBP':
+        return 'webp'
+    return None
+
+
+@deconstructible
+class ContentAddressedStorage(FileSystemStorage):
+    """Файлы с именем-хэшем содержимого сохраняются один раз.
+
+    Повторная загрузка того же файла возвращает уже сохраненное имя,
+    остальные файлы сохраняются как в FileSystemStorage.
+    """
+
+    @staticmethod
+    def is_hashed(name):
+        return bool(HASH_NAME.match(PurePosixPath(name).stem))
+
+    def get_available_name(self, name, max_length=None):
+        if self.is_hashed(name):
+            return name
+        return super().get_available_name(name, max_length)
+
+    def _save(self, name, content):
+        if self.is_hashed(name) and self.exists(name):
+            return name
+        return super()._save(name, content)
+
+
+recipe_image_storage = ContentAddressedStorage()
+
+
+def find_stored(digest):
+    """Имя уже сохраненного оригинала с таким хэшем или None."""
+    for extension in ('png', 'jpg', 'jpeg', 'gif', 'webp'):
+        name = f'{UPLOAD_TO}/{digest}.{extension}'
+        if recipe_image_storage.exists(name):
+            return name
+    return None
+
+
+def variant_name(name, variant):
+    stem = PurePosixPath(name).stem
+    return f'{UPLOAD_TO}/{VARIANTS_DIR}/{stem}_{variant}.webp'
+
+
+def variant_urls(name, ready):
+    """URL вариантов без обращения к хранилищу; пока варианты не готовы,
+    отдается оригинал."""
+    if not ready:
+        original = recipe_image_storage.url(name)
+        return {variant: original for variant in VARIANTS}
+    return {variant: recipe_image_storage.url(variant_name(name, variant))
+            for variant in VARIANTS}
+
+
+def build_variants(name):
+    """Создает недостающие WebP-варианты картинки, возвращает их число."""
+    missing = [variant for variant in VARIANTS
+               if not recipe_image_storage.exists(variant_name(name, variant))]
+    if not missing or not recipe_image_storage.exists(name):
+        return 0
+    with recipe_image_storage.open(name) as file:
+        image = ImageOps.exif_transpose(Image.open(file))
+        image.load()
+    if image.mode not in ('RGB', 'RGBA'):
+        image = image.convert('RGBA')
+    for variant in missing:
+        resized = image.copy()
+        resized.thumbnail(VARIANTS[variant])
+        buffer = io.BytesIO()
+        resized.save(buffer, 'WEBP', quality=WEBP_QUALITY)
+        recipe_image_storage.save(variant_name(name, variant),
+                                  ContentFile(buffer.getvalue()))
+    return len(missing)
+
+
+def mark_variants_ready(name):
+    """Отмечает готовность вариантов у всех рецептов с этой картинкой,
+    если все варианты есть в хранилище."""
+    if not all(recipe_image_storage.exists(variant_name(name, variant))
+               for variant in VARIANTS):
+        return
+    apps.get_model('recipes', 'Recipes').objects.filter(
+        image=name, image_variants_ready=False).mark_variants_ready()
+
+
+def build_variants_safely(name, background=False):
+    try:
+        build_variants(name)
+        mark_variants_ready(name)
+    except Exception:
+        logger.exception('не удалось создать варианты картинки %s', name)
+    finally:
+        if background:
+            connection.close()
+
+
+def schedule_variants(name):
+    """Создает варианты после коммита: в фоне или сразу, если
+    RECIPE_IMAGE_VARIANTS_ASYNC выключен."""
+    if not name:
+        return
+    if getattr(settings, 'RECIPE_IMAGE_VARIANTS_ASYNC', True):
+        transaction.on_commit(lambda: executor.submit(
+            build_variants_safely, name, background=True))
+    else:
+        transaction.on_commit(lambda: build_variants_safely(name))
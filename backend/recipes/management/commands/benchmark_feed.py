@@ -0,0 +1,110 @@
+import statistics
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+
+from recipes.models import Recipes, TimelineEntry
+from users.models import Follow, User
+
+FOLLOWS = (10, 50, 200)
+RECIPES_PER_AUTHOR = 5
+PAGE_SIZE = 10
+REPEATS = 20
+
+
+def median_ms(function, repeats):
+    timings = []
+    for _ in range(repeats):
+        started = time.perf_counter()
+        function()
+        timings.append((time.perf_counter() - started) * 1000)
+    return statistics.median(timings)
+
+
+class Command(BaseCommand):
+    help = ('сравнение ленты подписок при чтении (read) и с разносом при '
+            'записи (write) по мере роста числа подписок; данные создаются '
+            'во временной транзакции и откатываются')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--follows', type=int, nargs='+',
+                            default=FOLLOWS,
+                            help='число авторов, на которых подписан '
+                                 'каждый читатель (и подписчиков автора)')
+        parser.add_argument('--recipes', type=int,
+                            default=RECIPES_PER_AUTHOR)
+        parser.add_argument('--repeats', type=int, default=REPEATS)
+
+    def handle(self, *args, **options):
+        self.stdout.write(
+            f'{"подписок":>9}{"read, мс":>10}{"write, мс":>11}'
+            f'{"публикация write, мс":>22}{"строк ленты":>13}')
+        for follows in options['follows']:
+            with transaction.atomic():
+                result = self.measure(follows, options['recipes'],
+                                      options['repeats'])
+                transaction.set_rollback(True)
+            self.stdout.write(
+                f'{follows:>9}{result["read"]:>10.2f}{result["write"]:>11.2f}'
+                f'{result["publish"]:>22.2f}{result["rows"]:>13}')
+
+    @staticmethod
+    def measure(follows, recipes_per_author, repeats):
+        """follows читателей подписаны на follows авторов, у каждого
+        автора recipes_per_author рецептов."""
+        prefix = f'feed_bench_{follows}'
+        users = User.objects.bulk_create(
+            User(username=f'{prefix}_{index}',
+                 email=f'{prefix}_{index}@bench.local')
+            for index in range(2 * follows))
+        if users[0].pk is None:
+            users = list(User.objects.filter(
+                username__startswith=f'{prefix}_').order_by('id'))
+        authors, readers = users[:follows], users[follows:]
+        now = timezone.now()
+        recipes = Recipes.objects.bulk_create(
+            Recipes(author=author, name=f'{prefix}_{index}', text='text',
+                    cooking_time=1, image='recipes/bench.png',
+                    pub_date=now - timezone.timedelta(
+                        minutes=author_index * recipes_per_author + index))
+            for author_index, author in enumerate(authors)
+            for index in range(recipes_per_author))
+        if recipes[0].pk is None:
+            recipes = list(Recipes.objects.filter(
+                name__startswith=f'{prefix}_'))
+        Follow.objects.bulk_create(
+            Follow(user=reader, following=author)
+            for reader in readers for author in authors)
+        TimelineEntry.objects.bulk_create(
+            (TimelineEntry(user=reader, recipe=recipe,
+                           author_id=recipe.author_id,
+                           pub_date=recipe.pub_date)
+             for reader in readers for recipe in recipes),
+            batch_size=5000)
+        reader = readers[0]
+
+        def read_on_read():
+            list(Recipes.objects.followed_by(reader).order_by(
+                '-pub_date', '-id').values_list('id', flat=True)[:PAGE_SIZE])
+
+        def read_on_write():
+            list(TimelineEntry.objects.filter(user=reader).order_by(
+                '-pub_date', '-id').values_list(
+                    'recipe_id', flat=True)[:PAGE_SIZE])
+
+        def publish():
+            with transaction.atomic():
+                recipe = Recipes.objects.create(
+                    author=authors[0], name=f'{prefix}_new', text='text',
+                    cooking_time=1, image='recipes/bench.png')
+                TimelineEntry.objects.fan_out(recipe)
+                transaction.set_rollback(True)
+
+        return {
+            'read': median_ms(read_on_read, repeats),
+            'write': median_ms(read_on_write, repeats),
+            'publish': median_ms(publish, repeats),
+            'rows': TimelineEntry.objects.filter(user=reader).count(),
+        }
@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+
+from recipes.images import build_variants, mark_variants_ready
+from recipes.models import Recipes
+
+
+class Command(BaseCommand):
+    help = 'создание недостающих WebP-вариантов картинок рецептов'
+
+    def handle(self, *args, **options):
+        names = Recipes.objects.exclude(image='').values_list(
+            'image', flat=True).distinct().order_by()
+        created = 0
+        for name in names.iterator():
+            created += build_variants(name)
+            mark_variants_ready(name)
+        self.stdout.write(self.style.SUCCESS(
+            f'создано вариантов: {created}'))
@@ -0,0 +1,20 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from recipes.similarity import BATCH_SIZE, TOP_K, rebuild_similar
+
+
+class Command(BaseCommand):
+    help = 'пересчет похожих рецептов (top-K соседей) для всех рецептов'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--top', type=int, default=TOP_K)
+        parser.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        stored = rebuild_similar(options['top'], options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(
+            f'сохранено соседей: {stored} '
+            f'за {time.perf_counter() - started:.2f} с'))
@@ -0,0 +1,106 @@
+import csv
+import io
+import json
+import time
+from pathlib import Path
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+
+from recipes.models import NAME_MAX_LENGHT, Ingredients
+from recipes.versions import bump_catalog_version
+
+DEFAULT_FILE = Path(settings.BASE_DIR).resolve() / 'data' / 'ingredients.csv'
+FORMATS = ('csv', 'json')
+BATCH_SIZE = 5000
+
+
+def read_csv(file):
+    for row in csv.reader(file):
+        if len(row) >= 2:
+            yield row[0], row[1]
+
+
+def read_json(file):
+    for item in json.load(file):
+        yield item['name'], item['measurement_unit']
+
+
+READERS = {'csv': read_csv, 'json': read_json}
+
+
+class Command(BaseCommand):
+    help = ('загрузка в БД ингридиентов из csv или json; '
+            'уже существующие пары (название, единица) пропускаются')
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', nargs='?', default=str(DEFAULT_FILE))
+        parser.add_argument('--format', choices=FORMATS,
+                            help='по умолчанию - по расширению файла')
+        parser.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+
+    def handle(self, *args, **options):
+        path = Path(options['path'])
+        file_format = options['format'] or path.suffix.lstrip('.').lower()
+        if file_format not in READERS:
+            raise CommandError(f'неизвестный формат файла: {path.name}')
+        started = time.perf_counter()
+        with open(path, 'r', encoding='UTF-8') as file:
+            rows = self.clean(READERS[file_format](file))
+        with transaction.atomic():
+            if connection.vendor == 'postgresql':
+                created = self.copy_upsert(rows)
+            else:
+                created = self.bulk_upsert(rows, options['batch_size'])
+        bump_catalog_version()
+        elapsed = time.perf_counter() - started
+        self.stdout.write(self.style.SUCCESS(
+            f'прочитано {len(rows)}, добавлено {created} за {elapsed:.2f} с '
+            f'({len(rows) / elapsed:.0f} строк/с)'))
+
+    @staticmethod
+    def clean(rows):
+        unique = {}
+        for name, unit in rows:
+            name, unit = name.strip(), unit.strip()
+            if name:
+                unique[name[:NAME_MAX_LENGHT], unit[:NAME_MAX_LENGHT]] = None
+        return list(unique)
+
+    @staticmethod
+    def copy_upsert(rows):
+        """COPY во временную таблицу и вставка только новых пар."""
+        table = Ingredients._meta.db_table
+        buffer = io.StringIO()
+        csv.writer(buffer).writerows(rows)
+        buffer.seek(0)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'CREATE TEMP TABLE ingredients_staging '
+                '(name varchar(200), measurement_unit varchar(200)) '
+                'ON COMMIT DROP'
+            )
+            cursor.copy_expert(
+                'COPY ingredients_staging (name, measurement_unit) '
+                'FROM STDIN WITH (FORMAT csv)', buffer)
+            cursor.execute(
+                f'INSERT INTO {table} (name, measurement_unit) '
+                f'SELECT s.name, s.measurement_unit '
+                f'FROM ingredients_staging s '
+                f'WHERE NOT EXISTS (SELECT 1 FROM {table} i '
+                f'WHERE i.name = s.name '
+                f'AND i.measurement_unit = s.measurement_unit)'
+            )
+            return cursor.rowcount
+
+    @staticmethod
+    def bulk_upsert(rows, batch_size):
+        existing = set(Ingredients.objects.values_list(
+            'name', 'measurement_unit').iterator())
+        created = Ingredients.objects.bulk_create(
+            (Ingredients(name=name, measurement_unit=unit)
+             for name, unit in rows if (name, unit) not in existing),
+            batch_size=batch_size,
+        )
+        return len(created)
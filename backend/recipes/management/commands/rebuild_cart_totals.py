@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand
+
+from recipes.models import CartIngredientTotal
+
+
+class Command(BaseCommand):
+    help = 'пересчет итогов списков покупок с нуля'
+
+    def handle(self, *args, **options):
+        created = CartIngredientTotal.objects.rebuild()
+        self.stdout.write(self.style.SUCCESS(
+            f'пересчитано строк итогов: {created}'))
@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand
+
+from recipes.models import TimelineEntry
+
+
+class Command(BaseCommand):
+    help = 'заполнение лент подписок (FEED_STRATEGY=write) с нуля'
+
+    def handle(self, *args, **options):
+        created = TimelineEntry.objects.rebuild()
+        self.stdout.write(self.style.SUCCESS(
+            f'записей в лентах: {created}'))
@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+
+from recipes.popularity import refresh_popularity
+
+
+class Command(BaseCommand):
+    help = ('пересчет популярности рецептов по добавлениям в избранное и '
+            'списки покупок с затуханием; запускается периодически (cron)')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--half-life', type=float,
+                            help='период полураспада в часах, по умолчанию '
+                                 'POPULARITY_HALF_LIFE_HOURS')
+
+    def handle(self, *args, **options):
+        scored = refresh_popularity(half_life_hours=options['half_life'])
+        self.stdout.write(self.style.SUCCESS(
+            f'рецептов с оценкой: {scored}'))
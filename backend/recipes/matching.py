@@ -0,0 +1,202 @@
+import threading
+import time
+
+import numpy as np
+from django.db import DatabaseError, transaction
+
+from recipes.models import IngredientIndexChange, RecipeIngridient
+from recipes.versions import bump_version, get_version
+
+INDEX_VERSION_KEY = 'recipe_ingredients:version'
+MAX_PATCH_VERSIONS = 100
+REBUILD_INTERVAL = 10 * 60
+# Больше рецептов фильтр не передает в SQL (pk__in и CASE по id), ответ
+# тогда несет заголовок MATCH_TRUNCATED_HEADER с этим пределом.
+MATCH_LIMIT = 10_000
+MATCH_TRUNCATED_HEADER = 'X-Results-Truncated'
+
+
+class RecipeIngredientIndex:
+    """Неизменяемый инвертированный индекс ингредиент -> позиции рецептов.
+
+    Списки позиций - отсортированные массивы NumPy, число ингредиентов
+    рецепта хранится в sizes. Покрытие набора продуктов считается
+    bincount по спискам только этих ингредиентов.
+    """
+
+    def __init__(self, recipe_ids, postings, sizes):
+        self.recipe_ids = recipe_ids
+        self.postings = postings
+        self.sizes = sizes
+        self.positions = {recipe_id: position for position, recipe_id
+                          in enumerate(recipe_ids.tolist())}
+
+    @classmethod
+    def from_pairs(cls, pairs):
+        """Индекс из пар (id рецепта, id ингредиента)."""
+        pairs = np.unique(np.asarray(pairs, dtype=np.int64).reshape(-1, 2),
+                          axis=0)
+        recipe_ids, positions = np.unique(pairs[:, 0], return_inverse=True)
+        order = np.lexsort((positions, pairs[:, 1]))
+        ingredients, starts = np.unique(pairs[order, 1], return_index=True)
+        postings = dict(zip(ingredients.tolist(),
+                            np.split(positions[order], starts[1:])))
+        sizes = np.bincount(positions, minlength=len(recipe_ids))
+        return cls(recipe_ids, postings, sizes)
+
+    @classmethod
+    def from_db(cls):
+        # Ингредиент удаляется с SET_NULL: такие строки в индекс не входят.
+        return cls.from_pairs(list(RecipeIngridient.objects.filter(
+            ingredient__isnull=False).values_list(
+                'recipe_id', 'ingredient_id').iterator()))
+
+    def patched(self, recipes):
+        """Новый индекс, где ингредиенты рецептов заменены на
+        {id рецепта: множество id ингредиентов}; пустое - рецепт удален."""
+        recipe_ids = self.recipe_ids
+        sizes = self.sizes.copy()
+        postings = dict(self.postings)
+        new_ids = [recipe_id for recipe_id, ingredients in recipes.items()
+                   if ingredients and recipe_id not in self.positions]
+        if new_ids:
+            recipe_ids = np.concatenate(
+                (recipe_ids, np.array(new_ids, dtype=np.int64)))
+            sizes = np.concatenate(
+                (sizes, np.zeros(len(new_ids), dtype=sizes.dtype)))
+        positions = {**self.positions, **{
+            recipe_id: len(self.recipe_ids) + offset
+            for offset, recipe_id in enumerate(new_ids)}}
+        for recipe_id, ingredients in recipes.items():
+            position = positions.get(recipe_id)
+            if position is None:
+                continue
+            old = {ingredient for ingredient, posting in postings.items()
+                   if self.contains(posting, position)}
+            for ingredient in old - ingredients:
+                posting = postings[ingredient]
+                postings[ingredient] = posting[posting != position]
+            for ingredient in ingredients - old:
+                posting = postings.get(
+                    ingredient, np.empty(0, dtype=np.int64))
+                postings[ingredient] = np.insert(
+                    posting, np.searchsorted(posting, position), position)
+            sizes[position] = len(ingredients)
+        return type(self)(recipe_ids, postings, sizes)
+
+    @staticmethod
+    def contains(posting, position):
+        found = np.searchsorted(posting, position)
+        return found < len(posting) and posting[found] == position
+
+    def coverage(self, ingredient_ids):
+        """Сколько ингредиентов из набора есть в каждом рецепте."""
+        lists = [self.postings[ingredient] for ingredient in
+                 set(ingredient_ids) if ingredient in self.postings]
+        if not lists:
+            return np.zeros(len(self.recipe_ids), dtype=np.int64)
+        return np.bincount(np.concatenate(lists),
+                           minlength=len(self.recipe_ids))
+
+    def match(self, ingredient_ids, missing=0, limit=MATCH_LIMIT):
+        """Рецепты, где из набора нет не больше missing ингредиентов,
+        по убыванию доли покрытия, затем по числу недостающих.
+
+        Возвращает [(id рецепта, покрыто, не хватает), ...].
+        """
+        covered = self.coverage(ingredient_ids)
+        lacking = self.sizes - covered
+        found = np.flatnonzero((covered > 0) & (lacking <= missing))
+        ratio = covered[found] / self.sizes[found]
+        found = found[np.lexsort((lacking[found], -ratio))][:limit]
+        return list(zip(self.recipe_ids[found].tolist(),
+                        covered[found].tolist(), lacking[found].tolist()))
+
+
+def index_version():
+    return get_version(INDEX_VERSION_KEY)
+
+
+def recipes_changed(recipe_ids):
+    """Отмечает рецепты, чьи ингредиенты изменились, для всех процессов."""
+    recipe_ids = list(recipe_ids)
+
+    def publish():
+        version = bump_version(INDEX_VERSION_KEY)
+        IngredientIndexChange.objects.create(version=version,
+                                             recipe_ids=recipe_ids)
+        IngredientIndexChange.objects.filter(
+            version__lte=version - MAX_PATCH_VERSIONS).delete()
+        recipe_matcher.apply_pending()
+
+    transaction.on_commit(publish)
+
+
+class RecipeMatcher:
+    """Индекс на процесс: догоняет изменения из журнала в БД, а если
+    журнал неполон или индекс старше REBUILD_INTERVAL - строится заново."""
+
+    def __init__(self):
+        self._index = None
+        self._version = None
+        self._built = 0.0
+        self._lock = threading.Lock()
+
+    def invalidate(self):
+        self._index = None
+
+    def get_index(self):
+        index = self._index
+        version = index_version()
+        if (index is not None and self._version == version
+                and not self.expired()):
+            return index
+        with self._lock:
+            if self._index is index:
+                self._update(version)
+            return self._index
+
+    def apply_pending(self):
+        if self._index is not None:
+            self.get_index()
+
+    def expired(self):
+        return time.monotonic() - self._built > REBUILD_INTERVAL
+
+    def _update(self, version):
+        stale = (self._index is None
+                 or self.expired()
+                 or version - self._version > MAX_PATCH_VERSIONS
+                 or version < self._version)
+        changed = set()
+        if not stale:
+            changes = list(IngredientIndexChange.objects.filter(
+                version__gt=self._version, version__lte=version,
+            ).values_list('recipe_ids', flat=True))
+            stale = len(changes) != version - self._version
+            for recipe_ids in changes:
+                changed.update(recipe_ids)
+        if stale:
+            self._index = RecipeIngredientIndex.from_db()
+            self._built = time.monotonic()
+        elif changed:
+            recipes = {recipe_id: set() for recipe_id in changed}
+            pairs = RecipeIngridient.objects.filter(
+                recipe_id__in=changed, ingredient__isnull=False,
+            ).values_list('recipe_id', 'ingredient_id')
+            for recipe_id, ingredient_id in pairs:
+                recipes[recipe_id].add(ingredient_id)
+            self._index = self._index.patched(recipes)
+        self._version = version
+
+    def warm(self):
+        try:
+            self.get_index()
+        except DatabaseError:
+            self.invalidate()
+
+    def match(self, ingredient_ids, missing=0, limit=MATCH_LIMIT):
+        return self.get_index().match(ingredient_ids, missing, limit)
+
+
+recipe_matcher = RecipeMatcher()
@@ -0,0 +1,54 @@
+# Generated by Django 3.2 on 2026-10-18 18:10
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Sum
+import django.db.models.deletion
+
+
+def fill_cart_totals(apps, schema_editor):
+    Cart = apps.get_model('recipes', 'Cart')
+    CartIngredientTotal = apps.get_model('recipes', 'CartIngredientTotal')
+    totals = Cart.objects.filter(
+        recipe__recipeingridient__ingredient__isnull=False
+    ).values(
+        'user', 'recipe__recipeingridient__ingredient'
+    ).annotate(amount=Sum('recipe__recipeingridient__amount')).order_by()
+    CartIngredientTotal.objects.bulk_create(
+        (CartIngredientTotal(
+            user_id=total['user'],
+            ingredient_id=total['recipe__recipeingridient__ingredient'],
+            amount=total['amount'])
+         for total in totals.iterator()),
+        batch_size=1000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('recipes', '0008_recipes_pub_date_cursor'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CartIngredientTotal',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('amount', models.PositiveIntegerField(verbose_name='кол-во')),
+                ('ingredient', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='cart_totals', to='recipes.ingredients', verbose_name='ингридиент')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='cart_totals', to=settings.AUTH_USER_MODEL, verbose_name='Пользователь')),
+            ],
+            options={
+                'verbose_name': 'Итог списка покупок',
+                'verbose_name_plural': 'Итоги списков покупок',
+                'default_related_name': 'cart_totals',
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='cartingredienttotal',
+            constraint=models.UniqueConstraint(fields=('user', 'ingredient'), name='unique_cart_ingredient_total'),
+        ),
+        migrations.RunPython(fill_cart_totals, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 3.2 on 2026-10-18 18:14
+
+from django.db import migrations, models
+import recipes.images
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipes', '0010_ingredient_name_unit_idx'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='recipes',
+            name='image',
+            field=models.ImageField(help_text='загрузите картинку', storage=recipes.images.ContentAddressedStorage(), upload_to='recipes', verbose_name='картинка'),
+        ),
+    ]
@@ -0,0 +1,63 @@
+# Generated by Django 3.2 on 2026-10-18 18:17
+
+import django.contrib.postgres.search
+from django.db import migrations
+
+SEARCH_VECTOR_SQL = (
+    "setweight(to_tsvector('russian', coalesce({row}name, '')), 'A') || "
+    "setweight(to_tsvector('russian', coalesce({row}text, '')), 'B')"
+)
+
+
+def create_search_trigger(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute(f'''
+        CREATE FUNCTION recipes_search_vector_update() RETURNS trigger AS $$
+        BEGIN
+            NEW.search_vector := {SEARCH_VECTOR_SQL.format(row='NEW.')};
+            RETURN NEW;
+        END
+        $$ LANGUAGE plpgsql
+    ''')
+    schema_editor.execute('''
+        CREATE TRIGGER recipes_search_vector_trigger
+        BEFORE INSERT OR UPDATE OF name, text ON recipes_recipes
+        FOR EACH ROW EXECUTE PROCEDURE recipes_search_vector_update()
+    ''')
+    schema_editor.execute(
+        f'UPDATE recipes_recipes '
+        f'SET search_vector = {SEARCH_VECTOR_SQL.format(row="")}'
+    )
+    schema_editor.execute(
+        'CREATE INDEX recipe_search_vector_idx '
+        'ON recipes_recipes USING gin (search_vector)'
+    )
+
+
+def drop_search_trigger(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute('DROP INDEX IF EXISTS recipe_search_vector_idx')
+    schema_editor.execute(
+        'DROP TRIGGER IF EXISTS recipes_search_vector_trigger '
+        'ON recipes_recipes'
+    )
+    schema_editor.execute(
+        'DROP FUNCTION IF EXISTS recipes_search_vector_update()')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipes', '0012_recipes_updated_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='recipes',
+            name='search_vector',
+            field=django.contrib.postgres.search.SearchVectorField(editable=False, null=True),
+        ),
+        migrations.RunPython(create_search_trigger, drop_search_trigger),
+    ]
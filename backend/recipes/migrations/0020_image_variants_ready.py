@@ -0,0 +1,18 @@
+# Generated by Django 3.2 on 2026-10-18 18:55
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipes', '0019_version_counter'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='recipes',
+            name='image_variants_ready',
+            field=models.BooleanField(default=False, editable=False, verbose_name='Варианты картинки готовы'),
+        ),
+    ]
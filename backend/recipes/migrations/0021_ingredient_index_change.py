@@ -0,0 +1,24 @@
+# Generated by Django 3.2 on 2026-10-18 18:58
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipes', '0020_image_variants_ready'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='IngredientIndexChange',
+            fields=[
+                ('version', models.PositiveBigIntegerField(primary_key=True, serialize=False, verbose_name='версия')),
+                ('recipe_ids', models.JSONField(verbose_name='рецепты')),
+            ],
+            options={
+                'verbose_name': 'Изменение индекса ингредиентов',
+                'verbose_name_plural': 'Изменения индекса ингредиентов',
+            },
+        ),
+    ]
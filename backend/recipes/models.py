@@ -1,9 +1,17 @@
-from datetime import datetime
-
 from django.contrib.auth import get_user_model
+from django.conf import settings
+from django.contrib.postgres.search import (SearchQuery, SearchRank,
+                                            SearchVectorField)
 from django.core.validators import MinValueValidator
-from django.db import models
+from django.db import connection, models, transaction
+from django.db.models import (Case, Exists, F, OuterRef, Prefetch, Q, Sum,
+                              Value, When, Window)
 from django.db.models.constraints import UniqueConstraint
+from django.db.models.functions import Greatest, RowNumber
+from django.utils import timezone
+
+from users.models import CounterQuerySet, Follow
+from .images import UPLOAD_TO, recipe_image_storage
 
 User = get_user_model()
 
@@ -11,6 +19,10 @@ NAME_MAX_LENGHT = SLUG_TAG_MAX_LENGHT = 200
 COLOR_TAG_MAX_LENGHT = 7
 MIN_INT_VALUE = 1
 ERROR_MESSAGE_MIN = 'укажите хоть какое-то кол-во'
+REBUILD_BATCH_SIZE = 1000
+SEARCH_CONFIG = 'russian'
+FEED_FAN_OUT_ON_READ = 'read'
+FEED_FAN_OUT_ON_WRITE = 'write'
 
 
 class Tag(models.Model):
@@ -51,6 +63,10 @@ class Ingredients(models.Model):
         verbose_name_plural = 'Ингредиенты'
         db_table = 'ingridients'
         default_related_name = 'ingrodients'
+        indexes = [
+            models.Index(fields=['name', 'measurement_unit'],
+                         name='ingredient_name_unit_idx'),
+        ]
 
     def __str__(self) -> str:
         return self.name
@@ -71,11 +87,112 @@ class RecipeTag(models.Model):
             UniqueConstraint(fields=['recipe', 'tag'],
                              name='unique_recipe_tag')
         ]
+        indexes = [
+            models.Index(fields=['tag', 'recipe'],
+                         name='recipe_tag_tag_recipe_idx'),
+        ]
 
     def __str__(self):
         return 'тэги рецепта'
 
 
+class RecipeQuerySet(CounterQuerySet):
+
+    def touch(self):
+        """Отмечает рецепты измененными без вызова save()."""
+        return self.update(updated_at=timezone.now())
+
+    def mark_variants_ready(self):
+        """Варианты картинки созданы: ссылки в ответе API меняются."""
+        return self.update(image_variants_ready=True,
+                           updated_at=timezone.now())
+
+    def increment(self, **deltas):
+        """Счетчики входят в ответ API, поэтому рецепт заодно отмечается
+        измененным: от updated_at зависят ETag и Last-Modified."""
+        return self.update(updated_at=timezone.now(), **{
+            field: Greatest(F(field) + delta, 0)
+            for field, delta in deltas.items()})
+
+    def with_user_flags(self, user):
+        """Флаги избранного, корзины и подписки одним запросом."""
+        if user is None or user.is_anonymous:
+            return self.annotate(
+                is_favorited=Value(False, models.BooleanField()),
+                is_in_shopping_cart=Value(False, models.BooleanField()),
+                author_is_subscribed=Value(False, models.BooleanField()),
+            )
+        return self.annotate(
+            is_favorited=Exists(Favorites.objects.filter(
+                user=user, recipe=OuterRef('pk'))),
+            is_in_shopping_cart=Exists(Cart.objects.filter(
+                user=user, recipe=OuterRef('pk'))),
+            author_is_subscribed=Exists(Follow.objects.filter(
+                user=user, following=OuterRef('author'))),
+        )
+
+    def search(self, query):
+        """Полнотекстовый поиск по названию и описанию, по релевантности.
+
+        В PostgreSQL используется search_vector с GIN-индексом, на других
+        СУБД (локальная разработка) - поиск подстроки.
+        """
+        if connection.vendor == 'postgresql':
+            search_query = SearchQuery(query, config=SEARCH_CONFIG,
+                                       search_type='websearch')
+            return self.filter(search_vector=search_query).annotate(
+                rank=SearchRank(F('search_vector'), search_query)
+            ).order_by('-rank', '-pub_date', '-id')
+        return self.filter(
+            Q(name__icontains=query) | Q(text__icontains=query)
+        ).annotate(
+            rank=Case(When(name__icontains=query, then=Value(1.0)),
+                      default=Value(0.5),
+                      output_field=models.FloatField())
+        ).order_by('-rank', '-pub_date', '-id')
+
+    def latest_by_author(self, author_ids, limit):
+        """По limit последних рецептов каждого автора одним запросом
+        с ROW_NUMBER() OVER (PARTITION BY author_id)."""
+        recipes_by_author = {author_id: [] for author_id in author_ids}
+        if not author_ids or limit <= 0:
+            return recipes_by_author
+        ranked = self.filter(author_id__in=author_ids).annotate(
+            recipe_rank=Window(
+                expression=RowNumber(),
+                partition_by=[F('author_id')],
+                order_by=[F('pub_date').desc(), F('id').desc()],
+            )
+        ).order_by().values('id', 'recipe_rank')
+        sql, params = ranked.query.sql_with_params()
+        table = self.model._meta.db_table
+        recipes = self.raw(
+            f'SELECT * FROM {table} WHERE id IN ('
+            f'SELECT id FROM ({sql}) ranked WHERE recipe_rank <= %s'
+            f') ORDER BY pub_date DESC, id DESC',
+            (*params, limit),
+        )
+        for recipe in recipes:
+            recipes_by_author[recipe.author_id].append(recipe)
+        return recipes_by_author
+
+    def followed_by(self, user):
+        """Рецепты авторов, на которых подписан пользователь."""
+        return self.filter(Exists(Follow.objects.filter(
+            user=user, following=OuterRef('author'))))
+
+    def for_list(self, user):
+        """Рецепты со всеми связями, нужными для полного сериализатора."""
+        return self.select_related('author').prefetch_related(
+            'tags',
+            Prefetch(
+                'recipeingridient_set',
+                queryset=RecipeIngridient.objects.select_related(
+                    'ingredient'),
+            ),
+        ).with_user_flags(user)
+
+
 class Recipes(models.Model):
     author = models.ForeignKey(User,
                                on_delete=models.CASCADE,
@@ -94,8 +211,12 @@ class Recipes(models.Model):
                                                     help_text='введите время '
                                                     'приготовления в минутах')
     image = models.ImageField('картинка',
-                              upload_to='recipes',
+                              upload_to=UPLOAD_TO,
+                              storage=recipe_image_storage,
                               help_text='загрузите картинку')
+    image_variants_ready = models.BooleanField(
+        verbose_name='Варианты картинки готовы', default=False,
+        editable=False)
     tags = models.ManyToManyField(Tag,
                                   through='RecipeTag',
                                   verbose_name='Теги рецепта',
@@ -104,11 +225,31 @@ class Recipes(models.Model):
                                          through='RecipeIngridient',
                                          help_text='выберите ингридиенты')
     pub_date = models.DateTimeField(verbose_name="Дата публикации",
-                                    default=datetime.now(),
+                                    default=timezone.now,
                                     editable=False)
+    updated_at = models.DateTimeField(verbose_name='Дата изменения',
+                                      auto_now=True,
+                                      db_index=True)
+    search_vector = SearchVectorField(null=True, editable=False)
+    favorites_count = models.PositiveIntegerField(
+        verbose_name='В избранном', default=0, editable=False)
+    in_carts_count = models.PositiveIntegerField(
+        verbose_name='В списках покупок', default=0, editable=False)
+    popularity = models.FloatField(verbose_name='Популярность', default=0,
+                                   editable=False)
+
+    objects = RecipeQuerySet.as_manager()
 
     class Meta:
-        ordering = ('-pub_date',)
+        ordering = ('-pub_date', '-id')
+        indexes = [
+            models.Index(fields=['-pub_date', '-id'],
+                         name='recipe_pub_date_id_idx'),
+            models.Index(fields=['author', '-pub_date', '-id'],
+                         name='recipe_author_pub_date_idx'),
+            models.Index(fields=['-popularity', '-id'],
+                         name='recipe_popularity_idx'),
+        ]
         verbose_name = 'Рецепт'
         verbose_name_plural = 'Рецепты'
         default_related_name = 'recipes'
@@ -151,6 +292,9 @@ class Cart(models.Model):
     recipe = models.ForeignKey(Recipes,
                                on_delete=models.CASCADE,
                                verbose_name='Рецепт')
+    created = models.DateTimeField(verbose_name='Дата добавления',
+                                   default=timezone.now,
+                                   db_index=True)
 
     class Meta:
         constraints = [UniqueConstraint(
@@ -174,6 +318,9 @@ class Favorites(models.Model):
     recipe = models.ForeignKey(Recipes,
                                on_delete=models.CASCADE,
                                verbose_name='Рецепт')
+    created = models.DateTimeField(verbose_name='Дата добавления',
+                                   default=timezone.now,
+                                   db_index=True)
 
     class Meta:
         constraints = [models.UniqueConstraint(
@@ -187,3 +334,321 @@ class Favorites(models.Model):
     @property
     def cooking_time(self):
         return self.recipe.cooking_time
+
+
+class CartIngredientTotalManager(models.Manager):
+
+    def apply_deltas(self, deltas):
+        """Применяет изменения {(user_id, ingredient_id): delta} к итогам."""
+        deltas = {key: delta for key, delta in deltas.items()
+                  if key[1] is not None and delta}
+        if not deltas:
+            return
+        user_ids = {user_id for user_id, _ in deltas}
+        ingredient_ids = {ingredient_id for _, ingredient_id in deltas}
+        has_decrements = any(delta < 0 for delta in deltas.values())
+        with transaction.atomic(savepoint=False):
+            # Строки, которых еще нет, select_for_update не заблокирует:
+            # без блокировки пользователей два параллельных добавления
+            # вставили бы одну пару (user, ingredient) дважды.
+            list(User.objects.select_for_update().filter(
+                pk__in=user_ids).order_by('pk').values_list('pk', flat=True))
+            existing = [
+                total for total in self.select_for_update().filter(
+                    user_id__in=user_ids, ingredient_id__in=ingredient_ids)
+                if (total.user_id, total.ingredient_id) in deltas
+            ]
+            for total in existing:
+                total.amount = F('amount') + deltas.pop(
+                    (total.user_id, total.ingredient_id))
+            self.bulk_update(existing, ['amount'])
+            self.bulk_create(
+                self.model(user_id=user_id,
+                           ingredient_id=ingredient_id,
+                           amount=delta)
+                for (user_id, ingredient_id), delta in deltas.items()
+                if delta > 0
+            )
+            if has_decrements:
+                self.filter(user_id__in=user_ids, amount__lte=0).delete()
+
+    def add_recipe(self, user, recipe, sign=1):
+        """Добавляет (или при sign=-1 вычитает) ингредиенты рецепта."""
+        amounts = recipe.recipeingridient_set.values_list(
+            'ingredient_id', 'amount')
+        self.apply_deltas({
+            (user.pk, ingredient_id): sign * amount
+            for ingredient_id, amount in amounts
+        })
+
+    def remove_recipe(self, user, recipe):
+        self.add_recipe(user, recipe, sign=-1)
+
+    @staticmethod
+    def recipe_amounts(recipe):
+        """{id ингредиента: количество} рецепта."""
+        amounts = {}
+        for ingredient_id, amount in recipe.recipeingridient_set.values_list(
+                'ingredient_id', 'amount'):
+            amounts[ingredient_id] = amounts.get(ingredient_id, 0) + amount
+        return amounts
+
+    def delete_recipe(self, recipe):
+        """Вычитает рецепт из всех корзин одним apply_deltas."""
+        self.change_recipe(recipe, self.recipe_amounts(recipe), {})
+
+    def change_recipe(self, recipe, old_amounts, new_amounts):
+        """Переносит правку ингредиентов рецепта в корзины с этим рецептом."""
+        changes = {
+            ingredient_id: (new_amounts.get(ingredient_id, 0)
+                            - old_amounts.get(ingredient_id, 0))
+            for ingredient_id in old_amounts.keys() | new_amounts.keys()
+        }
+        changes = {key: delta for key, delta in changes.items() if delta}
+        if not changes:
+            return
+        self.apply_deltas({
+            (user_id, ingredient_id): delta
+            for user_id in recipe.shopping_cart.values_list(
+                'user_id', flat=True)
+            for ingredient_id, delta in changes.items()
+        })
+
+    def rebuild(self, users=None):
+        """Пересчитывает итоги корзин (всех или выбранных) с нуля."""
+        totals = self.all()
+        carts = Cart.objects.filter(
+            recipe__recipeingridient__ingredient__isnull=False)
+        if users is not None:
+            totals = totals.filter(user__in=users)
+            carts = carts.filter(user__in=users)
+        with transaction.atomic():
+            totals.delete()
+            totals = carts.values(
+                'user', 'recipe__recipeingridient__ingredient'
+            ).annotate(
+                amount=Sum('recipe__recipeingridient__amount')
+            ).order_by().iterator()
+            batch = []
+            created = 0
+            for total in totals:
+                batch.append(self.model(
+                    user_id=total['user'],
+                    ingredient_id=total[
+                        'recipe__recipeingridient__ingredient'],
+                    amount=total['amount'],
+                ))
+                if len(batch) >= REBUILD_BATCH_SIZE:
+                    created += len(self.bulk_create(batch))
+                    batch = []
+            created += len(self.bulk_create(batch))
+        return created
+
+
+class CartIngredientTotal(models.Model):
+    """Сумма ингредиента по всем рецептам из корзины пользователя."""
+
+    user = models.ForeignKey(User,
+                             on_delete=models.CASCADE,
+                             verbose_name='Пользователь')
+    ingredient = models.ForeignKey(Ingredients,
+                                   on_delete=models.CASCADE,
+                                   verbose_name='ингридиент')
+    amount = models.PositiveIntegerField(verbose_name='кол-во')
+
+    objects = CartIngredientTotalManager()
+
+    class Meta:
+        constraints = [UniqueConstraint(
+            fields=['user', 'ingredient'],
+            name='unique_cart_ingredient_total'
+        )]
+        verbose_name = 'Итог списка покупок'
+        verbose_name_plural = 'Итоги списков покупок'
+        default_related_name = 'cart_totals'
+
+    def __str__(self):
+        return f'{self.user}: {self.ingredient} - {self.amount}'
+
+
+class TimelineEntryManager(models.Manager):
+    """Лента подписок с разносом при записи: строка на каждого
+    подписчика автора."""
+
+    def enabled(self):
+        return settings.FEED_STRATEGY == FEED_FAN_OUT_ON_WRITE
+
+    def fan_out(self, recipe):
+        """Кладет новый рецепт в ленты всех подписчиков автора."""
+        followers = Follow.objects.filter(
+            following_id=recipe.author_id).values_list('user_id', flat=True)
+        return self.bulk_create(
+            (self.model(user_id=user_id, recipe_id=recipe.pk,
+                        author_id=recipe.author_id, pub_date=recipe.pub_date)
+             for user_id in followers.iterator()),
+            batch_size=REBUILD_BATCH_SIZE,
+        )
+
+    def follow(self, user_id, author_id):
+        """Переносит рецепты автора в ленту нового подписчика."""
+        recipes = Recipes.objects.filter(author_id=author_id).values_list(
+            'id', 'pub_date')
+        return self.bulk_create(
+            (self.model(user_id=user_id, recipe_id=recipe_id,
+                        author_id=author_id, pub_date=pub_date)
+             for recipe_id, pub_date in recipes.iterator()),
+            batch_size=REBUILD_BATCH_SIZE,
+            ignore_conflicts=True,
+        )
+
+    def unfollow(self, user_id, author_id):
+        return self.filter(user_id=user_id, author_id=author_id).delete()
+
+    def rebuild(self):
+        """Заполняет ленты всех пользователей с нуля."""
+        with transaction.atomic():
+            self.all().delete()
+            created = 0
+            for user_id, author_id in Follow.objects.values_list(
+                    'user_id', 'following_id').iterator():
+                created += len(self.follow(user_id, author_id))
+        return created
+
+
+class TimelineEntry(models.Model):
+    """Рецепт в ленте подписчика; pub_date копируется из рецепта, чтобы
+    страница ленты читалась по одному индексу."""
+
+    user = models.ForeignKey(User,
+                             on_delete=models.CASCADE,
+                             related_name='timeline',
+                             verbose_name='Пользователь')
+    recipe = models.ForeignKey(Recipes,
+                               on_delete=models.CASCADE,
+                               related_name='timeline_entries',
+                               verbose_name='рецепт')
+    author = models.ForeignKey(User,
+                               on_delete=models.CASCADE,
+                               related_name='+',
+                               verbose_name='автор')
+    pub_date = models.DateTimeField(verbose_name='дата публикации')
+
+    objects = TimelineEntryManager()
+
+    class Meta:
+        constraints = [UniqueConstraint(
+            fields=['user', 'recipe'],
+            name='unique_timeline_entry'
+        )]
+        indexes = [
+            models.Index(fields=['user', '-pub_date', '-id'],
+                         name='timeline_user_pub_date_idx'),
+            models.Index(fields=['user', 'author'],
+                         name='timeline_user_author_idx'),
+        ]
+        verbose_name = 'Запись ленты'
+        verbose_name_plural = 'Лента подписок'
+
+    def __str__(self):
+        return f'{self.user}: {self.recipe}'
+
+
+class SimilarRecipeManager(models.Manager):
+
+    def replace(self, neighbours):
+        """Заменяет сохраненных соседей {recipe_id: [(id, score), ...]}."""
+        with transaction.atomic():
+            self.filter(recipe_id__in=list(neighbours)).delete()
+            return self.bulk_create(
+                (self.model(recipe_id=recipe_id, similar_id=similar_id,
+                            score=score)
+                 for recipe_id, similar in neighbours.items()
+                 for similar_id, score in similar),
+                batch_size=REBUILD_BATCH_SIZE,
+            )
+
+
+class SimilarRecipe(models.Model):
+    """Заранее посчитанный сосед рецепта по ингредиентам и тегам."""
+
+    recipe = models.ForeignKey(Recipes,
+                               on_delete=models.CASCADE,
+                               related_name='similar_entries',
+                               verbose_name='рецепт')
+    similar = models.ForeignKey(Recipes,
+                                on_delete=models.CASCADE,
+                                related_name='+',
+                                verbose_name='похожий рецепт')
+    score = models.FloatField(verbose_name='близость')
+
+    objects = SimilarRecipeManager()
+
+    class Meta:
+        constraints = [UniqueConstraint(
+            fields=['recipe', 'similar'],
+            name='unique_similar_recipe'
+        )]
+        indexes = [
+            models.Index(fields=['recipe', '-score'],
+                         name='similar_recipe_score_idx'),
+        ]
+        verbose_name = 'Похожий рецепт'
+        verbose_name_plural = 'Похожие рецепты'
+
+    def __str__(self):
+        return f'{self.recipe} ~ {self.similar}: {self.score:.2f}'
+
+
+class VersionCounterManager(models.Manager):
+
+    def get_versions(self, keys):
+        """{ключ: версия} одним запросом, отсутствующим ключам - 1."""
+        versions = dict(self.filter(key__in=keys).values_list(
+            'key', 'value'))
+        return {key: versions.get(key, 1) for key in keys}
+
+    def bump(self, key):
+        """Атомарно увеличивает версию и возвращает новое значение
+        (upsert одним запросом, PostgreSQL и SQLite 3.35+)."""
+        table = self.model._meta.db_table
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'INSERT INTO {table} (key, value) VALUES (%s, 2) '
+                f'ON CONFLICT (key) DO UPDATE '
+                f'SET value = {table}.value + 1 RETURNING value', [key])
+            return cursor.fetchone()[0]
+
+
+class VersionCounter(models.Model):
+    """Версия данных для ключей кэша и ETag. Хранится в БД, а не в кэше,
+    чтобы не сбрасываться при вытеснении записей."""
+
+    key = models.CharField(max_length=NAME_MAX_LENGHT, primary_key=True,
+                           verbose_name='ключ')
+    value = models.PositiveBigIntegerField(default=1,
+                                           verbose_name='версия')
+
+    objects = VersionCounterManager()
+
+    class Meta:
+        verbose_name = 'Версия данных'
+        verbose_name_plural = 'Версии данных'
+
+    def __str__(self):
+        return f'{self.key}: {self.value}'
+
+
+class IngredientIndexChange(models.Model):
+    """Журнал рецептов с измененными ингредиентами для индекса «из того,
+    что есть»: запись на каждую версию индекса."""
+
+    version = models.PositiveBigIntegerField(primary_key=True,
+                                             verbose_name='версия')
+    recipe_ids = models.JSONField(verbose_name='рецепты')
+
+    class Meta:
+        verbose_name = 'Изменение индекса ингредиентов'
+        verbose_name_plural = 'Изменения индекса ингредиентов'
+
+    def __str__(self):
+        return f'{self.version}: {self.recipe_ids}'
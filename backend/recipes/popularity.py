@@ -0,0 +1,60 @@
+import numpy as np
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from recipes.models import REBUILD_BATCH_SIZE, Cart, Favorites, Recipes
+from recipes.versions import bump_version, get_version
+
+POPULARITY_VERSION_KEY = 'popularity:version'
+HALF_LIFE_HOURS = 72
+# Вклад события старше WINDOW_HALF_LIVES периодов меньше 0.1%.
+WINDOW_HALF_LIVES = 10
+WEIGHTS = ((Favorites, 1.0), (Cart, 0.5))
+
+
+def popularity_version():
+    """Номер последнего пересчета популярности."""
+    return get_version(POPULARITY_VERSION_KEY)
+
+
+def decayed_scores(now, half_life):
+    """{id рецепта: сумма весов добавлений с затуханием вдвое за
+    half_life}. События читаются курсором, суммы считаются NumPy."""
+    since = now - half_life * WINDOW_HALF_LIVES
+    recipe_ids, scores = [], []
+    for model, weight in WEIGHTS:
+        events = model.objects.filter(created__gte=since).values_list(
+            'recipe_id', 'created').order_by()
+        rows = list(events.iterator())
+        if not rows:
+            continue
+        ids, created = zip(*rows)
+        ages = np.array([(now - moment).total_seconds()
+                         for moment in created])
+        recipe_ids.append(np.array(ids, dtype=np.int64))
+        scores.append(weight * np.exp2(
+            -np.maximum(ages, 0) / half_life.total_seconds()))
+    if not recipe_ids:
+        return {}
+    unique_ids, positions = np.unique(np.concatenate(recipe_ids),
+                                      return_inverse=True)
+    totals = np.bincount(positions, weights=np.concatenate(scores))
+    return dict(zip(unique_ids.tolist(), totals.tolist()))
+
+
+def refresh_popularity(now=None, half_life_hours=None):
+    """Записывает свежие оценки в Recipes.popularity одной транзакцией.
+    Возвращает число рецептов с ненулевой оценкой."""
+    now = now or timezone.now()
+    half_life = timezone.timedelta(hours=half_life_hours or getattr(
+        settings, 'POPULARITY_HALF_LIFE_HOURS', HALF_LIFE_HOURS))
+    scores = decayed_scores(now, half_life)
+    with transaction.atomic():
+        Recipes.objects.filter(popularity__gt=0).update(popularity=0)
+        Recipes.objects.bulk_update(
+            [Recipes(pk=pk, popularity=score)
+             for pk, score in scores.items()],
+            ['popularity'], batch_size=REBUILD_BATCH_SIZE)
+    bump_version(POPULARITY_VERSION_KEY)
+    return len(scores)
@@ -0,0 +1,117 @@
+import threading
+from bisect import bisect_left
+from collections import Counter
+
+from django.db import DatabaseError
+
+from recipes.models import Ingredients
+from recipes.versions import catalog_version
+
+SEARCH_LIMIT = 50
+MIN_SIMILARITY = 0.3
+PREFIX_RANK, SUBSTRING_RANK, FUZZY_RANK = range(3)
+
+
+def normalize(value):
+    return ' '.join(value.casefold().replace('ё', 'е').split())
+
+
+def trigrams(value):
+    padded = f'  {value} '
+    return {padded[index:index + 3] for index in range(len(padded) - 2)}
+
+
+class IngredientIndex:
+    """Неизменяемый индекс названий: префиксы, подстроки и триграммы."""
+
+    def __init__(self, ingredients):
+        self.items = [
+            {'id': pk, 'name': name, 'measurement_unit': unit}
+            for pk, name, unit in ingredients
+        ]
+        self.names = [normalize(item['name']) for item in self.items]
+        self.sorted_names = sorted(
+            (name, position) for position, name in enumerate(self.names))
+        self.name_trigrams = [trigrams(name) for name in self.names]
+        self.postings = {}
+        for position, grams in enumerate(self.name_trigrams):
+            for gram in grams:
+                self.postings.setdefault(gram, []).append(position)
+
+    def prefix_matches(self, query):
+        start = bisect_left(self.sorted_names, (query,))
+        for name, position in self.sorted_names[start:]:
+            if not name.startswith(query):
+                break
+            yield position
+
+    def search(self, query, limit=SEARCH_LIMIT):
+        """Сначала совпадения с начала названия, затем подстроки,
+        затем похожие названия (опечатки) по сходству триграмм."""
+        query = normalize(query)
+        if not query:
+            return []
+        ranked = {}
+        for position in self.prefix_matches(query):
+            ranked[position] = (PREFIX_RANK, 0, self.names[position])
+        query_grams = trigrams(query)
+        shared = Counter(
+            position
+            for gram in query_grams
+            for position in self.postings.get(gram, ())
+        )
+        candidates = shared if len(query) >= 3 else range(len(self.names))
+        for position in candidates:
+            if position not in ranked and query in self.names[position]:
+                ranked[position] = (
+                    SUBSTRING_RANK, 0, self.names[position])
+        if len(ranked) < limit:
+            for position, common in shared.items():
+                if position in ranked:
+                    continue
+                similarity = common / (
+                    len(query_grams) + len(self.name_trigrams[position])
+                    - common)
+                if similarity >= MIN_SIMILARITY:
+                    ranked[position] = (
+                        FUZZY_RANK, -similarity, self.names[position])
+        best = sorted(ranked, key=ranked.get)[:limit]
+        return [self.items[position] for position in best]
+
+
+class IngredientSearch:
+    """Индекс на процесс: строится при первом обращении и перестраивается,
+    когда меняется версия справочников, в том числе из других воркеров."""
+
+    def __init__(self):
+        self._index = None
+        self._version = None
+        self._lock = threading.Lock()
+
+    def invalidate(self):
+        self._index = None
+
+    def get_index(self):
+        index = self._index
+        version = catalog_version()
+        if index is not None and self._version == version:
+            return index
+        with self._lock:
+            if self._index is index:
+                self._index = IngredientIndex(
+                    Ingredients.objects.values_list(
+                        'id', 'name', 'measurement_unit').iterator())
+                self._version = version
+            return self._index
+
+    def warm(self):
+        try:
+            self.get_index()
+        except DatabaseError:
+            self.invalidate()
+
+    def search(self, query, limit=SEARCH_LIMIT):
+        return self.get_index().search(query, limit)
+
+
+ingredient_search = IngredientSearch()
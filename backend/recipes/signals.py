@@ -0,0 +1,46 @@
+from django.contrib.auth import get_user_model
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save, pre_delete
+from django.dispatch import receiver
+
+from .matching import recipes_changed
+from .models import Ingredients, Recipes, Tag
+from .search import ingredient_search
+from .versions import CATALOG_VERSION_KEY, bump_version_on_commit
+
+User = get_user_model()
+
+
+@receiver((post_save, post_delete), sender=Tag)
+@receiver((post_save, post_delete), sender=Ingredients)
+def catalog_changed(sender, **kwargs):
+    bump_version_on_commit(CATALOG_VERSION_KEY)
+    if sender is Ingredients:
+        transaction.on_commit(ingredient_search.invalidate)
+
+
+@receiver(post_save, sender=Tag)
+@receiver(pre_delete, sender=Tag)
+def touch_tag_recipes(instance, **kwargs):
+    Recipes.objects.filter(tags=instance).touch()
+
+
+@receiver(post_save, sender=Ingredients)
+@receiver(pre_delete, sender=Ingredients)
+def touch_ingredient_recipes(instance, **kwargs):
+    Recipes.objects.filter(ingredients=instance).touch()
+
+
+@receiver(pre_delete, sender=Ingredients)
+def ingredient_deleted(instance, **kwargs):
+    """Строки рецептов остаются с пустым ингредиентом (SET_NULL), поэтому
+    индекс «из того, что есть» пересобирает эти рецепты."""
+    recipes_changed(Recipes.objects.filter(
+        ingredients=instance).values_list('pk', flat=True))
+
+
+@receiver(post_save, sender=User)
+def touch_author_recipes(instance, created, update_fields, **kwargs):
+    if created or update_fields == frozenset({'last_login'}):
+        return
+    Recipes.objects.filter(author=instance).touch()
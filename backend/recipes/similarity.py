@@ -0,0 +1,173 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Exists, OuterRef, Q, Subquery
+
+from recipes.models import RecipeIngridient, Recipes, RecipeTag, SimilarRecipe
+
+logger = logging.getLogger(__name__)
+
+TOP_K = 10
+TAG_WEIGHT = 0.5
+BATCH_SIZE = 64
+
+executor = ThreadPoolExecutor(max_workers=1,
+                              thread_name_prefix='similar-recipes')
+
+
+class FeatureMatrix:
+    """Разреженные векторы рецептов: ингредиенты с весом 1 и теги с весом
+    TAG_WEIGHT, нормированные по длине. Хранятся построчно (CSR) и
+    постолбцово (CSC), так что X[rows] @ X.T считается только по общим
+    признакам."""
+
+    def __init__(self, recipe_ids, features, weights):
+        self.recipe_ids, rows = np.unique(recipe_ids, return_inverse=True)
+        _, columns = np.unique(features, return_inverse=True)
+        weights = np.asarray(weights, dtype=np.float64)
+        norms = np.sqrt(np.bincount(rows, weights=weights ** 2,
+                                    minlength=len(self.recipe_ids)))
+        values = weights / norms[rows]
+        self.csr = self.compress(rows, columns, values,
+                                 len(self.recipe_ids))
+        self.csc = self.compress(columns, rows, values, columns.max() + 1
+                                 if len(columns) else 0)
+
+    @staticmethod
+    def compress(major, minor, values, size):
+        order = np.lexsort((minor, major))
+        pointers = np.zeros(size + 1, dtype=np.int64)
+        np.cumsum(np.bincount(major, minlength=size), out=pointers[1:])
+        return pointers, minor[order], values[order]
+
+    @classmethod
+    def from_db(cls, recipes=None):
+        """Матрица всех рецептов или рецептов из queryset recipes."""
+        # Строки удаленных ингредиентов (SET_NULL) признаков не дают.
+        ingredients = RecipeIngridient.objects.filter(
+            ingredient__isnull=False)
+        tags = RecipeTag.objects.all()
+        if recipes is not None:
+            ingredients = ingredients.filter(
+                recipe_id__in=Subquery(recipes.values('pk')))
+            tags = tags.filter(recipe_id__in=Subquery(recipes.values('pk')))
+        ingredient_pairs = np.array(
+            list(ingredients.values_list('recipe_id', 'ingredient_id')),
+            dtype=np.int64).reshape(-1, 2)
+        tag_pairs = np.array(
+            list(tags.values_list('recipe_id', 'tag_id')),
+            dtype=np.int64).reshape(-1, 2)
+        # Ингредиенты - четные номера признаков, теги - нечетные.
+        return cls(
+            np.concatenate((ingredient_pairs[:, 0], tag_pairs[:, 0])),
+            np.concatenate((ingredient_pairs[:, 1] * 2,
+                            tag_pairs[:, 1] * 2 + 1)),
+            np.concatenate((np.ones(len(ingredient_pairs)),
+                            np.full(len(tag_pairs), TAG_WEIGHT))),
+        )
+
+    def __len__(self):
+        return len(self.recipe_ids)
+
+    def similarities(self, rows):
+        """Плотный блок косинусной близости строк rows со всеми рецептами."""
+        pointers, columns, values = self.csr
+        counts = pointers[rows + 1] - pointers[rows]
+        local_rows = np.repeat(np.arange(len(rows)), counts)
+        entries = (np.repeat(pointers[rows] - np.cumsum(counts) + counts,
+                             counts) + np.arange(counts.sum()))
+        entry_columns, entry_values = columns[entries], values[entries]
+        column_pointers, column_rows, column_values = self.csc
+        posting_counts = (column_pointers[entry_columns + 1]
+                          - column_pointers[entry_columns])
+        postings = (np.repeat(column_pointers[entry_columns]
+                              - np.cumsum(posting_counts) + posting_counts,
+                              posting_counts)
+                    + np.arange(posting_counts.sum()))
+        block = np.zeros((len(rows), len(self)))
+        np.add.at(block,
+                  (np.repeat(local_rows, posting_counts),
+                   column_rows[postings]),
+                  np.repeat(entry_values, posting_counts)
+                  * column_values[postings])
+        block[np.arange(len(rows)), rows] = 0
+        return block
+
+    def neighbours(self, rows, k=TOP_K):
+        """{id рецепта: [(id соседа, близость), ...]} для строк rows."""
+        block = self.similarities(rows)
+        k = min(k, len(self) - 1)
+        result = {}
+        if k <= 0:
+            return {int(self.recipe_ids[row]): [] for row in rows}
+        best = np.argpartition(-block, k - 1, axis=1)[:, :k]
+        for local, row in enumerate(rows):
+            columns = best[local][np.argsort(-block[local, best[local]])]
+            result[int(self.recipe_ids[row])] = [
+                (int(self.recipe_ids[column]), float(block[local, column]))
+                for column in columns if block[local, column] > 0
+            ]
+        return result
+
+    def batches(self, batch_size=BATCH_SIZE):
+        for start in range(0, len(self), batch_size):
+            yield np.arange(start, min(start + batch_size, len(self)))
+
+    def row_of(self, recipe_id):
+        row = np.searchsorted(self.recipe_ids, recipe_id)
+        if row < len(self) and self.recipe_ids[row] == recipe_id:
+            return row
+        return None
+
+
+def rebuild_similar(k=TOP_K, batch_size=BATCH_SIZE):
+    """Пересчитывает соседей всех рецептов блоками строк."""
+    matrix = FeatureMatrix.from_db()
+    stored = 0
+    with transaction.atomic():
+        SimilarRecipe.objects.all().delete()
+        for rows in matrix.batches(batch_size):
+            stored += len(SimilarRecipe.objects.replace(
+                matrix.neighbours(rows, k)))
+    return stored
+
+
+def update_similar(recipe_id, k=TOP_K):
+    """Соседи одного рецепта: матрица строится только по нему и рецептам
+    с общими ингредиентами, теги учитываются внутри этого круга. Соседи
+    только по тегам появляются при полном пересчете."""
+    ingredients = RecipeIngridient.objects.filter(
+        recipe_id=recipe_id).values('ingredient_id')
+    candidates = Recipes.objects.filter(
+        Q(pk=recipe_id)
+        | Exists(RecipeIngridient.objects.filter(
+            recipe=OuterRef('pk'), ingredient_id__in=ingredients))
+    )
+    matrix = FeatureMatrix.from_db(candidates)
+    row = matrix.row_of(recipe_id)
+    neighbours = ({recipe_id: []} if row is None
+                  else matrix.neighbours(np.array([row]), k))
+    return SimilarRecipe.objects.replace(neighbours)
+
+
+def update_similar_safely(recipe_id, background=False):
+    try:
+        update_similar(recipe_id)
+    except Exception:
+        logger.exception('не удалось обновить похожие рецепты %s', recipe_id)
+    finally:
+        if background:
+            connection.close()
+
+
+def schedule_similar(recipe_id):
+    """Пересчитывает соседей после коммита: в фоне или сразу, если
+    SIMILAR_RECIPES_ASYNC выключен."""
+    if getattr(settings, 'SIMILAR_RECIPES_ASYNC', True):
+        transaction.on_commit(lambda: executor.submit(
+            update_similar_safely, recipe_id, background=True))
+    else:
+        transaction.on_commit(lambda: update_similar_safely(recipe_id))
@@ -0,0 +1,42 @@
+from django.db import transaction
+
+from recipes.models import VersionCounter
+
+CATALOG_VERSION_KEY = 'catalog:version'
+USER_STATE_VERSION_KEY = 'user:{user_id}:state'
+
+
+def get_versions(keys):
+    return VersionCounter.objects.get_versions(keys)
+
+
+def get_version(key):
+    return get_versions([key])[key]
+
+
+def bump_version(key):
+    return VersionCounter.objects.bump(key)
+
+
+def bump_version_on_commit(key):
+    """Версия меняется после коммита, иначе другой воркер успеет
+    закэшировать старые данные под новой версией."""
+    transaction.on_commit(lambda: bump_version(key))
+
+
+def catalog_version():
+    """Номер версии справочников (теги и ингредиенты)."""
+    return get_version(CATALOG_VERSION_KEY)
+
+
+def bump_catalog_version():
+    return bump_version(CATALOG_VERSION_KEY)
+
+
+def user_state_version(user_id):
+    """Номер версии избранного, корзины и подписок пользователя."""
+    return get_version(USER_STATE_VERSION_KEY.format(user_id=user_id))
+
+
+def bump_user_state_version(user_id):
+    return bump_version(USER_STATE_VERSION_KEY.format(user_id=user_id))
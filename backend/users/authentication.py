@@ -0,0 +1,116 @@
+import copy
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from rest_framework.authentication import TokenAuthentication
+
+from api.metrics import record_cache
+from recipes.versions import bump_version_on_commit, get_version
+
+AUTH_VERSION_KEY = 'auth:version'
+TOKEN_CACHE_SIZE = 1024
+TOKEN_CACHE_TTL = 5 * 60
+REVOCATION_CHECK_INTERVAL = 5
+
+
+class LRUCache:
+    """Потокобезопасный LRU-кэш процесса со сроком жизни записей."""
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                return None
+            value, expires = item
+            if expires < time.monotonic():
+                del self._items[key]
+                return None
+            self._items.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._items[key] = (value, time.monotonic() + self.ttl)
+            self._items.move_to_end(key)
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+
+token_cache = LRUCache(
+    getattr(settings, 'AUTH_TOKEN_CACHE_SIZE', TOKEN_CACHE_SIZE),
+    getattr(settings, 'AUTH_TOKEN_CACHE_TTL', TOKEN_CACHE_TTL),
+)
+
+
+class RevocationCheck:
+    """Версия отзыва в БД читается процессом не чаще раза в
+    AUTH_REVOCATION_CHECK_INTERVAL секунд; если она изменилась, кэш
+    токенов процесса сбрасывается целиком."""
+
+    def __init__(self, cache):
+        self.cache = cache
+        self._version = None
+        self._checked = None
+        self._lock = threading.Lock()
+
+    def due(self):
+        interval = getattr(settings, 'AUTH_REVOCATION_CHECK_INTERVAL',
+                           REVOCATION_CHECK_INTERVAL)
+        return (self._checked is None
+                or time.monotonic() - self._checked >= interval)
+
+    def check(self):
+        if not self.due():
+            return
+        with self._lock:
+            if not self.due():
+                return
+            version = get_version(AUTH_VERSION_KEY)
+            if version != self._version:
+                self.cache.clear()
+                self._version = version
+            self._checked = time.monotonic()
+
+
+revocation_check = RevocationCheck(token_cache)
+
+
+def revoke_tokens():
+    """Выход, удаление токена, блокировка или смена прав: кэш этого
+    процесса сбрасывается сразу, остальных - при следующей проверке."""
+    token_cache.clear()
+    bump_version_on_commit(AUTH_VERSION_KEY)
+
+
+class CachedTokenAuthentication(TokenAuthentication):
+    """TokenAuthentication с кэшем token -> пользователь и его права.
+
+    Попадание в кэш обходится без запросов к БД. Отзыв виден в своем
+    процессе сразу, в остальных - не позже чем через
+    AUTH_REVOCATION_CHECK_INTERVAL секунд.
+    """
+
+    def authenticate_credentials(self, key):
+        revocation_check.check()
+        cached = token_cache.get(key)
+        if cached is not None:
+            record_cache('auth_token', True)
+            user, token = cached
+            return copy.copy(user), token
+        record_cache('auth_token', False)
+        user, token = super().authenticate_credentials(key)
+        user.get_all_permissions()
+        token_cache.set(key, (user, token))
+        return copy.copy(user), token
@@ -1,6 +1,7 @@
-from django.contrib.auth.models import AbstractUser
+from django.contrib.auth.models import AbstractUser, UserManager
 from django.db import models
-from django.db.models import F, Q
+from django.db.models import Exists, F, OuterRef, Q, Value
+from django.db.models.functions import Greatest
 from django.db.models.constraints import CheckConstraint, UniqueConstraint
 
 from .validators import validate_username
@@ -12,6 +13,26 @@ LAST_NAME_MAX_LENGTH = 150
 PASSWORD_MAX_LENGHT = 150
 
 
+class CounterQuerySet(models.QuerySet):
+
+    def increment(self, **deltas):
+        """Атомарно меняет счетчики, не опуская их ниже нуля."""
+        return self.update(**{field: Greatest(F(field) + delta, 0)
+                              for field, delta in deltas.items()})
+
+    def with_subscription(self, user):
+        """Флаг is_subscribed для user одним запросом со списком."""
+        if user is None or user.is_anonymous:
+            return self.annotate(
+                is_subscribed=Value(False, models.BooleanField()))
+        return self.annotate(is_subscribed=Exists(Follow.objects.filter(
+            user=user, following=OuterRef('pk'))))
+
+
+class CounterUserManager(UserManager.from_queryset(CounterQuerySet)):
+    pass
+
+
 class User(AbstractUser):
 
     username = models.CharField(
@@ -44,6 +65,23 @@ class User(AbstractUser):
         verbose_name="Активирован",
         default=True,
     )
+    recipes_count = models.PositiveIntegerField(
+        verbose_name='Рецептов',
+        default=0,
+        editable=False,
+    )
+    followers_count = models.PositiveIntegerField(
+        verbose_name='Подписчиков',
+        default=0,
+        editable=False,
+    )
+    following_count = models.PositiveIntegerField(
+        verbose_name='Подписок',
+        default=0,
+        editable=False,
+    )
+
+    objects = CounterUserManager()
 
     class Meta:
         ordering = ('username',)
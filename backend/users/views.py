@@ -1,4 +1,5 @@
 from django.contrib.auth import get_user_model
+from django.db import transaction
 from django.shortcuts import get_object_or_404
 from djoser.views import UserViewSet as DjoserUserViewSet
 from rest_framework import status
@@ -7,28 +8,40 @@ from rest_framework.permissions import DjangoModelPermissions, IsAuthenticated
 from rest_framework.response import Response
 
 from .mixins import CreateDestroyViewSet
+from recipes.models import Recipes, TimelineEntry
+from recipes.versions import bump_user_state_version
 from users.models import Follow
+from api.async_views import AsyncReadViewSetMixin
 from api.pagination import PageLimitPagination
-from api.serializers import (UserSerializer, ShowFollowSerializer)
+from api.serializers import (UserSerializer, ShowFollowSerializer,
+                             get_recipes_limit)
 User = get_user_model()
 
 
-class UserViewSet(DjoserUserViewSet):
+class UserViewSet(AsyncReadViewSetMixin, DjoserUserViewSet):
     queryset = User.objects.all()
     serializer_class = UserSerializer
     permission_classes = [DjangoModelPermissions, ]
     pagination_class = PageLimitPagination
 
+    def get_queryset(self):
+        return super().get_queryset().with_subscription(self.request.user)
+
     @action(
         detail=False,
         permission_classes=(IsAuthenticated,))
     def subscriptions(self, request):
-        queryset = Follow.objects.filter(user=request.user)
+        recipes_limit = get_recipes_limit(request)
+        queryset = Follow.objects.filter(
+            user=request.user).select_related('following').order_by('-id')
         pages = self.paginate_queryset(queryset)
+        recipes_by_author = Recipes.objects.latest_by_author(
+            [follow.following_id for follow in pages], recipes_limit)
         serializer = ShowFollowSerializer(
             pages,
             many=True,
-            context={'request': request},)
+            context={'request': request,
+                     'recipes_by_author': recipes_by_author},)
         return self.get_paginated_response(serializer.data)
 
 
@@ -44,13 +57,19 @@ class FollowViewSet(CreateDestroyViewSet):
         return context
 
     def perform_create(self, serializer):
-        serializer.save(
-            user=self.request.user,
-            following=get_object_or_404(
-                User,
-                id=self.kwargs.get('user_id')
-            )
-        )
+        following = get_object_or_404(User, id=self.kwargs.get('user_id'))
+        with transaction.atomic():
+            serializer.save(user=self.request.user, following=following)
+            User.objects.filter(pk=self.request.user.pk).increment(
+                following_count=1)
+            User.objects.filter(pk=following.pk).increment(
+                followers_count=1)
+            # Автор с followers_count вложен в рецепты: меняются их ETag.
+            Recipes.objects.filter(author=following).touch()
+            if TimelineEntry.objects.enabled():
+                TimelineEntry.objects.follow(self.request.user.pk,
+                                             following.pk)
+        bump_user_state_version(self.request.user.pk)
 
     @action(methods=('delete',), detail=True)
     def delete(self, request, user_id):
@@ -59,9 +78,17 @@ class FollowViewSet(CreateDestroyViewSet):
                 user=request.user, following_id=user_id).exists():
             return Response({'errors': 'Вы не были подписаны на автора'},
                             status=status.HTTP_400_BAD_REQUEST)
-        get_object_or_404(
-            Follow,
-            user=request.user,
-            following_id=user_id
-        ).delete()
+        with transaction.atomic():
+            get_object_or_404(
+                Follow,
+                user=request.user,
+                following_id=user_id
+            ).delete()
+            User.objects.filter(pk=request.user.pk).increment(
+                following_count=-1)
+            User.objects.filter(pk=user_id).increment(
+                followers_count=-1)
+            Recipes.objects.filter(author_id=user_id).touch()
+            TimelineEntry.objects.unfollow(request.user.pk, user_id)
+        bump_user_state_version(request.user.pk)
         return Response(status=status.HTTP_204_NO_CONTENT)